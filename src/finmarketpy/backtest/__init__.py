@@ -3,4 +3,6 @@ __author__ = 'saeedamen'
 from finmarketpy.backtest.backtestengine import Backtest
 from finmarketpy.backtest.backtestrequest import BacktestRequest
 from finmarketpy.backtest.backtestengine import TradingModel
+from finmarketpy.backtest.backtestsweep import BacktestSweep
 from finmarketpy.backtest.tradeanalysis import TradeAnalysis
+from finmarketpy.backtest.tradeattribution import TradeAttribution
@@ -17,6 +17,8 @@ __author__ = 'saeedamen'  # Saeed Amen
 import numpy as np
 import pandas as pd
 
+from numba import guvectorize
+
 from finmarketpy.util.marketconstants import MarketConstants
 
 from findatapy.util import SwimPool
@@ -37,10 +39,131 @@ except:
 import pickle
 
 from finmarketpy.backtest.backtestrequest import BacktestRequest
+from finmarketpy.backtest.tradeattribution import TradeAttribution
+from finmarketpy.util.shareddataframe import SharedDataFrame
 
 market_constants = MarketConstants()
 
 
+@guvectorize(['void(f8[:], f8[:], b1[:], f8[:], f8[:], f8[:], f8[:])'],
+             '(n),(n),(n),(n),(n),(n)->(n)', cache=True, target="cpu",
+             nopython=True)
+def _stop_loss_take_profit_numba(signal, returns, non_trading, stop_loss,
+                                 take_profit, trailing_stop, out):
+    trade_ret = 0.0
+    trade_peak = 0.0
+
+    stop_signal = np.nan
+    out_signal = np.nan
+
+    for i in range(len(out)):
+        # Cumulative returns of the trade held into this point (which is
+        # reset whenever the signal held changes)
+        cum_ret = np.nan
+
+        if i >= 2:
+            held_change = abs(signal[i - 1] - signal[i - 2])
+
+            if not np.isnan(held_change):
+                if held_change > 0:
+                    trade_ret = 0.0
+                    trade_peak = 0.0
+
+                ret = signal[i - 1] * returns[i]
+
+                if not np.isnan(ret):
+                    trade_ret = trade_ret + ret
+                    trade_peak = max(trade_peak, trade_ret)
+                    cum_ret = trade_ret
+
+        # Close the position if we have hit a stop, otherwise only change
+        # it when the signal changes (so it stays closed till the next trade)
+        if cum_ret > take_profit[i] or cum_ret < stop_loss[i] \
+                or cum_ret - trade_peak < trailing_stop[i]:
+            stop_signal = 0.0
+        elif i == 0 or abs(signal[i] - signal[i - 1]) != 0:
+            if not np.isnan(signal[i]):
+                stop_signal = signal[i]
+
+        # Can't trade when the asset isn't trading, so fill down
+        if not non_trading[i] and not np.isnan(stop_signal):
+            out_signal = stop_signal
+
+        out[i] = out_signal
+
+
+def _cost_vector(cost, columns) -> np.ndarray:
+    """Creates a vector of costs for each column, from a float or a
+    dictionary of costs by asset name (NaN if no costs are defined)
+    """
+    if cost is None:
+        return np.repeat(np.nan, len(columns))
+
+    if isinstance(cost, dict):
+        cost_ind = []
+
+        for k in columns:
+            try:
+                cost_ind.append(cost[k.split('.')[0]])
+            except:
+                cost_ind.append(cost['default'])
+
+        return np.array(cost_ind, dtype=float)
+
+    return np.repeat(float(cost), len(columns))
+
+
+def _calculate_signal_returns_with_tc(signal: np.ndarray,
+                                      returns_df: pd.DataFrame,
+                                      tc, rc) -> np.ndarray:
+    """Calculates the returns of signals (time x asset) with transaction
+    costs and roll costs, in the same way as
+    Calculations.calculate_signal_returns_with_tc_matrix, but on arrays,
+    with the costs broadcast along each row (rather than as DataFrames)
+    """
+
+    # Costs which vary over time need to be aligned by date
+    if isinstance(tc, pd.DataFrame) or isinstance(rc, pd.DataFrame):
+        return Calculations().calculate_signal_returns_with_tc_matrix(
+            pd.DataFrame(signal, index=returns_df.index), returns_df,
+            tc=tc, rc=rc).values
+
+    return _signal_returns_with_tc(signal, returns_df.values,
+                                   _cost_vector(tc, returns_df.columns),
+                                   _cost_vector(rc, returns_df.columns))
+
+
+def _signal_returns_with_tc(signal: np.ndarray, returns: np.ndarray,
+                            tc: np.ndarray, rc: np.ndarray) -> np.ndarray:
+    """Calculates the returns of signals with transaction costs and roll
+    costs, with time on the second to last axis and the assets on the last
+    axis (eg. time x asset or parameter set x time x asset for
+    BacktestSweep), broadcasting the returns and costs against the signals
+    """
+    signal_shift = _shift_time(signal)
+
+    signal_pnl = signal_shift * returns - np.abs(signal_shift - signal) * tc
+
+    # NaN roll costs are ignored
+    if not np.isnan(rc).all():
+        with np.errstate(invalid='ignore'):
+            signal_pnl = signal_pnl - np.where(np.isnan(rc), 0.0,
+                                               np.abs(signal_shift) * rc)
+
+    return signal_pnl
+
+
+def _shift_time(data: np.ndarray) -> np.ndarray:
+    """Shifts an array down by one period along the time axis (the second to
+    last axis), like pd.DataFrame.shift(1)
+    """
+    data_shift = np.empty(data.shape)
+    data_shift[..., 0, :] = np.nan
+    data_shift[..., 1:, :] = data[..., :-1, :]
+
+    return data_shift
+
+
 class Backtest(object):
     """Conducts backtest for strategies trading assets. Assumes we have an
     input of total returns. Reports historical return statistics
@@ -51,6 +174,9 @@ class Backtest(object):
     def __init__(self):
         self._pnl = None
         self._portfolio = None
+
+        # State required to extend the backtest with new rows later
+        self._update_state = None
         return
 
     def calculate_diagnostic_trading_PnL(
@@ -124,7 +250,8 @@ class Backtest(object):
             asset_a_df: pd.DataFrame,
             signal_df: pd.DataFrame,
             contract_value_df: pd.DataFrame,
-            run_in_parallel: bool = False):
+            run_in_parallel: bool = False,
+            keep_update_state: bool = False):
         """Calculates P&L of a trading strategy and statistics to be retrieved
         later
 
@@ -148,10 +275,18 @@ class Backtest(object):
 
         contract_value_df : pd.DataFrame
             Daily size of contracts
+
+        run_in_parallel : bool
+            Calculate the return statistics and cumulative indices in several
+            processes (only for large backtests)
+
+        keep_update_state : bool
+            Keep the aligned inputs, so the backtest can be extended later
+            with update_trading_PnL (default - False, given these are as
+            large as the whole history)
         """
 
         calculations = Calculations()
-        risk_engine = RiskEngine()
 
         # # Do an outer join first, so can fill out signal and fill it down
         # # this captures the case where the signal changes on an asset holiday
@@ -167,9 +302,14 @@ class Backtest(object):
 
         logger.info("Calculating trading P&L...")
 
-        signal_df = signal_df.shift(br.signal_delay)
-        asset_df, signal_df = calculations.join_left_fill_right(asset_a_df,
-                                                                signal_df)
+        update_state = None
+
+        if keep_update_state:
+            update_state = {'asset_a_df': asset_a_df, 'signal_df': signal_df,
+                            'contract_value_a_df': contract_value_df}
+
+        asset_df, signal_df, returns_df = self._align_signal_with_asset(
+            br, asset_a_df, signal_df, update_state=update_state)
 
         if (contract_value_df is not None):
             asset_df, contract_value_df = asset_df.align(contract_value_df,
@@ -179,20 +319,6 @@ class Backtest(object):
                 method='ffill')  # fill down asset holidays (we won't trade
             # on these days)
 
-        # Non-trading days of the assets (this may of course vary between the
-        # assets we are trading
-        # if they are from different asset classes)
-        non_trading_days = np.isnan(asset_df.values)
-
-        # Only allow signals to change on the days when we can trade assets
-        signal_df = signal_df.mask(
-            non_trading_days)  # fill asset holidays with NaN signals
-        signal_df = signal_df.ffill()  # fill these down
-
-        # Transaction costs and roll costs
-        tc = br.spot_tc_bp
-        rc = br.spot_rc_bp
-
         signal_cols = signal_df.columns.values
         asset_df_cols = asset_df.columns.values
 
@@ -201,108 +327,11 @@ class Backtest(object):
         for i in range(0, len(asset_df_cols)):
             pnl_cols.append(asset_df_cols[i] + " / " + signal_cols[i])
 
-        # Fill down asset holidays (we won't trade on these days)
-        asset_df = asset_df.ffill()
-        returns_df = calculations.calculate_returns(asset_df)
-
-        # Apply a stop loss/take profit to every trade if this has been specified
-        # do this before we start to do vol weighting etc.
-        if br.take_profit is not None and br.stop_loss is not None:
-            returns_df = calculations.calculate_returns(asset_df)
-
-            # Makes assumption that signal column order matches that of returns
-            temp_strategy_rets_df = calculations.calculate_signal_returns_as_matrix(
-                signal_df, returns_df)
-
-            trade_rets_df = calculations.calculate_cum_rets_trades(signal_df,
-                                                                   temp_strategy_rets_df)
-
-            # pre_signal_df = signal_df.copy()
-
-            signal_df = calculations.calculate_risk_stop_signals(signal_df,
-                                                                 trade_rets_df,
-                                                                 br.stop_loss,
-                                                                 br.take_profit)
-
-            # Make sure we can't trade where asset price is undefined and
-            # carry over signal
-            signal_df = signal_df.mask(
-                non_trading_days)  # fill asset holidays with NaN signals
-            signal_df = signal_df.fillna(
-                method='ffill')  # fill these down (when asset is not trading
-
-            # for debugging purposes
-            # if True:
-            #     signal_df_copy = signal_df.copy()
-            #     trade_rets_df_copy = trade_rets_df.copy()
-            #
-            #     asset_df_copy.columns = [x + '_asset' for x in temp_strategy_rets_df.columns]
-            #     temp_strategy_rets_df.columns = [x + '_strategy_rets' for x in temp_strategy_rets_df.columns]
-            #     signal_df_copy.columns = [x + '_final_signal' for x in signal_df_copy.columns]
-            #     trade_rets_df_copy.columns = [x + '_cum_trade' for x in trade_rets_df_copy.columns]
-            #
-            #     to_plot = _calculations.pandas_outer_join([asset_df_copy, pre_signal_df, signal_df_copy, trade_rets_df_copy, temp_strategy_rets_df])
-            #     to_plot.to_csv('test.csv')
-
-        if br.portfolio_weight_construction is None:
-            pwc = PortfolioWeightConstruction(br=br)
-        else:
-            pwc = br.portfolio_weight_construction
-
-        # Adjust signal weights and portfolio weights (eg. using various rules, like vol targeting)
-        # and also aggregate final portfolio weights
-        portfolio_signal_before_weighting, portfolio_signal, portfolio_leverage_df, portfolio, individual_leverage_df, pnl = \
-            pwc.optimize_portfolio_weights(returns_df, signal_df, pnl_cols)
-
-        portfolio_total_longs, portfolio_total_shorts, portfolio_net_exposure, portfolio_total_exposure \
-            = self.calculate_exposures(portfolio_signal)
-
-        # Apply position limits?
-        position_clip_adjustment = risk_engine.calculate_position_clip_adjustment \
-            (portfolio_net_exposure, portfolio_total_exposure, br)
-
-        # If we have any position clip adjustment, for example related to max position sizes
-        if position_clip_adjustment is not None:
-            length_cols = len(signal_df.columns)
-
-            position_clip_adjustment_matrix = np.transpose(
-                np.repeat(
-                    position_clip_adjustment.values.flatten()[np.newaxis, :],
-                    length_cols, 0))
-
-            # Recalculate portfolio signals after adjustment (for individual components - without
-            # weighting each signal separately)
-            portfolio_signal_before_weighting = pd.DataFrame(
-                data=(
-                        portfolio_signal_before_weighting.values * position_clip_adjustment_matrix),
-                index=portfolio_signal_before_weighting.index,
-                columns=portfolio_signal_before_weighting.columns)
-
-            # Recalculate portfolio signal after adjustment (for portfolio
-            # level positions)
-            portfolio_signal = pd.DataFrame(
-                data=(
-                        portfolio_signal.values * position_clip_adjustment_matrix),
-                index=portfolio_signal.index,
-                columns=portfolio_signal.columns)
-
-            # Recalculate portfolio leverage with position constraint
-            # (multiply vectors elementwise)
-            portfolio_leverage_df = pd.DataFrame(
-                data=(
-                        portfolio_leverage_df.values * position_clip_adjustment.values),
-                index=portfolio_leverage_df.index,
-                columns=portfolio_leverage_df.columns)
-
-            # Recalculate total long, short, net and absolute exposures of the
-            # whole portfolio after the position
-            # clip adjustment
-            portfolio_total_longs, portfolio_total_shorts, portfolio_net_exposure, portfolio_total_exposure \
-                = self.calculate_exposures(portfolio_signal)
-
-        # Calculate final portfolio returns with the amended portfolio leverage (by default just 1s)
-        portfolio = calculations.calculate_signal_returns_with_tc_matrix(
-            portfolio_leverage_df, portfolio, tc=tc, rc=rc)
+        portfolio_signal, portfolio_leverage_df, portfolio, \
+        individual_leverage_df, pnl, components_pnl, portfolio_total_longs, \
+        portfolio_total_shorts, portfolio_net_exposure, \
+        portfolio_total_exposure = self._calculate_portfolio(
+            br, signal_df, returns_df, pnl_cols)
 
         # Assign all the property variables
         # Trim them if we have asked for a different plot start/finish
@@ -316,9 +345,8 @@ class Backtest(object):
 
         self._portfolio = self._filter_by_plot_start_finish_date(portfolio, br)
 
-        # Calculate each period of trades
-        self._portfolio_trade = self._portfolio_signal - self._portfolio_signal.shift(
-            1)
+        # Each period of trades (calculated on demand)
+        self._portfolio_trade = None
 
         # Expressing trades/positions in terms of notionals
         self._portfolio_signal_notional = None
@@ -353,15 +381,13 @@ class Backtest(object):
         # P&L components of individual assets after all the portfolio level
         # risk signals and position limits have been applied
         self._components_pnl = self._filter_by_plot_start_finish_date(
-            calculations.calculate_signal_returns_with_tc_matrix(
-                portfolio_signal_before_weighting,
-                returns_df, tc=tc, rc=rc), br)
-        self._components_pnl.columns = pnl_cols
+            components_pnl, br)
 
-        # TODO FIX very slow - hence only calculate on demand
-        # _pnl_trades = _calculations.calculate_individual_trade_gains(signal_df, _pnl)
+        # Individual trades are only calculated on demand
         self._pnl_trades = None
         self._components_pnl_trades = None
+        self._pnl_trades_detail = None
+        self._components_pnl_trades_detail = None
 
         self._trade_no = None
         self._portfolio_trade_no = None
@@ -376,134 +402,949 @@ class Backtest(object):
         self._portfolio_ret_stats = RetStats(self._portfolio, br.ann_factor,
                                              br.resample_ann_factor)
 
-        # Also create other measures of portfolio
+        # Also other measures of portfolio (calculated on demand)
         # * portfolio & trades in terms of a predefined notional (in USD)
         # * portfolio & trades in terms of contract sizes (particularly useful for futures)
-        if br.portfolio_notional_size is not None:
-
-            # Express positions in terms of the notional size specified
-            self._portfolio_signal_notional = self._portfolio_signal * br.portfolio_notional_size
-            self._portfolio_signal_trade_notional = self._portfolio_signal_notional \
-                                                    - self._portfolio_signal_notional.shift(
-                1)
-
-            df_trades_sizes = pd.DataFrame()
-
-            rounded_portfolio_signal_trade_notional = self._portfolio_signal_trade_notional.round(
-                2)
-
-            for k in rounded_portfolio_signal_trade_notional.columns:
-                df_trades_sizes[k] = pd.value_counts(
-                    rounded_portfolio_signal_trade_notional[k], sort=True)
+        self._portfolio_notional_size = br.portfolio_notional_size
+        self._contract_value_df = contract_value_df
 
-            df_trades_sizes = df_trades_sizes[df_trades_sizes.index != 0]
-
-            self._portfolio_signal_trade_notional_sizes = df_trades_sizes
-
-            self._portfolio_total_longs_notional = portfolio_total_longs * br.portfolio_notional_size
-            self._portfolio_total_shorts_notional = portfolio_total_shorts * br.portfolio_notional_size
-            self._portfolio_net_exposure_notional = portfolio_net_exposure * br.portfolio_notional_size
-            self._portfolio_total_exposure_notional = portfolio_total_exposure * br.portfolio_notional_size
-
-            # Get the positions in terms of the contract sizes
-            notional_copy = self._portfolio_signal_notional.copy(deep=True)
-            notional_copy_cols = [x.split('.')[0] for x in
-                                  notional_copy.columns]
-            notional_copy_cols = [x + '.contract-value' for x in
-                                  notional_copy_cols]
-
-            notional_copy.columns = notional_copy_cols
+        # Cumulative indices are calculated on demand (unless they are
+        # calculated in parallel below)
+        self._cum_index = br.cum_index
 
-            # Can only give contract sizes if these are defined
-            if contract_value_df is not None:
-                contract_value_df = contract_value_df[notional_copy_cols]
-                notional_df, contract_value_df = notional_copy.align(
-                    contract_value_df, join='left', axis='index')
+        self._pnl_cum = None
+        self._components_pnl_cum = None
+        self._portfolio_cum = None
 
-                # Careful make sure orders of magnitude are same for the notional and the contract value
-                self._portfolio_signal_contracts = notional_df / contract_value_df
-                self._portfolio_signal_contracts.columns = self._portfolio_signal_notional.columns
-                self._portfolio_signal_trade_contracts = self._portfolio_signal_contracts \
-                                                         - self._portfolio_signal_contracts.shift(
-                    1)
+        thread_no = market_constants.backtest_thread_no[
+            market_constants.generic_plat]
 
-        # TODO parallel version still work in progress!
-        logger.info("Cumulative index calculations")
+        # Only worth starting up processes for large backtests (eg. many
+        # years of intraday data), given the overhead of pickling
+        if thread_no > 1 and run_in_parallel and self._pnl.size \
+                >= market_constants.backtest_parallel_min_size:
+            logger.info("Cumulative index calculations")
 
-        if False:  # market_constants.backtest_thread_no[market_constants.generic_plat] > 1 and run_in_parallel:
             swim_pool = SwimPool(
                 multiprocessing_library=market_constants.multiprocessing_library)
 
             pool = swim_pool.create_pool(
                 thread_technique=market_constants.backtest_thread_technique,
-                thread_no=market_constants.backtest_thread_no[
-                    market_constants.generic_plat])
+                thread_no=thread_no)
+
+            if br.cum_index == 'mult':
+                create_index = calculations.create_mult_index
+            elif br.cum_index == 'add':
+                create_index = calculations.create_add_index
 
+            # The return statistics and cumulative indices are independent
+            # of each other (and the indices of each column too), so they can
+            # be calculated in separate processes, giving identical output
+            # to the serial version
             r1 = pool.apply_async(self._pnl_ret_stats.calculate_ret_stats)
             r2 = pool.apply_async(
                 self._components_pnl_ret_stats.calculate_ret_stats)
             r3 = pool.apply_async(
                 self._portfolio_ret_stats.calculate_ret_stats)
 
-            resultsA = pool.apply_async(calculations.create_mult_index,
-                                        args=(self._pnl,))
-            resultsB = pool.apply_async(calculations.create_mult_index,
-                                        args=(self._components_pnl,))
-            resultsC = pool.apply_async(calculations.create_mult_index,
+            resultsA = [pool.apply_async(create_index, args=(df,))
+                        for df in self._split_columns(self._pnl, thread_no)]
+            resultsB = [pool.apply_async(create_index, args=(df,))
+                        for df in self._split_columns(self._components_pnl,
+                                                      thread_no)]
+            resultsC = pool.apply_async(create_index,
                                         args=(self._portfolio,))
 
-            swim_pool.close_pool(pool)
-
             self._pnl_ret_stats = r1.get()
             self._components_pnl_ret_stats = r2.get()
             self._portfolio_ret_stats = r3.get()
 
-            self._pnl_cum = resultsA.get()
-            self._components_pnl_cum = resultsB.get()
-            self._portfolio_cum = resultsC.get()
+            self._pnl_cum = pd.concat([r.get() for r in resultsA], axis=1)
+            self._components_pnl_cum = pd.concat([r.get() for r in resultsB],
+                                                 axis=1)
+            self._portfolio_cum = resultsC.get()
+
+            swim_pool.close_pool(pool, force_process_respawn=True)
+
+            self._pnl_cum.columns = pnl_cols
+            self._components_pnl_cum.columns = pnl_cols
+            self._portfolio_cum.columns = ['Port']
+
+            logger.info("Completed cumulative index calculations")
+
+        # Keep everything we need to extend the backtest with new rows later
+        if update_state is not None:
+            update_state['signal'] = signal_df
+            update_state['returns_df'] = returns_df
+            update_state['pnl_cols'] = pnl_cols
+            update_state['cum_state'] = [None, None, None]
+
+        self._update_state = update_state
+
+    def update_trading_PnL(
+            self,
+            br: BacktestRequest,
+            asset_a_df: pd.DataFrame,
+            signal_df: pd.DataFrame,
+            contract_value_df: pd.DataFrame = None):
+        """Extends a backtest, which has already been calculated with
+        calculate_trading_PnL, with new rows of asset prices and signals (eg.
+        when running a strategy live, adding a new bar every day).
+
+        Rather than recalculating the whole history, only the new rows (and a
+        short warm up window, needed for the rolling volatility, rebalancing
+        and any open trades for stop losses) are calculated and appended. The
+        output is identical to calling calculate_trading_PnL on the whole
+        history (up to floating point rounding in the rolling volatility).
+
+        The new rows are still appended to the existing full history
+        DataFrames (and the inputs kept for later updates), so each update
+        copies the whole history, even though only the new rows are
+        calculated.
+
+        The backtest must have been calculated with keep_update_state=True.
+        Where the backtest cannot be extended incrementally (eg. with a
+        custom PortfolioWeightConstruction, plot start/finish dates or
+        transaction costs which are DataFrames), it falls back to
+        recalculating the whole history.
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest (should be the same as for the
+            original calculation)
+
+        asset_a_df : pd.DataFrame
+            New asset prices, with dates after those already in the backtest
+
+        signal_df : pd.DataFrame
+            New signals, with dates after those already in the backtest
+
+        contract_value_df : pd.DataFrame
+            New daily size of contracts
+        """
+
+        logger = LoggerManager().getLogger(__name__)
+
+        state = self._update_state
+
+        if state is None:
+            if self._pnl is not None:
+                raise Exception("Backtest can only be updated if it was "
+                                "calculated with keep_update_state=True")
+
+            self.calculate_trading_PnL(br, asset_a_df, signal_df,
+                                       contract_value_df,
+                                       keep_update_state=True)
+
+            return
+
+        if len(asset_a_df.index) == 0:
+            return
+
+        n0 = len(state['asset_a_df'].index)
+
+        start = None
+
+        if self._is_incremental_update(br):
+            start = self._update_window_start(br, state['asset_a_df'].index,
+                                              n0)
+
+        if start is None:
+            logger.info("Recalculating whole backtest...")
+
+            contract_value_a_df = state['contract_value_a_df']
+
+            if contract_value_df is not None:
+                contract_value_a_df = pd.concat([contract_value_a_df,
+                                                 contract_value_df])
+
+            self.calculate_trading_PnL(
+                br, pd.concat([state['asset_a_df'], asset_a_df]),
+                pd.concat([state['signal_df'], signal_df]),
+                contract_value_a_df, keep_update_state=True)
+
+            return
+
+        logger.info("Updating trading P&L...")
+
+        calculations = Calculations()
+
+        last_date = state['asset_a_df'].index[-1]
+
+        # Delay the new signals (including any signals we had after the last
+        # asset date)
+        old_signal_df = state['signal_df']
+
+        ind = old_signal_df.index.searchsorted(last_date, side='right')
+        ind_delay = max(ind - br.signal_delay, 0)
+
+        signal_new_df = pd.concat(
+            [old_signal_df.iloc[ind_delay:], signal_df]).shift(
+            br.signal_delay).iloc[ind - ind_delay:]
+
+        # Carry on from the last signal/asset price (exactly the same as
+        # aligning the whole history)
+        asset_new_df, signal_new_df = calculations.join_left_fill_right(
+            asset_a_df,
+            pd.concat([state['signal_joined_last'], signal_new_df]))
+
+        signal_joined_last = signal_new_df.iloc[-1:]
+        non_trading_days = np.isnan(asset_new_df.values)
+
+        signal_new_df = pd.concat(
+            [state['signal_pre_stop'].iloc[-1:],
+             signal_new_df.mask(non_trading_days)]).ffill().iloc[1:]
+
+        asset_new_df = pd.concat(
+            [state['asset_last'], asset_new_df]).ffill()
+        returns_new_df = calculations.calculate_returns(asset_new_df).iloc[1:]
+
+        signal_pre_stop = pd.concat([state['signal_pre_stop'], signal_new_df])
+
+        if self._has_stops(br):
+            # Needs the cumulative returns of every trade which is still open
+            stop_start = self._stop_window_start(state['signal_pre_stop'].values,
+                                                 n0)
+
+            non_trading_days = np.isnan(np.concatenate(
+                [state['asset_a_df'].values[stop_start:], asset_a_df.values]))
+
+            signal_new_df = self._apply_stop_loss_take_profit(
+                br, pd.concat([state['returns_df'].iloc[stop_start:],
+                               returns_new_df]),
+                signal_pre_stop.iloc[stop_start:],
+                non_trading_days).iloc[n0 - stop_start:]
+
+        signal_all_df = pd.concat([state['signal'], signal_new_df])
+        returns_all_df = pd.concat([state['returns_df'], returns_new_df])
+
+        # Recalculate the weights over the warm up window and the new rows
+        portfolio_signal, portfolio_leverage_df, portfolio, \
+        individual_leverage_df, pnl, components_pnl, portfolio_total_longs, \
+        portfolio_total_shorts, portfolio_net_exposure, \
+        portfolio_total_exposure = self._calculate_portfolio(
+            br, signal_all_df.iloc[start:], returns_all_df.iloc[start:],
+            state['pnl_cols'])
+
+        new = n0 - start
+
+        portfolio.columns = ['Port']
+
+        self._signal = signal_all_df
+
+        if self._portfolio_trade is not None:
+            self._portfolio_trade = pd.concat(
+                [self._portfolio_trade,
+                 (portfolio_signal - portfolio_signal.shift(1)).iloc[new:]])
+
+        self._portfolio_signal = pd.concat(
+            [self._portfolio_signal, portfolio_signal.iloc[new:]])
+        self._portfolio_leverage = pd.concat(
+            [self._portfolio_leverage, portfolio_leverage_df.iloc[new:]])
+        self._portfolio = pd.concat([self._portfolio, portfolio.iloc[new:]])
+
+        self._portfolio_total_longs = pd.concat(
+            [self._portfolio_total_longs, portfolio_total_longs.iloc[new:]])
+        self._portfolio_total_shorts = pd.concat(
+            [self._portfolio_total_shorts, portfolio_total_shorts.iloc[new:]])
+        self._portfolio_net_exposure = pd.concat(
+            [self._portfolio_net_exposure, portfolio_net_exposure.iloc[new:]])
+        self._portfolio_total_exposure = pd.concat(
+            [self._portfolio_total_exposure,
+             portfolio_total_exposure.iloc[new:]])
+
+        self._pnl = pd.concat([self._pnl, pnl.iloc[new:]])
+        self._components_pnl = pd.concat(
+            [self._components_pnl, components_pnl.iloc[new:]])
+
+        if individual_leverage_df is not None:
+            self._individual_leverage = pd.concat(
+                [self._individual_leverage, individual_leverage_df.iloc[new:]])
+
+        self._pnl_trades = None
+        self._components_pnl_trades = None
+        self._pnl_trades_detail = None
+        self._components_pnl_trades_detail = None
+
+        self._trade_no = None
+        self._portfolio_trade_no = None
+
+        self._pnl_ret_stats = RetStats(self._pnl, br.ann_factor,
+                                       br.resample_ann_factor)
+        self._components_pnl_ret_stats = RetStats(self._components_pnl,
+                                                  br.ann_factor,
+                                                  br.resample_ann_factor)
+        self._portfolio_ret_stats = RetStats(self._portfolio, br.ann_factor,
+                                             br.resample_ann_factor)
+
+        # Fill down the contract sizes from the last one
+        contract_value_all_df = self._contract_value_df
+
+        if contract_value_all_df is not None:
+            contract_value_new_df = contract_value_df
+
+            if contract_value_new_df is None:
+                contract_value_new_df = contract_value_all_df.iloc[0:0]
+
+            contract_value_new_df = pd.concat(
+                [contract_value_all_df.iloc[-1:],
+                 asset_a_df.align(contract_value_new_df, join='left',
+                                  axis='index')[1]]).ffill().iloc[1:]
+
+            contract_value_all_df = pd.concat(
+                [contract_value_all_df, contract_value_new_df])
+
+        self._contract_value_df = contract_value_all_df
+
+        # Notionals and contracts are recalculated on demand
+        self._portfolio_signal_notional = None
+        self._portfolio_signal_trade_notional = None
+        self._portfolio_signal_trade_notional_sizes = None
+        self._portfolio_signal_contracts = None
+        self._portfolio_signal_trade_contracts = None
+
+        self._portfolio_total_longs_notional = None
+        self._portfolio_total_shorts_notional = None
+        self._portfolio_net_exposure_notional = None
+        self._portfolio_total_exposure_notional = None
+
+        # Carry on the cumulative indices from their last levels (if they
+        # haven't been calculated yet, they'll be calculated on demand)
+        cum_list = []
+
+        for i, (cum_df, df_all, df) in enumerate(
+                [(self._pnl_cum, self._pnl, pnl),
+                 (self._components_pnl_cum, self._components_pnl,
+                  components_pnl),
+                 (self._portfolio_cum, self._portfolio, portfolio)]):
+
+            if cum_df is not None:
+                if state['cum_state'][i] is None:
+                    state['cum_state'][i] = self._cum_index_level(
+                        df_all.iloc[:n0], br.cum_index)
+
+                cum_new_df, state['cum_state'][i] = self._extend_cum_index(
+                    df.iloc[new:], state['cum_state'][i], br.cum_index)
+
+                # If an index hadn't started, create_mult_index/create_add_index
+                # may have added an extra row at the end
+                cum_new_df.columns = cum_df.columns
+                cum_df = pd.concat([cum_df.iloc[:n0], cum_new_df])
+
+            cum_list.append(cum_df)
+
+        self._pnl_cum, self._components_pnl_cum, self._portfolio_cum = \
+            cum_list
+
+        logger.info("Completed updating trading P&L")
+
+        state['asset_a_df'] = pd.concat([state['asset_a_df'], asset_a_df])
+        state['signal_df'] = pd.concat([state['signal_df'], signal_df])
+        state['signal_joined_last'] = signal_joined_last
+        state['signal_pre_stop'] = signal_pre_stop
+        state['asset_last'] = asset_new_df.iloc[-1:]
+        state['signal'] = signal_all_df
+        state['returns_df'] = returns_all_df
+
+        if state['contract_value_a_df'] is not None \
+                and contract_value_df is not None:
+            state['contract_value_a_df'] = pd.concat(
+                [state['contract_value_a_df'], contract_value_df])
+
+    def _is_incremental_update(self, br: BacktestRequest) -> bool:
+        """Can the backtest be extended without recalculating the whole
+        history?
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest
+
+        Returns
+        -------
+        bool
+        """
+        if br.portfolio_weight_construction is not None:
+            return False
+
+        if br.plot_start is not None or br.plot_finish is not None:
+            return False
+
+        if isinstance(br.spot_tc_bp, pd.DataFrame) \
+                or isinstance(br.spot_rc_bp, pd.DataFrame):
+            return False
+
+        if (br.signal_vol_adjust and br.signal_vol_resample_freq is not None) \
+                or (br.portfolio_vol_adjust and
+                    br.portfolio_vol_resample_freq is not None):
+            return False
+
+        for level in [br.stop_loss, br.take_profit, br.trailing_stop]:
+            if isinstance(level, pd.DataFrame):
+                return False
+
+        return True
+
+    def _update_window_start(
+            self,
+            br: BacktestRequest,
+            index: pd.DatetimeIndex,
+            pos: int) -> int:
+        """Finds the first row from which the signal and portfolio weights
+        need to be recalculated, so that the rows from pos onwards are
+        the same as recalculating the whole history. Works backwards
+        through each stage (position limits, portfolio vol target and signal
+        vol target), each of which need their own rebalancing period and
+        window of volatility.
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest
+
+        index : pd.DatetimeIndex
+            Dates already in the backtest
+
+        pos : int
+            Row of the first new point
+
+        Returns
+        -------
+        int (or None if the window cannot be found)
+        """
+
+        # Need the previous positions for trades/transaction costs, and the
+        # portfolio weights depend on the P&L (hence previous signal)
+        pos = pos - 2
+
+        if br.max_net_exposure is not None or br.max_abs_exposure is not None:
+            pos = self._rebalance_window_start(
+                index, pos, br.position_clip_rebalance_freq,
+                br.position_clip_resample_type)
+
+            if pos is None: return None
+
+            pos = pos - br.position_clip_period_shift - 1
+
+        if br.portfolio_vol_adjust:
+            pos = self._rebalance_window_start(
+                index, pos, br.portfolio_vol_rebalance_freq,
+                br.portfolio_vol_resample_type)
+
+            if pos is None: return None
+
+            pos = pos - br.portfolio_vol_period_shift \
+                  - br.portfolio_vol_periods - 1
+
+        if br.signal_vol_adjust:
+            pos = self._rebalance_window_start(
+                index, pos, br.signal_vol_rebalance_freq,
+                br.signal_vol_resample_type)
+
+            if pos is None: return None
+
+            pos = pos - br.signal_vol_period_shift - br.signal_vol_periods - 1
+
+        return max(pos, 0)
+
+    def _rebalance_window_start(
+            self,
+            index: pd.DatetimeIndex,
+            pos: int,
+            rebalance_freq: str,
+            resample_type: str) -> int:
+        """Finds the first row of the rebalancing period, whose resampled
+        value is used at row pos (goes back two periods, so that it is
+        always covered)
+
+        Parameters
+        ----------
+        index : pd.DatetimeIndex
+            Dates already in the backtest
+
+        pos : int
+            Row where the rebalanced value is needed
+
+        rebalance_freq : str
+            How often we rebalance (eg. 'BM')
+
+        resample_type : str
+            How the values are resampled
+
+        Returns
+        -------
+        int (or None if the start cannot be found)
+        """
+        if rebalance_freq is None or resample_type is None:
+            return pos
+
+        if pos <= 0:
+            return 0
+
+        offset = pd.tseries.frequencies.to_offset(rebalance_freq)
+
+        # Intraday bins are only the same for any start point if they split
+        # up a day exactly
+        if isinstance(offset, pd.tseries.offsets.Tick) \
+                and (24 * 60 * 60 * 10 ** 9) % offset.nanos != 0:
+            return None
+
+        return index.searchsorted(index[pos] - offset * 2)
+
+    def _stop_window_start(self, signal_values: np.ndarray, pos: int) -> int:
+        """Finds the first row from which stop losses/take profits need to be
+        recalculated, for the rows from pos onwards to be the same as
+        recalculating the whole history. This is just before the second
+        to last change in every signal (ie. the start of the trade which
+        was open before the current one).
+
+        Parameters
+        ----------
+        signal_values : np.ndarray
+            Signals (before any stop losses/take profits)
+
+        pos : int
+            Row of the first new point
+
+        Returns
+        -------
+        int
+        """
+        chunk = 256
+
+        while True:
+            start = max(pos - chunk, 0)
+
+            changes = np.abs(np.diff(signal_values[start:pos], axis=0)) > 0
+
+            if (changes.sum(axis=0) >= 2).all():
+                change_start = [np.nonzero(changes[:, i])[0][-2]
+                                for i in range(changes.shape[1])]
+
+                return start + min(change_start)
+
+            if start == 0:
+                return 0
+
+            chunk = chunk * 4
+
+    def _cum_index_level(self, returns_df: pd.DataFrame,
+                         cum_index: str) -> np.ndarray:
+        """Gets the last level of a cumulative index (before it is scaled),
+        which can be used to extend it later with _extend_cum_index
+
+        Parameters
+        ----------
+        returns_df : pd.DataFrame
+            Returns of the index
+
+        cum_index : str
+            'mult' or 'add'
+
+        Returns
+        -------
+        np.ndarray
+        """
+        if cum_index == 'mult':
+            level_df = (1.0 + returns_df).cumprod()
+        elif cum_index == 'add':
+            level_df = returns_df.cumsum()
+
+        return level_df.ffill().values[-1]
+
+    def _extend_cum_index(self, returns_df: pd.DataFrame, level: np.ndarray,
+                          cum_index: str) -> (pd.DataFrame, np.ndarray):
+        """Extends a cumulative index (eg. from create_mult_index) from its
+        last level with new returns, giving the same output as recreating
+        the index over the whole history
+
+        Parameters
+        ----------
+        returns_df : pd.DataFrame
+            New returns
+
+        level : np.ndarray
+            Last level of the index (NaN where the index hasn't started)
+
+        cum_index : str
+            'mult' or 'add'
+
+        Returns
+        -------
+        pd.DataFrame (new part of index), np.ndarray (new last level)
+        """
+        started = ~np.isnan(level)
+
+        if cum_index == 'mult':
+            values = 1.0 + returns_df.values
+            fill, scale, first = 1.0, 100.0, 100.0
+        elif cum_index == 'add':
+            values = returns_df.values
+            fill, scale, first = 0.0, 1.0, 1.0
+
+        ind = np.isnan(values)
+
+        level_start = np.where(started, level, fill)[np.newaxis, :]
+        values = np.concatenate([level_start, np.where(ind, fill, values)])
+
+        if cum_index == 'mult':
+            level_values = np.cumprod(values, axis=0)[1:]
+        else:
+            level_values = np.cumsum(values, axis=0)[1:]
+
+        level_values[ind] = np.nan
+
+        # Same as ffill, without changing the last level if there are no
+        # new points
+        has_values = (~ind).any(axis=0)
+
+        if len(level_values) > 0:
+            last = pd.DataFrame(level_values).ffill().values[-1]
+            level = np.where(has_values, last, level)
+
+        if cum_index == 'mult':
+            cum_values = scale * level_values
+        else:
+            cum_values = scale + level_values
+
+        # The first point of any new index starts from 100 (or 1)
+        for i in np.nonzero(~started & has_values)[0]:
+            cum_values[np.nonzero(~ind[:, i])[0][0], i] = first
+
+        return pd.DataFrame(cum_values, index=returns_df.index,
+                            columns=returns_df.columns), level
+
+    def _calculate_portfolio(
+            self,
+            br: BacktestRequest,
+            signal_df: pd.DataFrame,
+            returns_df: pd.DataFrame,
+            pnl_cols: List[str]) -> List[pd.DataFrame]:
+        """Calculates the weights of each signal and the portfolio (applying
+        any vol targeting and position limits), and the resulting returns
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest specifying transaction costs, vol
+            targets etc.
+
+        signal_df : pd.DataFrame
+            Signals aligned with the asset returns
+
+        returns_df : pd.DataFrame
+            Returns of the assets to be traded
+
+        pnl_cols : str (list)
+            Column names for the P&L of each asset/signal
+
+        Returns
+        -------
+        pd.DataFrame (list)
+        """
+        risk_engine = RiskEngine()
+
+        # Transaction costs and roll costs
+        tc = br.spot_tc_bp
+        rc = br.spot_rc_bp
+
+        if br.portfolio_weight_construction is None:
+            pwc = PortfolioWeightConstruction(br=br)
+        else:
+            pwc = br.portfolio_weight_construction
+
+        # Adjust signal weights and portfolio weights (eg. using various rules, like vol targeting)
+        # and also aggregate final portfolio weights
+        portfolio_signal_before_weighting, portfolio_signal, portfolio_leverage_df, portfolio, individual_leverage_df, pnl = \
+            pwc.optimize_portfolio_weights(returns_df, signal_df, pnl_cols)
+
+        portfolio_total_longs, portfolio_total_shorts, portfolio_net_exposure, portfolio_total_exposure \
+            = self.calculate_exposures(portfolio_signal)
+
+        # Apply position limits?
+        position_clip_adjustment = risk_engine.calculate_position_clip_adjustment \
+            (portfolio_net_exposure, portfolio_total_exposure, br)
+
+        # If we have any position clip adjustment, for example related to max position sizes
+        if position_clip_adjustment is not None:
+            # Broadcast across the columns
+            position_clip_adjustment_matrix = \
+                position_clip_adjustment.values.reshape(-1, 1)
+
+            # Recalculate portfolio signals after adjustment (for individual components - without
+            # weighting each signal separately)
+            portfolio_signal_before_weighting = pd.DataFrame(
+                data=(
+                        portfolio_signal_before_weighting.values * position_clip_adjustment_matrix),
+                index=portfolio_signal_before_weighting.index,
+                columns=portfolio_signal_before_weighting.columns)
+
+            # Recalculate portfolio signal after adjustment (for portfolio
+            # level positions)
+            portfolio_signal = pd.DataFrame(
+                data=(
+                        portfolio_signal.values * position_clip_adjustment_matrix),
+                index=portfolio_signal.index,
+                columns=portfolio_signal.columns)
+
+            # Recalculate portfolio leverage with position constraint
+            # (multiply vectors elementwise)
+            portfolio_leverage_df = pd.DataFrame(
+                data=(
+                        portfolio_leverage_df.values * position_clip_adjustment.values),
+                index=portfolio_leverage_df.index,
+                columns=portfolio_leverage_df.columns)
+
+            # Recalculate total long, short, net and absolute exposures of the
+            # whole portfolio after the position
+            # clip adjustment
+            portfolio_total_longs, portfolio_total_shorts, portfolio_net_exposure, portfolio_total_exposure \
+                = self.calculate_exposures(portfolio_signal)
+
+        # Calculate final portfolio returns with the amended portfolio leverage (by default just 1s)
+        portfolio = pd.DataFrame(
+            _calculate_signal_returns_with_tc(portfolio_leverage_df.values,
+                                              portfolio, tc, rc),
+            index=portfolio.index)
+
+        # P&L components of individual assets after all the portfolio level
+        # risk signals and position limits have been applied
+        components_pnl = pd.DataFrame(
+            _calculate_signal_returns_with_tc(
+                portfolio_signal_before_weighting.values, returns_df, tc, rc),
+            index=returns_df.index, columns=pnl_cols)
+
+        return portfolio_signal, portfolio_leverage_df, portfolio, \
+               individual_leverage_df, pnl, components_pnl, \
+               portfolio_total_longs, portfolio_total_shorts, \
+               portfolio_net_exposure, portfolio_total_exposure
+
+    def _align_signal_with_asset(
+            self,
+            br: BacktestRequest,
+            asset_a_df: pd.DataFrame,
+            signal_df: pd.DataFrame,
+            update_state: dict = None) -> (
+            pd.DataFrame, pd.DataFrame, pd.DataFrame):
+        """Aligns the signals with the asset prices to be traded, delaying the
+        signal, filling down the signals over asset holidays and applying any
+        stop loss/take profit to the signals
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest specifying signal delay, stop loss etc.
+
+        asset_a_df : pd.DataFrame
+            Asset prices to be traded
+
+        signal_df : pd.DataFrame
+            Signals for the trading strategy
+
+        update_state : dict
+            If specified, is populated with the intermediate signals needed
+            to extend the backtest later with update_trading_PnL
+
+        Returns
+        -------
+        pd.DataFrame (asset prices), pd.DataFrame (signals),
+        pd.DataFrame (asset returns)
+        """
+        calculations = Calculations()
+
+        signal_df = signal_df.shift(br.signal_delay)
+        asset_df, signal_df = calculations.join_left_fill_right(asset_a_df,
+                                                                signal_df)
+
+        # Non-trading days of the assets (this may of course vary between the
+        # assets we are trading
+        # if they are from different asset classes)
+        non_trading_days = np.isnan(asset_df.values)
+
+        if update_state is not None:
+            update_state['signal_joined_last'] = signal_df.iloc[-1:]
+
+        # Only allow signals to change on the days when we can trade assets
+        signal_df = signal_df.mask(
+            non_trading_days)  # fill asset holidays with NaN signals
+        signal_df = signal_df.ffill()  # fill these down
+
+        # Fill down asset holidays (we won't trade on these days)
+        asset_df = asset_df.ffill()
+        returns_df = calculations.calculate_returns(asset_df)
+
+        if update_state is not None:
+            update_state['signal_pre_stop'] = signal_df
+            update_state['asset_last'] = asset_df.iloc[-1:]
+
+        # Apply a stop loss/take profit to every trade if this has been specified
+        # do this before we start to do vol weighting etc.
+        if self._has_stops(br):
+            signal_df = self._apply_stop_loss_take_profit(
+                br, returns_df, signal_df, non_trading_days)
+
+        return asset_df, signal_df, returns_df
+
+    def _apply_stop_loss_take_profit(
+            self,
+            br: BacktestRequest,
+            returns_df: pd.DataFrame,
+            signal_df: pd.DataFrame,
+            non_trading_days: np.ndarray) -> pd.DataFrame:
+        """Applies a stop loss/take profit/trailing stop to every trade,
+        closing the position until the next change in the signal. The
+        cumulative returns of each trade are calculated and the stops applied
+        in a single pass with Numba.
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest specifying stop loss and take profit
+
+        returns_df : pd.DataFrame
+            Returns of the assets to be traded
+
+        signal_df : pd.DataFrame
+            Signals aligned with the asset returns
+
+        non_trading_days : np.ndarray
+            Points where the assets are not trading
+
+        Returns
+        -------
+        pd.DataFrame
+        """
+
+        # Makes assumption that signal column order matches that of returns
+        # (work asset by asset, ie. along the last axis for Numba)
+        signal_arr = np.ascontiguousarray(
+            signal_df.values.astype(np.float64).T)
+        returns_arr = np.ascontiguousarray(
+            returns_df.values.astype(np.float64).T)
+
+        stop_loss_arr = self._stop_level(br.stop_loss, returns_df, -np.inf)
+        take_profit_arr = self._stop_level(br.take_profit, returns_df, np.inf)
+        trailing_stop_arr = self._stop_level(br.trailing_stop, returns_df,
+                                             -np.inf)
+
+        signal_arr = _stop_loss_take_profit_numba(
+            signal_arr, returns_arr,
+            np.ascontiguousarray(non_trading_days.T), stop_loss_arr,
+            take_profit_arr, trailing_stop_arr)
+
+        return pd.DataFrame(signal_arr.T, index=signal_df.index,
+                            columns=signal_df.columns)
+
+    def _stop_level(self, level, returns_df: pd.DataFrame,
+                    default: float) -> np.ndarray:
+        """Converts a stop loss/take profit level, which can either be a
+        single value, a value for each asset (list, dict or Series) or a
+        DataFrame of values over time, into an array of asset x time
+
+        Parameters
+        ----------
+        level : float, list, dict, pd.Series or pd.DataFrame
+            Stop level(s)
+
+        returns_df : pd.DataFrame
+            Returns of the assets to be traded
+
+        default : float
+            Level to use when there is no stop (or for missing values)
+
+        Returns
+        -------
+        np.ndarray
+        """
+        shape = (len(returns_df.columns), len(returns_df.index))
+
+        if level is None:
+            return np.full(shape, default)
+
+        if isinstance(level, pd.DataFrame):
+            level = level.reindex(returns_df.index)
+
+            if all(c in level.columns for c in returns_df.columns):
+                level = level[returns_df.columns]
+
+            level = level.values.T
+
+        elif isinstance(level, dict):
+            level = pd.Series(level)
+
+        if isinstance(level, pd.Series):
+            level = level.reindex(returns_df.columns).values
+
+        level = np.array(level, dtype=np.float64)
+
+        if level.ndim == 1:
+            level = level[:, np.newaxis]
+
+        level = np.array(np.broadcast_to(level, shape))
+        level[np.isnan(level)] = default
+
+        return level
+
+    def _has_stops(self, br: BacktestRequest) -> bool:
+        """Have any stop losses/take profits/trailing stops been specified
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest
 
-        else:
-            # Calculate return statistics of the each asset/signal after signal
-            # leverage (but before portfolio level constraints)
-            # self._ret_stats_pnl.calculate_ret_stats()
+        Returns
+        -------
+        bool
+        """
+        return br.stop_loss is not None or br.take_profit is not None \
+               or br.trailing_stop is not None
 
-            # Calculate return statistics of the each asset/signal after signal
-            # leverage AND after portfolio level constraints
-            # self._ret_stats_pnl_components.calculate_ret_stats()
+    def _create_cum_index(self, returns_df: pd.DataFrame) -> pd.DataFrame:
+        """Creates a cumulative index from returns (either multiplicative or
+        additive, depending on the BacktestRequest)
 
-            # Calculate return statistics of the final portfolio
-            # self._ret_stats_portfolio.calculate_ret_stats()
+        Parameters
+        ----------
+        returns_df : pd.DataFrame
+            Returns to be indexed
 
-            # Calculate final portfolio cumulative P&L
-            if br.cum_index == 'mult':
-                # Calculate individual signals cumulative P&L after signal
-                # leverage but before portfolio level constraints
-                self._pnl_cum = calculations.create_mult_index(self._pnl)
+        Returns
+        -------
+        pd.DataFrame
+        """
+        calculations = Calculations()
 
-                # Calculate individual signals cumulative P&L after signal
-                # leverage AND after portfolio level constraints
-                self._components_pnl_cum = calculations.create_mult_index(
-                    self._components_pnl)
+        if self._cum_index == 'mult':
+            cum_df = calculations.create_mult_index(returns_df)
+        elif self._cum_index == 'add':
+            cum_df = calculations.create_add_index(returns_df)
 
-                self._portfolio_cum = calculations.create_mult_index(
-                    self._portfolio)  # portfolio cumulative P&L
+        cum_df.columns = returns_df.columns
 
-            elif br.cum_index == 'add':
-                # Calculate individual signals cumulative P&L after signal leverage but before portfolio level constraints
-                self._pnl_cum = calculations.create_add_index(self._pnl)
+        return cum_df
+
+    def _split_columns(self, df: pd.DataFrame, chunks: int) -> List[
+        pd.DataFrame]:
+        """Splits a DataFrame into (up to) a number of blocks of columns
 
-                # Calculate individual signals cumulative P&L after signal leverage AND after portfolio level constraints
-                self._components_pnl_cum = calculations.create_add_index(
-                    self._components_pnl)
+        Parameters
+        ----------
+        df : pd.DataFrame
+            DataFrame to be split
 
-                self._portfolio_cum = calculations.create_add_index(
-                    self._portfolio)  # portfolio cumulative P&L
+        chunks : int
+            Number of blocks
 
-        logger.info("Completed cumulative index calculations")
+        Returns
+        -------
+        pd.DataFrame (list)
+        """
+        col_ind = np.array_split(np.arange(len(df.columns)),
+                                 min(chunks, len(df.columns)))
 
-        self._pnl_cum.columns = pnl_cols
-        self._components_pnl_cum.columns = pnl_cols
-        self._portfolio_cum.columns = ['Port']
+        return [df.iloc[:, ind] for ind in col_ind]
 
     def _filter_by_plot_start_finish_date(
             self,
@@ -546,23 +1387,28 @@ class Backtest(object):
 
         """
 
-        # Calculate total portfolio longs/total portfolio shorts/total portfolio exposure
+        # Calculate total portfolio longs/total portfolio shorts/total portfolio exposure (summing each row
+        # of the underlying array, in the same order as pandas)
+        signal = np.ascontiguousarray(portfolio_signal.values)
+
+        total_longs = np.where(signal > 0, signal, 0.0).sum(axis=1)
+        total_shorts = np.where(signal < 0, signal, 0.0).sum(axis=1)
+
         portfolio_total_longs = pd.DataFrame(
-            portfolio_signal[portfolio_signal > 0].sum(axis=1))
+            index=portfolio_signal.index, columns=['Total Longs'],
+            data=total_longs)
         portfolio_total_shorts = pd.DataFrame(
-            portfolio_signal[portfolio_signal < 0].sum(axis=1))
-
-        portfolio_total_longs.columns = ['Total Longs']
-        portfolio_total_shorts.columns = ['Total Shorts']
+            index=portfolio_signal.index, columns=['Total Shorts'],
+            data=total_shorts)
 
         # NOTE: careful usage of signs (portfolio_total_shorts are NEGATIVE)
         portfolio_net_exposure = pd.DataFrame(
             index=portfolio_signal.index, columns=['Net Exposure'],
-            data=portfolio_total_longs.values + portfolio_total_shorts.values)
+            data=total_longs + total_shorts)
 
         portfolio_total_exposure = pd.DataFrame(
             index=portfolio_signal.index, columns=['Total Exposure'],
-            data=portfolio_total_longs.values - portfolio_total_shorts.values)
+            data=total_longs - total_shorts)
 
         return portfolio_total_longs, portfolio_total_shorts, portfolio_net_exposure, portfolio_total_exposure
 
@@ -602,12 +1448,26 @@ class Backtest(object):
         """
 
         if self._pnl_trades is None:
-            calculations = Calculations()
-            self._pnl_trades = calculations.calculate_individual_trade_gains(
-                self._signal, self._pnl)
+            self._pnl_trades = TradeAttribution().calculate_trade_gains(
+                self._signal, self._pnl, cum_index=self._cum_index)
 
         return self._pnl_trades
 
+    def pnl_trades_detail(self) -> pd.DataFrame:
+        """Gets every individual trade per signal, with its entry/exit dates,
+        holding period, P&L and maximum adverse/favourable excursions
+
+        Returns
+        -------
+        pd.Dataframe
+        """
+
+        if self._pnl_trades_detail is None:
+            self._pnl_trades_detail = TradeAttribution().calculate_trades(
+                self._signal, self._pnl, cum_index=self._cum_index)
+
+        return self._pnl_trades_detail
+
     def pnl_desc(self) -> pd.DataFrame:
         """Gets P&L return statistics in a string format
 
@@ -635,6 +1495,9 @@ class Backtest(object):
         pd.DataFrame
         """
 
+        if self._pnl_cum is None:
+            self._pnl_cum = self._create_cum_index(self._pnl)
+
         return self._pnl_cum
 
     ### Get PnL of individual assets AFTER portfolio constraints
@@ -656,13 +1519,29 @@ class Backtest(object):
         """
 
         if self._components_pnl_trades is None:
-            calculations = Calculations()
-            self._components_pnl_trades = calculations.calculate_individual_trade_gains(
-                self._signal,
-                self._components_pnl)
+            self._components_pnl_trades = TradeAttribution().calculate_trade_gains(
+                self._signal, self._components_pnl,
+                cum_index=self._cum_index)
 
         return self._components_pnl_trades
 
+    def components_pnl_trades_detail(self) -> pd.DataFrame:
+        """Gets every individual trade per signal (after portfolio level
+        leverage is applied), with its entry/exit dates, holding period, P&L
+        and maximum adverse/favourable excursions
+
+        Returns
+        -------
+        pd.Dataframe
+        """
+
+        if self._components_pnl_trades_detail is None:
+            self._components_pnl_trades_detail = TradeAttribution().calculate_trades(
+                self._signal, self._components_pnl,
+                cum_index=self._cum_index)
+
+        return self._components_pnl_trades_detail
+
     def components_pnl_desc(self) -> pd.DataFrame:
         """Gets P&L of individual components as return statistics in a string format
 
@@ -690,6 +1569,10 @@ class Backtest(object):
         pd.DataFrame
         """
 
+        if self._components_pnl_cum is None:
+            self._components_pnl_cum = self._create_cum_index(
+                self._components_pnl)
+
         return self._components_pnl_cum
 
     ### Get PnL of the final portfolio
@@ -702,6 +1585,9 @@ class Backtest(object):
         pd.DataFrame
         """
 
+        if self._portfolio_cum is None:
+            self._portfolio_cum = self._create_cum_index(self._portfolio)
+
         return self._portfolio_cum
 
     def portfolio_pnl(self) -> pd.DataFrame:
@@ -828,6 +1714,11 @@ class Backtest(object):
         DataFrame
         """
 
+        if self._portfolio_total_longs_notional is None \
+                and self._portfolio_notional_size is not None:
+            self._portfolio_total_longs_notional = \
+                self._portfolio_total_longs * self._portfolio_notional_size
+
         return self._portfolio_total_longs_notional
 
     def portfolio_total_shorts_notional(self) -> pd.DataFrame:
@@ -838,6 +1729,11 @@ class Backtest(object):
         DataFrame
         """
 
+        if self._portfolio_total_shorts_notional is None \
+                and self._portfolio_notional_size is not None:
+            self._portfolio_total_shorts_notional = \
+                self._portfolio_total_shorts * self._portfolio_notional_size
+
         return self._portfolio_total_shorts_notional
 
     def portfolio_net_exposure_notional(self) -> pd.DataFrame:
@@ -848,6 +1744,11 @@ class Backtest(object):
         DataFrame
         """
 
+        if self._portfolio_net_exposure_notional is None \
+                and self._portfolio_notional_size is not None:
+            self._portfolio_net_exposure_notional = \
+                self._portfolio_net_exposure * self._portfolio_notional_size
+
         return self._portfolio_net_exposure_notional
 
     def portfolio_total_exposure_notional(self) -> pd.DataFrame:
@@ -858,6 +1759,11 @@ class Backtest(object):
         DataFrame
         """
 
+        if self._portfolio_total_exposure_notional is None \
+                and self._portfolio_notional_size is not None:
+            self._portfolio_total_exposure_notional = \
+                self._portfolio_total_exposure * self._portfolio_notional_size
+
         return self._portfolio_total_exposure_notional
 
     def portfolio_trade(self) -> pd.DataFrame:
@@ -869,6 +1775,10 @@ class Backtest(object):
         DataFrame
         """
 
+        if self._portfolio_trade is None:
+            self._portfolio_trade = self._portfolio_signal \
+                                    - self._portfolio_signal.shift(1)
+
         return self._portfolio_trade
 
     def portfolio_signal_notional(self) -> pd.DataFrame:
@@ -880,6 +1790,12 @@ class Backtest(object):
         DataFrame
         """
 
+        if self._portfolio_signal_notional is None \
+                and self._portfolio_notional_size is not None:
+            # Express positions in terms of the notional size specified
+            self._portfolio_signal_notional = \
+                self._portfolio_signal * self._portfolio_notional_size
+
         return self._portfolio_signal_notional
 
     def portfolio_trade_notional(self) -> pd.DataFrame:
@@ -891,6 +1807,13 @@ class Backtest(object):
         DataFrame
         """
 
+        if self._portfolio_signal_trade_notional is None \
+                and self._portfolio_notional_size is not None:
+            portfolio_signal_notional = self.portfolio_signal_notional()
+
+            self._portfolio_signal_trade_notional = portfolio_signal_notional \
+                - portfolio_signal_notional.shift(1)
+
         return self._portfolio_signal_trade_notional
 
     def portfolio_trade_notional_sizes(self) -> pd.DataFrame:
@@ -902,6 +1825,21 @@ class Backtest(object):
         DataFrame
         """
 
+        if self._portfolio_signal_trade_notional_sizes is None \
+                and self._portfolio_notional_size is not None:
+            df_trades_sizes = pd.DataFrame()
+
+            rounded_portfolio_signal_trade_notional = \
+                self.portfolio_trade_notional().round(2)
+
+            for k in rounded_portfolio_signal_trade_notional.columns:
+                df_trades_sizes[k] = pd.value_counts(
+                    rounded_portfolio_signal_trade_notional[k], sort=True)
+
+            df_trades_sizes = df_trades_sizes[df_trades_sizes.index != 0]
+
+            self._portfolio_signal_trade_notional_sizes = df_trades_sizes
+
         return self._portfolio_signal_trade_notional_sizes
 
     def portfolio_signal_contracts(self) -> pd.DataFrame:
@@ -914,6 +1852,29 @@ class Backtest(object):
         DataFrame
         """
 
+        # Can only give contract sizes if these are defined
+        if self._portfolio_signal_contracts is None \
+                and self._portfolio_notional_size is not None \
+                and self._contract_value_df is not None:
+
+            # Get the positions in terms of the contract sizes
+            notional_copy = self.portfolio_signal_notional().copy(deep=True)
+            notional_copy_cols = [x.split('.')[0] for x in
+                                  notional_copy.columns]
+            notional_copy_cols = [x + '.contract-value' for x in
+                                  notional_copy_cols]
+
+            notional_copy.columns = notional_copy_cols
+
+            contract_value_df = self._contract_value_df[notional_copy_cols]
+            notional_df, contract_value_df = notional_copy.align(
+                contract_value_df, join='left', axis='index')
+
+            # Careful make sure orders of magnitude are same for the notional and the contract value
+            self._portfolio_signal_contracts = notional_df / contract_value_df
+            self._portfolio_signal_contracts.columns = \
+                self._portfolio_signal.columns
+
         return self._portfolio_signal_contracts
 
     def portfolio_trade_contracts(self) -> pd.DataFrame:
@@ -926,6 +1887,14 @@ class Backtest(object):
         DataFrame
         """
 
+        if self._portfolio_signal_trade_contracts is None:
+            portfolio_signal_contracts = self.portfolio_signal_contracts()
+
+            if portfolio_signal_contracts is not None:
+                self._portfolio_signal_trade_contracts = \
+                    portfolio_signal_contracts \
+                    - portfolio_signal_contracts.shift(1)
+
         return self._portfolio_signal_trade_contracts
 
     def signal(self) -> pd.DataFrame:
@@ -1148,59 +2117,77 @@ class TradingModel(object):
 
             mult_results = []
 
-            # start = asset_df.index[0]
-            # finish = asset_df.index[-1]
-
-            # calculate sub substrategies in sub-processes
-            # TODO cut up in time chunks
-            for key in bask_keys:
-
-                if key != self.FINAL_STRATEGY:
-                    logger.info("Calculating (parallel) " + key)
-
-                    asset_cut_df = asset_df[
-                        [x + "." + br.trading_field for x in basket_dict[key]]]
-                    spot_cut_df = spot_df[
-                        [x + "." + br.trading_field for x in basket_dict[key]]]
-
-                    mult_results.append(
-                        pool.apply_async(self.construct_individual_strategy,
-                                         args=(br, spot_cut_df, spot_df2,
-                                               asset_cut_df,
-                                               tech_params, key,
-                                               contract_value_df,
-                                               False, True,))
-                    )
+            # With multiprocessing, publish the market data once to memory
+            # mapped files, rather than pickling it for every basket
+            use_shared_memory = market_constants.backtest_shared_memory and \
+                market_constants.backtest_thread_technique == "multiprocessing"
 
-                    # Calculate final strategy separately in my main process (so don't have issues with pickling back large output)
+            shared_list = []
 
-            logger.info("Calculating final strategy " + self.FINAL_STRATEGY)
-
-            # Calculate the final strategy separately (can often be a lot larger)
-            asset_cut_df = asset_df[[x + "." + br.trading_field for x in
-                                     basket_dict[self.FINAL_STRATEGY]]]
-            spot_cut_df = spot_df[[x + "." + br.trading_field for x in
-                                   basket_dict[self.FINAL_STRATEGY]]]
-
-            desc, results, leverage, stats, key, backtest = \
-                self.construct_individual_strategy(br, spot_cut_df, spot_df2,
+            try:
+                if use_shared_memory:
+                    # One at a time, so any already published are still
+                    # closed if a later one fails
+                    for df in [spot_df, spot_df2, asset_df, contract_value_df]:
+                        shared_list.append(SharedDataFrame(df))
+
+                # start = asset_df.index[0]
+                # finish = asset_df.index[-1]
+
+                # calculate sub substrategies in sub-processes
+                # TODO cut up in time chunks
+                for key in bask_keys:
+
+                    if key != self.FINAL_STRATEGY:
+                        logger.info("Calculating (parallel) " + key)
+
+                        cols = [x + "." + br.trading_field for x in basket_dict[key]]
+
+                        if use_shared_memory:
+                            # Each task only carries the column positions
+                            mult_results.append(
+                                pool.apply_async(
+                                    self._construct_individual_strategy_shared,
+                                    args=(br, shared_list[0],
+                                          [spot_df.columns.get_loc(x)
+                                           for x in cols],
+                                          shared_list[1], shared_list[2],
+                                          [asset_df.columns.get_loc(x)
+                                           for x in cols],
+                                          tech_params, key, shared_list[3],))
+                            )
+
+                            continue
+
+                        asset_cut_df = asset_df[cols]
+                        spot_cut_df = spot_df[cols]
+
+                        mult_results.append(
+                            pool.apply_async(self.construct_individual_strategy,
+                                             args=(br, spot_cut_df, spot_df2,
                                                    asset_cut_df,
-                                                   tech_params,
-                                                   self.FINAL_STRATEGY,
-                                                   contract_value_df, True,
-                                                   False)
-
-            results.columns = desc
+                                                   tech_params, key,
+                                                   contract_value_df,
+                                                   False, True,))
+                        )
 
-            cum_results[results.columns[0]] = results
-            port_leverage[results.columns[0]] = leverage
-            ret_stats_results[key] = stats
+                        # Calculate final strategy separately in my main process (so don't have issues with pickling back large output)
 
-            self._assign_final_strategy_results(results, backtest)
+                logger.info("Calculating final strategy " + self.FINAL_STRATEGY)
 
-            for p in mult_results:
+                # Calculate the final strategy separately (can often be a lot larger)
+                asset_cut_df = asset_df[[x + "." + br.trading_field for x in
+                                         basket_dict[self.FINAL_STRATEGY]]]
+                spot_cut_df = spot_df[[x + "." + br.trading_field for x in
+                                       basket_dict[self.FINAL_STRATEGY]]]
 
-                desc, results, leverage, stats, key, backtest = p.get()
+                desc, results, leverage, stats, key, backtest = \
+                    self.construct_individual_strategy(br, spot_cut_df, spot_df2,
+                                                       asset_cut_df,
+                                                       tech_params,
+                                                       self.FINAL_STRATEGY,
+                                                       contract_value_df, True,
+                                                       False)
 
                 results.columns = desc
 
@@ -1208,13 +2195,29 @@ class TradingModel(object):
                 port_leverage[results.columns[0]] = leverage
                 ret_stats_results[key] = stats
 
-                if key == self.FINAL_STRATEGY:
-                    self._assign_final_strategy_results(results, backtest)
+                self._assign_final_strategy_results(results, backtest)
 
-            try:
-                swim_pool.close_pool(pool)
-            except:
-                pass
+                for p in mult_results:
+
+                    desc, results, leverage, stats, key, backtest = p.get()
+
+                    results.columns = desc
+
+                    cum_results[results.columns[0]] = results
+                    port_leverage[results.columns[0]] = leverage
+                    ret_stats_results[key] = stats
+
+                    if key == self.FINAL_STRATEGY:
+                        self._assign_final_strategy_results(results, backtest)
+            finally:
+                try:
+                    swim_pool.close_pool(pool)
+                except:
+                    pass
+
+                # All the workers have finished with the market data
+                for shared in shared_list:
+                    shared.close()
 
         else:
             for key in bask_keys:
@@ -1373,6 +2376,10 @@ class TradingModel(object):
             desc = [key]
 
         # For final strategy return heavyweight backtest object (contains lots of auxilliary information about trades etc)
+        # Never send the (large) state for updating the backtest back from
+        # a worker
+        backtest._update_state = None
+
         if key == self.FINAL_STRATEGY and compress_output:
             logger.debug('Compressing ' + key)
 
@@ -1392,6 +2399,57 @@ class TradingModel(object):
         # return desc, backtest.portfolio_cum(), backtest.portfolio_leverage(), backtest.portfolio_pnl_ret_stats(), \
         #       key, _
 
+    def _construct_individual_strategy_shared(
+            self, br: BacktestRequest,
+            shared_spot: SharedDataFrame,
+            spot_col_ind: List[int],
+            shared_spot2: SharedDataFrame,
+            shared_asset: SharedDataFrame,
+            asset_col_ind: List[int],
+            tech_params: TechParams,
+            key: str,
+            shared_contract_value: SharedDataFrame):
+        """Attaches to the market data published by the parent process
+        and calculates the returns of an individual strategy (in a worker)
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for backtest such as start and finish dates
+
+        shared_spot : SharedDataFrame
+            Market time series for generating signals
+
+        spot_col_ind : list(int)
+            Positions of the columns of shared_spot for this strategy
+
+        shared_spot2 : SharedDataFrame
+            Secondary Market time series for generated signals
+
+        shared_asset : SharedDataFrame
+            Asset time series for calculating returns
+
+        asset_col_ind : list(int)
+            Positions of the columns of shared_asset for this strategy
+
+        tech_params : TechParams
+            Parameters for generating signals
+
+        key : str
+            Name of the strategy
+
+        shared_contract_value : SharedDataFrame
+            Dataframe with the contract sizes for each asset
+
+        Returns
+        -------
+        tuple
+        """
+        return self.construct_individual_strategy(
+            br, shared_spot.get_columns(spot_col_ind), shared_spot2.get_df(),
+            shared_asset.get_columns(asset_col_ind), tech_params, key,
+            shared_contract_value.get_df(), False, True)
+
     def compare_strategy_vs_benchmark(
             self,
             br: BacktestRequest,
@@ -2536,6 +3594,10 @@ class PortfolioWeightConstruction(object):
 
         individual_leverage_df = None
 
+        # Work on the underlying (time x asset) arrays, broadcasting any
+        # vectors along rows or columns, only creating DataFrames at the end
+        signal = signal_df.values
+
         # Do we have a vol target for individual signals?
         if br.signal_vol_adjust is True:
             leverage_df = self._risk_engine.calculate_leverage_factor(
@@ -2548,59 +3610,24 @@ class PortfolioWeightConstruction(object):
                 br.signal_vol_resample_type,
                 period_shift=br.signal_vol_period_shift)
 
-            signal_df = pd.DataFrame(
-                signal_df.values * leverage_df.values,
-                index=signal_df.index, columns=signal_df.columns)
+            signal = signal * leverage_df.values
 
             individual_leverage_df = leverage_df  # Contains leverage of individual signal (before portfolio vol target)
 
-        signal_pnl = self._calculations.calculate_signal_returns_with_tc_matrix(
-            signal_df, returns_df, tc=tc, rc=rc)
-        signal_pnl.columns = signal_pnl_cols
+        signal_pnl = _calculate_signal_returns_with_tc(signal, returns_df,
+                                                       tc, rc)
 
-        adjusted_weights_matrix = None
+        signal_pnl_df = pd.DataFrame(signal_pnl, index=returns_df.index,
+                                     columns=signal_pnl_cols)
 
-        # Portfolio is average of the underlying signals: should we sum them or average them or use another
-        # weighting scheme?
-        if br.portfolio_combination is not None:
-            if br.portfolio_combination == "sum" and br.portfolio_combination_weights is None:
-                portfolio = pd.DataFrame(data=signal_pnl.sum(axis=1),
-                                         index=signal_pnl.index,
-                                         columns=["Portfolio"])
-            elif br.portfolio_combination == "mean" and br.portfolio_combination_weights is None:
-                portfolio = pd.DataFrame(data=signal_pnl.mean(axis=1),
-                                         index=signal_pnl.index,
-                                         columns=["Portfolio"])
-
-                adjusted_weights_matrix = self.calculate_signal_weights_for_portfolio(
-                    br, signal_pnl, method="mean")
-            elif "weighted" in br.portfolio_combination and isinstance(
-                    br.portfolio_combination_weights, dict):
-
-                # Get the weights for each asset
-                adjusted_weights_matrix = self.calculate_signal_weights_for_portfolio(
-                    br, signal_pnl, method=br.portfolio_combination)
-
-                portfolio = pd.DataFrame(
-                    data=(signal_pnl.values * adjusted_weights_matrix),
-                    index=signal_pnl.index)
-                is_all_na = pd.isnull(portfolio).all(axis=1)
-                portfolio = pd.DataFrame(portfolio.sum(axis=1),
-                                         columns=["Portfolio"])
-
-                # Overwrite days when every asset PnL was null is NaN with nan
-                portfolio[is_all_na] = np.nan
-        else:
-            # Just assume to take the mean / ie. equal weights for each signal
-            portfolio = pd.DataFrame(data=signal_pnl.mean(axis=1),
-                                     index=signal_pnl.index,
-                                     columns=["Portfolio"])
+        portfolio, adjusted_weights_matrix = self.combine_signal_returns(
+            br, signal_pnl, signal_pnl_cols)
 
-            adjusted_weights_matrix = self.calculate_signal_weights_for_portfolio(
-                br, signal_pnl, method="mean")
+        portfolio = pd.DataFrame(data=portfolio, index=signal_pnl_df.index,
+                                 columns=["Portfolio"])
 
         portfolio_leverage_df = pd.DataFrame(
-            data=np.ones(len(signal_pnl.index)), index=signal_pnl.index,
+            data=np.ones(len(signal_pnl_df.index)), index=signal_pnl_df.index,
             columns=["Portfolio"])
 
         # Should we apply vol target on a portfolio level basis?
@@ -2619,44 +3646,96 @@ class PortfolioWeightConstruction(object):
 
             # portfolio, portfolio_leverage_df = risk_engine.calculate_vol_adjusted_returns(portfolio, br = br)
 
-        # Multiply portfolio leverage * individual signals to get final position signals
-        length_cols = len(signal_df.columns)
-        leverage_matrix = np.transpose(
-            np.repeat(portfolio_leverage_df.values.flatten()[np.newaxis, :],
-                      length_cols, 0))
+        # Multiply portfolio leverage * individual signals to get final position signals (broadcasting the
+        # leverage across the columns)
+        portfolio_signal_before_weighting = \
+            portfolio_leverage_df.values.reshape(-1, 1) * signal
 
         # Final portfolio signals (including signal & portfolio leverage)
-        portfolio_signal = pd.DataFrame(
-            data=np.multiply(leverage_matrix, signal_df.values),
-            index=signal_df.index, columns=signal_df.columns)
+        portfolio_signal = portfolio_signal_before_weighting
+
+        if adjusted_weights_matrix is not None:
+            portfolio_signal = portfolio_signal * adjusted_weights_matrix
 
         # Later, when we plot the portfolio components, we do that without weighting the individual components
-        portfolio_signal_before_weighting = portfolio_signal.copy()
+        portfolio_signal_before_weighting = pd.DataFrame(
+            data=portfolio_signal_before_weighting, index=signal_df.index,
+            columns=signal_df.columns)
+
+        portfolio_signal = pd.DataFrame(
+            data=portfolio_signal, index=signal_df.index,
+            columns=signal_df.columns)
+
+        return portfolio_signal_before_weighting, portfolio_signal, portfolio_leverage_df, portfolio, individual_leverage_df, signal_pnl_df
+
+    def combine_signal_returns(
+            self,
+            br: BacktestRequest,
+            signal_pnl: np.ndarray,
+            signal_pnl_cols: List[str]) -> (np.ndarray, np.ndarray):
+        """Combines the returns of each signal into the portfolio returns,
+        by summing, averaging or weighting them (depending on
+        br.portfolio_combination)
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest specifying the portfolio combination
+
+        signal_pnl : np.ndarray
+            Returns of each signal, with the signals on the last axis (eg.
+            time x signal, or parameter set x time x signal)
+
+        signal_pnl_cols : str (list)
+            Names of each signal
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            Portfolio returns and the weights to apply to the position of each
+            signal (None if the positions aren't weighted)
+        """
+
+        # Portfolio is average of the underlying signals: should we sum them or average them or use another
+        # weighting scheme?
+        if br.portfolio_combination is None or (
+                br.portfolio_combination == "mean" and br.portfolio_combination_weights is None):
+            # Just assume to take the mean / ie. equal weights for each signal
+            portfolio = self._nan_mean(signal_pnl)
+
+            adjusted_weights_matrix = self.calculate_signal_weights_for_portfolio(
+                br, signal_pnl, method="mean", signal_pnl_cols=signal_pnl_cols)
+        elif br.portfolio_combination == "sum" and br.portfolio_combination_weights is None:
+            portfolio = np.nansum(signal_pnl, axis=-1)
+
+            adjusted_weights_matrix = None
+        elif "weighted" in br.portfolio_combination and isinstance(
+                br.portfolio_combination_weights, dict):
+
+            # Get the weights for each asset
+            adjusted_weights_matrix = self.calculate_signal_weights_for_portfolio(
+                br, signal_pnl, method=br.portfolio_combination, signal_pnl_cols=signal_pnl_cols)
+
+            portfolio = np.nansum(signal_pnl * adjusted_weights_matrix, axis=-1)
 
-        if br.portfolio_combination is not None:
+            # Overwrite days when every asset PnL was null is NaN with nan
+            portfolio[np.isnan(signal_pnl).all(axis=-1)] = np.nan
+
+            # Positions aren't weighted when the weighted returns are summed
             if 'sum' in br.portfolio_combination:
-                pass
-            elif br.portfolio_combination == 'mean' \
-                    or (br.portfolio_combination == 'weighted' and isinstance(
-                br.portfolio_combination_weights, dict)):
-                portfolio_signal = pd.DataFrame(
-                    data=(portfolio_signal.values * adjusted_weights_matrix),
-                    index=portfolio_signal.index,
-                    columns=portfolio_signal.columns)
+                adjusted_weights_matrix = None
         else:
-            # Otherwise it's "mean"
-            portfolio_signal = pd.DataFrame(
-                data=(portfolio_signal.values * adjusted_weights_matrix),
-                index=portfolio_signal.index,
-                columns=portfolio_signal.columns)
+            raise Exception("Portfolio combination " + str(br.portfolio_combination)
+                            + " is not supported with these portfolio combination weights")
 
-        return portfolio_signal_before_weighting, portfolio_signal, portfolio_leverage_df, portfolio, individual_leverage_df, signal_pnl
+        return portfolio, adjusted_weights_matrix
 
     def calculate_signal_weights_for_portfolio(
             self,
             br: Backtest,
             signal_pnl: pd.DataFrame,
-            method: str = "mean") -> pd.DataFrame:
+            method: str = "mean",
+            signal_pnl_cols: List[str] = None) -> np.ndarray:
         """Calculates the weights of each signal for the portfolio
 
         Parameters
@@ -2665,8 +3744,10 @@ class PortfolioWeightConstruction(object):
             Parameters for the backtest specifying start date, finish data,
             transaction costs etc.
 
-        signal_pnl : pd.DataFrame
-            Contains the daily P&L for the portfolio
+        signal_pnl : pd.DataFrame or np.ndarray
+            Contains the daily P&L for the portfolio (an array can have the
+            signals on the last axis, after any other axes, eg. parameter set
+            x time x signal)
 
         method : String
             "mean" - assumes equal weighting for each signal
@@ -2674,39 +3755,36 @@ class PortfolioWeightConstruction(object):
             weighting of 1, 1, 0.5, for three signals the third signal will
             have a weighting of half versus the others)
 
-        weights : dict
-            Portfolio weights
+        signal_pnl_cols : str (list)
+            Names of each signal (default - the columns of signal_pnl)
 
         Returns
         -------
-        pd.DataFrame
+        np.ndarray
             Contains the portfolio weights
         """
 
+        if isinstance(signal_pnl, pd.DataFrame):
+            if signal_pnl_cols is None: signal_pnl_cols = signal_pnl.columns
+
+            signal_pnl = signal_pnl.values
+
         if method == "mean":
-            weights_vector = np.ones(len(signal_pnl.columns))
-        elif method == "weighted" or "weighted-sum":
+            weights_vector = np.ones(len(signal_pnl_cols))
+        else:
             # Get the weights for each asset
             weights_vector = np.array(
                 [float(br.portfolio_combination_weights[col]) for col in
-                 signal_pnl.columns])
-
-        # Repeat this down for every day
-        weights_matrix = np.repeat(weights_vector[np.newaxis, :],
-                                   len(signal_pnl.index), 0)
+                 signal_pnl_cols])
 
-        # Where we don't have old price data, make the weights 0 there
-        ind = np.isnan(signal_pnl.values)
-        weights_matrix[ind] = 0
+        # Broadcast the weights down every day, and where we don't have old
+        # price data, make the weights 0 there
+        ind = np.isnan(signal_pnl)
+        weights_matrix = np.where(ind, 0.0, weights_vector)
 
         if method != "weighted-sum":
             # The total weights will vary, as historically might not have all the assets trading
-            total_weights = np.sum(weights_matrix, axis=1)
-
-            # Replicate across columns
-            total_weights = np.transpose(
-                np.repeat(total_weights[np.newaxis, :],
-                          len(signal_pnl.columns), 0))
+            total_weights = np.sum(weights_matrix, axis=-1, keepdims=True)
 
             # To avoid divide by zero
             total_weights[total_weights == 0.0] = 1.0
@@ -2718,6 +3796,15 @@ class PortfolioWeightConstruction(object):
 
         return weights_matrix
 
+    def _nan_mean(self, data: np.ndarray) -> np.ndarray:
+        """Calculates the mean over the last axis (ie. of each row), ignoring
+        NaNs (NaN if every element is NaN), like pd.DataFrame.mean(axis=1)
+        """
+        count = np.sum(~np.isnan(data), axis=-1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.nansum(data, axis=-1) / count
+
 
 #######################################################################################################################
 
@@ -2824,8 +3911,12 @@ class RiskEngine(object):
             number of observations in the year
         vol_rebalance_freq : str
             how often to rebalance
+        resample_freq : str
+            frequency to downsample the returns to first, before calculating
+            volatility (eg. 'D' for intraday data), in which case vol_periods,
+            vol_obs_in_year and period_shift refer to the downsampled periods
         resample_type : str
-            do we need to resample the underlying data first? (eg. have we got intraday data?)
+            how to resample the leverage when rebalancing
         returns : boolean
             is this returns time series or prices?
         period_shift : int
@@ -2837,24 +3928,140 @@ class RiskEngine(object):
         """
 
         calculations = Calculations()
-        filter = Filter()
-
-        if resample_freq is not None:
-            return
-            # TODO not implemented yet
 
         if not returns: returns_df = calculations.calculate_returns(returns_df)
 
+        if resample_freq is not None:
+            # Calculate the leverage on a downsampled grid (much quicker for
+            # intraday data) and then fill it down onto the original points
+            return self._calculate_leverage_factor_resampled(
+                returns_df, vol_target, vol_max_leverage,
+                vol_periods=vol_periods, vol_obs_in_year=vol_obs_in_year,
+                vol_rebalance_freq=vol_rebalance_freq,
+                resample_freq=resample_freq, resample_type=resample_type,
+                period_shift=period_shift)
+
         roll_vol_df = calculations.rolling_volatility(returns_df,
                                                       periods=vol_periods,
                                                       obs_in_year=vol_obs_in_year).shift(
             period_shift)
 
+        return self.calculate_leverage_factor_from_vol(
+            returns_df, roll_vol_df, vol_target, vol_max_leverage,
+            vol_periods=vol_periods, vol_rebalance_freq=vol_rebalance_freq,
+            resample_type=resample_type)
+
+    def _calculate_leverage_factor_resampled(
+            self,
+            returns_df: pd.DataFrame,
+            vol_target: float,
+            vol_max_leverage: float,
+            vol_periods: int = 60,
+            vol_obs_in_year: int = 252,
+            vol_rebalance_freq: str = "BM",
+            resample_freq: str = "D",
+            resample_type: str = "mean",
+            period_shift: int = 0) -> pd.DataFrame:
+        """Calculates the time series of leverage for a specified vol target,
+        with the volatility calculated on returns downsampled to resample_freq
+        (eg. daily returns from intraday data). The leverage is then filled
+        down onto the original points.
+
+        Parameters
+        ----------
+        returns_df : DataFrame
+            Asset returns
+        vol_target : float
+            vol target for assets
+        vol_max_leverage : float
+            maximum leverage allowed
+        vol_periods : int
+            number of downsampled periods to calculate volatility
+        vol_obs_in_year : int
+            number of downsampled observations in the year
+        vol_rebalance_freq : str
+            how often to rebalance
+        resample_freq : str
+            frequency to downsample the returns to
+        resample_type : str
+            how to resample the leverage when rebalancing
+        period_shift : int
+            should we delay the signal by a number of downsampled periods?
+
+        Returns
+        -------
+        pd.Dataframe
+        """
+
+        calculations = Calculations()
+
+        # Compound the returns in each period, labelling each period by its
+        # end, so the leverage is only used after the period has finished
+        # (ignoring empty periods, eg. weekends)
+        resampled_returns_df = (1.0 + returns_df).resample(
+            resample_freq, closed='left', label='right').prod(
+            min_count=1) - 1.0
+        resampled_returns_df = resampled_returns_df.dropna(how='all')
+
+        roll_vol_df = calculations.rolling_volatility(
+            resampled_returns_df, periods=vol_periods,
+            obs_in_year=vol_obs_in_year).shift(period_shift)
+
+        lev_df = self.calculate_leverage_factor_from_vol(
+            resampled_returns_df, roll_vol_df, vol_target, vol_max_leverage,
+            vol_periods=vol_periods, vol_rebalance_freq=vol_rebalance_freq,
+            resample_type=resample_type)
+
+        returns_df, lev_df = calculations.join_left_fill_right(returns_df,
+                                                               lev_df)
+
+        return lev_df
+
+    def calculate_leverage_factor_from_vol(
+            self,
+            returns_df: pd.DataFrame,
+            roll_vol_df: pd.DataFrame,
+            vol_target,
+            vol_max_leverage,
+            vol_periods: int = 60,
+            vol_rebalance_freq: str = "BM",
+            resample_type: str = "mean") -> pd.DataFrame:
+        """Calculates the time series of leverage for a specified vol target,
+        from an already computed rolling volatility. The vol target and max
+        leverage can either be a float, or an array with a value for each
+        column (eg. when sweeping many vol targets at once).
+
+        Parameters
+        ----------
+        returns_df : DataFrame
+            Asset returns (used to align the leverage to the trading days)
+        roll_vol_df : DataFrame
+            Rolling annualised volatility of the assets
+        vol_target : float or np.ndarray
+            vol target for assets
+        vol_max_leverage : float or np.ndarray
+            maximum leverage allowed (None for no maximum, or np.inf for
+            individual columns in an array)
+        vol_periods : int
+            number of periods to calculate volatility
+        vol_rebalance_freq : str
+            how often to rebalance
+        resample_type : str
+            how to resample the leverage when rebalancing
+
+        Returns
+        -------
+        pd.Dataframe
+        """
+
+        calculations = Calculations()
+        filter = Filter()
+
         # calculate the leverage as function of vol target (with max lev constraint)
         lev_df = vol_target / roll_vol_df
 
         if vol_max_leverage is not None:
-            lev_df[lev_df > vol_max_leverage] = vol_max_leverage
+            lev_df = np.minimum(lev_df, vol_max_leverage)
 
         if resample_type is not None:
             lev_df = filter.resample_time_series_frequency(lev_df,
@@ -2901,42 +4108,41 @@ class RiskEngine(object):
 
         position_clip_adjustment = None
 
-        # Adjust leverage of portfolio based on max NET position sizes
-        if br.max_net_exposure is not None:
-            portfolio_net_exposure = portfolio_net_exposure.shift(
-                br.position_clip_period_shift)
+        if br.max_net_exposure is None and br.max_abs_exposure is None:
+            return position_clip_adjustment
 
-            # add further constraints on portfolio (total net amount of longs and short)
-            position_clip_adjustment = pd.DataFrame(
-                data=np.ones(len(portfolio_net_exposure.index)),
-                index=portfolio_net_exposure.index,
-                columns=['Portfolio'])
+        # Use the underlying arrays, given the exposures and the adjustment
+        # have different column names
+        adjustment = np.ones(len(portfolio_net_exposure.index))
 
-            portfolio_abs_exposure = portfolio_net_exposure.abs()
+        # Adjust leverage of portfolio based on max NET position sizes
+        if br.max_net_exposure is not None:
+            portfolio_abs_exposure = portfolio_net_exposure.shift(
+                br.position_clip_period_shift).abs().values[:, 0]
 
             # For those periods when the absolute net positioning is greater
             # than our limit cut down the leverage
-            position_clip_adjustment[
-                (portfolio_abs_exposure > br.max_net_exposure).values] = \
-                br.max_net_exposure / portfolio_abs_exposure
+            clip = portfolio_abs_exposure > br.max_net_exposure
+
+            adjustment[clip] = br.max_net_exposure / portfolio_abs_exposure[clip]
 
         # Adjust leverage of portfolio based on max TOTAL position sizes
         if br.max_abs_exposure is not None:
-            portfolio_abs_exposure = portfolio_abs_exposure.shift(
-                br.position_clip_period_shift)
-
-            # add further constraints on portfolio (total net amount of
-            # longs and short)
-            position_clip_adjustment = pd.DataFrame(
-                data=np.ones(len(portfolio_abs_exposure.index)),
-                index=portfolio_abs_exposure.index,
-                columns=['Portfolio'])
+            portfolio_total_abs_exposure = portfolio_total_exposure.shift(
+                br.position_clip_period_shift).values[:, 0]
 
             # For those periods when the absolute TOTAL positioning is
-            # greater than our limit cut down the leverage
-            position_clip_adjustment[
-                (portfolio_total_exposure > br.max_abs_exposure).values] = \
-                br.max_abs_exposure / portfolio_total_exposure
+            # greater than our limit cut down the leverage (unless the net
+            # limit has already cut it down further)
+            clip = portfolio_total_abs_exposure > br.max_abs_exposure
+
+            adjustment[clip] = np.minimum(
+                adjustment[clip],
+                br.max_abs_exposure / portfolio_total_abs_exposure[clip])
+
+        position_clip_adjustment = pd.DataFrame(
+            data=adjustment, index=portfolio_net_exposure.index,
+            columns=['Portfolio'])
 
         # Only allow the position clip adjustment to change on certain
         # days (eg. 'BM' = month end)
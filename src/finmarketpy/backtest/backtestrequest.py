@@ -86,9 +86,11 @@ class BacktestRequest(MarketDataRequest):
         self.__position_clip_resample_type = 'mean'
         self.__position_clip_period_shift = 0
 
-        # Take profit and stop loss parameters
+        # Take profit and stop loss parameters (either a single level, a level for each asset or a DataFrame of
+        # levels over time), and a trailing stop, which is the maximum fall in P&L from the peak of each trade
         self.__take_profit = None
         self.__stop_loss = None
+        self.__trailing_stop = None
 
         # Should we delay the signal?
         self.__signal_delay = 0
@@ -417,6 +419,14 @@ class BacktestRequest(MarketDataRequest):
     def take_profit(self, take_profit):
         self.__take_profit = take_profit
 
+    @property
+    def trailing_stop(self):
+        return self.__trailing_stop
+
+    @trailing_stop.setter
+    def trailing_stop(self, trailing_stop):
+        self.__trailing_stop = trailing_stop
+
     ##### tech indicators and spot bp tc
     @property
     def tech_params(self):
@@ -0,0 +1,420 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import copy
+from collections import OrderedDict
+from typing import List, Dict
+
+import numpy as np
+import pandas as pd
+
+from findatapy.timeseries import Calculations
+from findatapy.util import LoggerManager
+
+from finmarketpy.backtest.backtestengine import Backtest, RiskEngine, \
+    PortfolioWeightConstruction, _cost_vector, _signal_returns_with_tc
+from finmarketpy.backtest.backtestrequest import BacktestRequest
+
+
+class BacktestSweep(object):
+    """Calculates the portfolio returns for many different parameter sets of
+    a backtest in a single pass, for parameters which only impact the P&L
+    (eg. transaction costs, vol targets, position limits), rather than the
+    signal generation.
+
+    The signals and asset returns are only calculated once (or once for each
+    different signal delay/stop loss/take profit combination), and the
+    leverage and costs are applied as 3D arrays of
+    parameter set x time x asset, instead of rerunning the whole Backtest
+    for every parameter set.
+
+    """
+
+    # Parameters which can be varied between the parameter sets
+    SWEEP_PARAMETERS = ['spot_tc_bp', 'spot_rc_bp', 'signal_delay',
+                        'stop_loss', 'take_profit', 'trailing_stop',
+                        'signal_vol_adjust', 'signal_vol_target',
+                        'signal_vol_max_leverage',
+                        'portfolio_vol_adjust', 'portfolio_vol_target',
+                        'portfolio_vol_max_leverage',
+                        'max_net_exposure', 'max_abs_exposure']
+
+    def __init__(self):
+        self._calculations = Calculations()
+        self._risk_engine = RiskEngine()
+
+    def is_sweepable(self,
+                     br: BacktestRequest,
+                     parameter_list: List[Dict]) -> bool:
+        """Checks whether a list of parameters can be calculated in a single
+        sweep, or whether we need to rerun the whole backtest for each
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Base parameters for the backtest
+
+        parameter_list : dict (list)
+            Parameters to change for each run of the backtest
+
+        Returns
+        -------
+        bool
+        """
+        for p in parameter_list:
+            for k in p.keys():
+                if k not in self.SWEEP_PARAMETERS:
+                    return False
+
+        br_list = [self._create_request(br, p) for p in parameter_list]
+
+        for b in br_list:
+            # Custom weighting schemes and time varying costs require the
+            # full backtest
+            if b.portfolio_weight_construction is not None:
+                return False
+
+            if isinstance(b.spot_tc_bp, pd.DataFrame) \
+                    or isinstance(b.spot_rc_bp, pd.DataFrame):
+                return False
+
+            if b.signal_vol_resample_freq is not None \
+                    or b.portfolio_vol_resample_freq is not None:
+                return False
+
+        if br.portfolio_combination is not None:
+            if br.portfolio_combination_weights is None:
+                return br.portfolio_combination in ['sum', 'mean']
+
+            return 'weighted' in br.portfolio_combination \
+                and isinstance(br.portfolio_combination_weights, dict)
+
+        return True
+
+    def calculate_portfolio_returns(
+            self,
+            br: BacktestRequest,
+            asset_a_df: pd.DataFrame,
+            signal_df: pd.DataFrame,
+            parameter_list: List[Dict],
+            parameter_names: List[str] = None) -> pd.DataFrame:
+        """Calculates the portfolio returns for every parameter set, which
+        are identical to running Backtest.calculate_trading_PnL with each
+        parameter set and taking the portfolio_pnl
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Base parameters for the backtest, which will be amended by each
+            parameter set
+
+        asset_a_df : pd.DataFrame
+            Asset prices to be traded
+
+        signal_df : pd.DataFrame
+            Signals for the trading strategy
+
+        parameter_list : dict (list)
+            Parameters to change for each run of the backtest
+            eg. [{'spot_tc_bp': 0.5, 'portfolio_vol_target': 0.1}, ...]
+
+        parameter_names : str (list)
+            Column names for each parameter set
+
+        Returns
+        -------
+        pd.DataFrame
+            Portfolio returns with one column for each parameter set
+        """
+
+        logger = LoggerManager().getLogger(__name__)
+
+        if parameter_names is None:
+            parameter_names = [str(p) for p in parameter_list]
+
+        br_list = [self._create_request(br, p) for p in parameter_list]
+
+        # Parameters which change the signal itself need the signal
+        # recalculated, but everything in the group can be swept together
+        signal_groups = OrderedDict()
+
+        for i, b in enumerate(br_list):
+            signal_groups.setdefault(self._signal_key(b), []).append(i)
+
+        backtest = Backtest()
+
+        portfolio = []
+        portfolio_ind = []
+
+        for key in signal_groups.keys():
+            ind = signal_groups[key]
+
+            logger.info("Calculating sweep for " + str(len(ind))
+                        + " parameter sets with signal delay/stops "
+                        + str(key))
+
+            asset_df, signal_aligned_df, returns_df = \
+                backtest._align_signal_with_asset(br_list[ind[0]],
+                                                  asset_a_df, signal_df)
+
+            portfolio_group = self._calculate_portfolio_returns_group(
+                [br_list[i] for i in ind], signal_aligned_df, returns_df)
+
+            portfolio.append(portfolio_group)
+            portfolio_ind = portfolio_ind + ind
+
+        # Put back in the same order as the parameter list
+        portfolio = np.hstack(portfolio)[:, np.argsort(portfolio_ind)]
+
+        portfolio_df = pd.DataFrame(portfolio, index=returns_df.index,
+                                    columns=parameter_names)
+
+        return backtest._filter_by_plot_start_finish_date(portfolio_df, br)
+
+    def _signal_key(self, br: BacktestRequest) -> tuple:
+        """Gets the parameters which change the aligned signal, as a key
+        (stops for each asset or over time are compared by identity)
+        """
+        key = [br.signal_delay]
+
+        for level in [br.stop_loss, br.take_profit, br.trailing_stop]:
+            if level is None or np.isscalar(level):
+                key.append(level)
+            else:
+                key.append(id(level))
+
+        return tuple(key)
+
+    def _calculate_portfolio_returns_group(
+            self,
+            br_list: List[BacktestRequest],
+            signal_df: pd.DataFrame,
+            returns_df: pd.DataFrame) -> np.ndarray:
+        """Calculates the portfolio returns for parameter sets which share
+        the same (aligned) signals, returning an array of time x parameter
+        set. Follows the same steps as Backtest.calculate_trading_PnL and
+        PortfolioWeightConstruction.optimize_portfolio_weights.
+        """
+
+        br = br_list[0]
+
+        returns = returns_df.values
+        signal = signal_df.values
+
+        signal_cols = signal_df.columns.values
+        asset_df_cols = returns_df.columns.values
+
+        pnl_cols = [asset_df_cols[i] + " / " + signal_cols[i]
+                    for i in range(0, len(asset_df_cols))]
+
+        # Transaction costs and roll costs of each parameter set for every
+        # asset
+        tc = np.array([_cost_vector(b.spot_tc_bp, returns_df.columns)
+                       for b in br_list])
+        rc = np.array([_cost_vector(b.spot_rc_bp, returns_df.columns)
+                       for b in br_list])
+
+        # Signal level parameters are often shared by many parameter sets
+        # (eg. if we only vary the portfolio vol target), so only calculate
+        # the signal leverage and signal P&L for each unique combination
+        leverage_keys = [(b.signal_vol_adjust is True, b.signal_vol_target,
+                          b.signal_vol_max_leverage) for b in br_list]
+
+        leverage_ind, leverage_inv = self._unique_index(leverage_keys)
+
+        pnl_ind, pnl_inv = self._unique_index(
+            [(leverage_inv[i], tc[i].tobytes(), rc[i].tobytes())
+             for i in range(0, len(br_list))])
+
+        # Signal level vol targeting (rolling vol is the same for every
+        # parameter set), shape (parameter set, time, asset)
+        signal_leverage = np.ones((len(leverage_ind), 1, 1))
+
+        signal_vol_adjust = np.array([leverage_keys[i][0]
+                                      for i in leverage_ind])
+
+        if signal_vol_adjust.any():
+            roll_vol_df = self._calculations.rolling_volatility(
+                returns_df, periods=br.signal_vol_periods,
+                obs_in_year=br.signal_vol_obs_in_year).shift(
+                br.signal_vol_period_shift)
+
+            signal_leverage = self._calculate_leverage_sweep(
+                returns_df, roll_vol_df,
+                [leverage_keys[i][1] for i in leverage_ind],
+                [leverage_keys[i][2] for i in leverage_ind],
+                br.signal_vol_periods, br.signal_vol_rebalance_freq,
+                br.signal_vol_resample_type)
+
+            signal_leverage[~signal_vol_adjust] = 1.0
+
+        signal = signal[np.newaxis, :, :] * signal_leverage
+
+        signal_pnl = _signal_returns_with_tc(
+            signal[leverage_inv[pnl_ind]], returns[np.newaxis, :, :],
+            tc[pnl_ind][:, np.newaxis, :], rc[pnl_ind][:, np.newaxis, :])
+
+        # Combine the signals into a portfolio, in the same way as the
+        # Backtest (with the signals on the last axis)
+        portfolio, weights_matrix = \
+            PortfolioWeightConstruction(br=br).combine_signal_returns(
+                br, signal_pnl, pnl_cols)
+
+        # From now on we need every parameter set, shape (parameter set, time)
+        portfolio = portfolio[pnl_inv]
+
+        # Portfolio level vol targeting (different rolling vol for each
+        # parameter set, given the portfolio returns differ)
+        portfolio_leverage = np.ones(portfolio.shape)
+
+        portfolio_vol_adjust = np.array([b.portfolio_vol_adjust is True
+                                         for b in br_list])
+
+        if portfolio_vol_adjust.any():
+            portfolio_df = pd.DataFrame(np.transpose(portfolio),
+                                        index=returns_df.index)
+
+            roll_vol_df = self._calculations.rolling_volatility(
+                portfolio_df, periods=br.portfolio_vol_periods,
+                obs_in_year=br.portfolio_vol_obs_in_year).shift(
+                br.portfolio_vol_period_shift)
+
+            portfolio_leverage = self._calculate_leverage_sweep(
+                portfolio_df, roll_vol_df,
+                [b.portfolio_vol_target for b in br_list],
+                [b.portfolio_vol_max_leverage for b in br_list],
+                br.portfolio_vol_periods, br.portfolio_vol_rebalance_freq,
+                br.portfolio_vol_resample_type, tile=False)[:, :, 0]
+
+            portfolio_leverage[~portfolio_vol_adjust] = 1.0
+
+        # Apply any position limits on the whole portfolio
+        for i, b in enumerate(br_list):
+            if b.max_net_exposure is None and b.max_abs_exposure is None:
+                continue
+
+            portfolio_signal = portfolio_leverage[i][:, np.newaxis] \
+                * signal[leverage_inv[i]]
+
+            if weights_matrix is not None:
+                portfolio_signal = portfolio_signal \
+                    * weights_matrix[pnl_inv[i]]
+
+            total_longs = np.where(portfolio_signal > 0, portfolio_signal,
+                                   0).sum(axis=1)
+            total_shorts = np.where(portfolio_signal < 0, portfolio_signal,
+                                    0).sum(axis=1)
+
+            portfolio_net_exposure = pd.DataFrame(
+                index=returns_df.index, columns=['Net Exposure'],
+                data=total_longs + total_shorts)
+            portfolio_total_exposure = pd.DataFrame(
+                index=returns_df.index, columns=['Total Exposure'],
+                data=total_longs - total_shorts)
+
+            position_clip_adjustment = \
+                self._risk_engine.calculate_position_clip_adjustment(
+                    portfolio_net_exposure, portfolio_total_exposure, b)
+
+            portfolio_leverage[i] = portfolio_leverage[i] \
+                * position_clip_adjustment.values.flatten()
+
+        # Final portfolio returns with the portfolio leverage
+        tc_port = np.array([_cost_vector(b.spot_tc_bp, ["Portfolio"])
+                            for b in br_list])
+        rc_port = np.array([_cost_vector(b.spot_rc_bp, ["Portfolio"])
+                            for b in br_list])
+
+        # With the portfolio as the only asset, shape (parameter set, time, 1)
+        portfolio = _signal_returns_with_tc(
+            portfolio_leverage[:, :, np.newaxis],
+            portfolio[:, :, np.newaxis], tc_port[:, np.newaxis, :],
+            rc_port[:, np.newaxis, :])[:, :, 0]
+
+        return np.transpose(portfolio)
+
+    def _calculate_leverage_sweep(
+            self,
+            returns_df: pd.DataFrame,
+            roll_vol_df: pd.DataFrame,
+            vol_target: List[float],
+            vol_max_leverage: List[float],
+            vol_periods: int,
+            vol_rebalance_freq: str,
+            resample_type: str,
+            tile: bool = True) -> np.ndarray:
+        """Calculates the leverage for many vol targets at once, stacking
+        every parameter set side by side, so the rebalancing is done in a
+        single resample, returning an array of
+        parameter set x time x column
+
+        If tile is True, the same rolling vol is used for every parameter
+        set, otherwise roll_vol_df already has one column per parameter set.
+        """
+
+        no_params = len(vol_target)
+
+        if tile:
+            no_cols = len(roll_vol_df.columns)
+
+            roll_vol_df = pd.DataFrame(
+                np.tile(roll_vol_df.values, (1, no_params)),
+                index=roll_vol_df.index)
+        else:
+            no_cols = 1
+
+        vol_target = np.repeat(np.array(vol_target, dtype=float), no_cols)
+
+        vol_max_leverage = np.repeat(
+            np.array([np.inf if x is None else x for x in vol_max_leverage],
+                     dtype=float), no_cols)
+
+        lev_df = self._risk_engine.calculate_leverage_factor_from_vol(
+            returns_df, roll_vol_df, vol_target, vol_max_leverage,
+            vol_periods=vol_periods, vol_rebalance_freq=vol_rebalance_freq,
+            resample_type=resample_type)
+
+        return np.transpose(
+            lev_df.values.reshape(len(lev_df.index), no_params, no_cols),
+            (1, 0, 2))
+
+    def _unique_index(self, keys: List) -> (np.ndarray, np.ndarray):
+        """Finds the first index of each unique key and for every key the
+        position of its unique key (like np.unique with return_index and
+        return_inverse, but for any hashable keys, in order of appearance)
+        """
+        unique_keys = OrderedDict()
+        inverse = []
+
+        for i, k in enumerate(keys):
+            if k not in unique_keys:
+                unique_keys[k] = (i, len(unique_keys))
+
+            inverse.append(unique_keys[k][1])
+
+        return np.array([v[0] for v in unique_keys.values()]), \
+            np.array(inverse)
+
+    def _create_request(self,
+                        br: BacktestRequest,
+                        parameters: Dict) -> BacktestRequest:
+        br = copy.copy(br)
+
+        for k in parameters.keys():
+            setattr(br, k, parameters[k])
+
+        return br
@@ -27,9 +27,9 @@ import pandas
 import copy
 
 from chartpy import Chart, Style, ChartConstants
-from findatapy.timeseries import Calculations, Timezone
+from findatapy.timeseries import Calculations, Timezone, RetStats
 from findatapy.util.loggermanager import LoggerManager
-from finmarketpy.backtest import Backtest
+from finmarketpy.backtest import Backtest, BacktestSweep
 
 from finmarketpy.util.marketconstants import MarketConstants
 from findatapy.util.swimpool import SwimPool
@@ -227,7 +227,7 @@ class TradeAnalysis(object):
                                engine='xlsxwriter')
 
     def run_tc_shock(self, strategy, tc=None, run_in_parallel=False,
-                     reload_market_data=True):
+                     reload_market_data=True, batch=False):
         if tc is None: tc = [0.0, 0.25, 0.5, 0.75, 1.0, 1.25, 1.5, 1.75, 2.0]
 
         parameter_list = [{'spot_tc_bp': x} for x in tc]
@@ -240,22 +240,79 @@ class TradeAnalysis(object):
                                               pretty_portfolio_names=pretty_portfolio_names,
                                               parameter_type=parameter_type,
                                               run_in_parallel=run_in_parallel,
-                                              reload_market_data=reload_market_data)
+                                              reload_market_data=reload_market_data,
+                                              batch=batch)
 
     ###### Parameters and signal generations (need to be customised for every model)
     def run_arbitrary_sensitivity(self, trading_model, parameter_list=None,
                                   pretty_portfolio_names=None,
                                   parameter_type=None, run_in_parallel=False,
-                                  reload_market_data=True, plot=True):
+                                  reload_market_data=True, plot=True,
+                                  batch=False):
+        """Runs a trading strategy for a list of different parameters and
+        plots the returns for each (and their IR and returns)
 
-        if not (reload_market_data):
+        Parameters
+        ----------
+        trading_model : TradingModel
+            defining trading strategy
+
+        parameter_list : dict (list)
+            parameters to change for each run eg. [{'spot_tc_bp': 0.5}, ...]
+
+        pretty_portfolio_names : str (list)
+            names for each set of parameters
+
+        parameter_type : str
+            broad type of parameter name (used in titles)
+
+        run_in_parallel : bool
+            run each set of parameters in a separate process
+
+        reload_market_data : bool
+            reload market data for each set of parameters
+
+        plot : bool
+            plot the output
+
+        batch : bool
+            if all the parameters only impact the P&L (eg. transaction costs,
+            vol targets, position limits, stops), generate the signals once
+            and calculate the returns for every parameter set in a single
+            sweep using BacktestSweep (market data is only loaded once)
+
+        Returns
+        -------
+        DataFrame (cumulative returns), DataFrame (IR), DataFrame (returns)
+        """
+
+        logger = LoggerManager().getLogger(__name__)
+
+        if batch:
+            br = copy.copy(trading_model.load_parameters())
+
+            if not (BacktestSweep().is_sweepable(br, parameter_list)):
+                logger.warning("Parameters cannot be swept in a batch, so "
+                               "will run every backtest separately")
+
+                batch = False
+
+        if not (reload_market_data) and not (batch):
             asset_df, spot_df, spot_df2, basket_dict, contract_value_df = self._load_assets(
                 trading_model)
 
         port_list = []
         ret_stats_list = []
 
-        if market_constants.backtest_thread_no[
+        if batch:
+            asset_df, spot_df, spot_df2, basket_dict, contract_value_df = self._load_assets(
+                trading_model, br=br)
+
+            port_list, ret_stats_list = self._run_strategy_sweep(
+                trading_model, asset_df, spot_df, spot_df2, br,
+                parameter_list, pretty_portfolio_names)
+
+        elif market_constants.backtest_thread_no[
             market_constants.generic_plat] > 1 and run_in_parallel:
             swim_pool = SwimPool(
                 multiprocessing_library=market_constants.multiprocessing_library)
@@ -418,6 +475,49 @@ class TradeAnalysis(object):
 
         return port, ret_stats
 
+    def _run_strategy_sweep(self, trading_model, asset_df, spot_df, spot_df2,
+                            br, parameter_list, pretty_portfolio_names):
+
+        logger = LoggerManager().getLogger(__name__)
+
+        logger.info("Calculating sweep of " + str(len(parameter_list))
+                    + " parameter sets...")
+
+        calculations = Calculations()
+
+        # Signals are calculated once for all the parameter sets
+        signal_df = trading_model.construct_signal(spot_df, spot_df2,
+                                                   br.tech_params, br,
+                                                   run_in_parallel=False)
+
+        portfolio_df = BacktestSweep().calculate_portfolio_returns(
+            br, asset_df, signal_df, parameter_list,
+            parameter_names=[str(p) for p in pretty_portfolio_names])
+
+        port_list = []
+        ret_stats_list = []
+
+        for i in range(0, len(portfolio_df.columns)):
+            portfolio = pandas.DataFrame(portfolio_df.iloc[:, i])
+            portfolio.columns = ['Port']
+
+            ret_stats = RetStats(portfolio, br.ann_factor,
+                                 br.resample_ann_factor)
+            stats = str(ret_stats.summary()[0])
+
+            if br.cum_index == 'mult':
+                port = calculations.create_mult_index(portfolio)
+            elif br.cum_index == 'add':
+                port = calculations.create_add_index(portfolio)
+
+            port = port.resample('B').mean()
+            port.columns = [str(pretty_portfolio_names[i]) + ' ' + stats]
+
+            port_list.append(port)
+            ret_stats_list.append(ret_stats)
+
+        return port_list, ret_stats_list
+
     ###### Parameters and signal generations (need to be customised for every model)
     ###### Plot all the output separately
     def run_arbitrary_sensitivity_separately(self, trading_model,
@@ -0,0 +1,211 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import numpy as np
+import pandas as pd
+
+
+class TradeAttribution(object):
+    """Splits the P&L of a strategy into individual trades, where a trade is
+    a run of periods over which the position held in an asset is unchanged
+    (and not flat).
+
+    The runs are found by run-length encoding the changes in the signal for
+    every asset at once, and the P&L of each run (and its maximum adverse and
+    favourable excursions) by differencing the cumulative returns at the
+    boundaries of each run, so it takes time linear in rows x assets, without
+    looping over the trades.
+
+    """
+
+    def calculate_trades(self, signal_df: pd.DataFrame,
+                         returns_df: pd.DataFrame,
+                         cum_index: str = 'mult') -> pd.DataFrame:
+        """Calculates the P&L of every individual trade for each asset. A
+        signal at time t is assumed to earn the returns at time t+1 (as in
+        the Backtest), so a trade entered at the entry date earns the returns
+        after it up to (and including) the exit date.
+
+        Parameters
+        ----------
+        signal_df : DataFrame
+            Trading signals (NaN is treated as flat)
+        returns_df : DataFrame
+            Strategy returns for each asset (ie. already multiplied by the
+            signal), aligned with the signals
+        cum_index : str
+            'mult' to compound the returns during each trade or 'add' to sum
+            them (default - 'mult')
+
+        Returns
+        -------
+        DataFrame
+            One row per trade with the asset, position, entry and exit dates,
+            number of periods held, P&L, maximum adverse excursion (MAE),
+            maximum favourable excursion (MFE) and whether the trade is still
+            open at the end of the time series
+        """
+        trades = self._segment_trades(signal_df, returns_df, cum_index)
+
+        col, row_start, row_end, position, pnl, mae, mfe, is_open = trades
+
+        index = returns_df.index
+
+        return pd.DataFrame({
+            'Asset': returns_df.columns.to_numpy()[col],
+            'Position': position,
+            'Entry Date': index[row_start - 1].array,
+            'Exit Date': index[row_end].array,
+            'Holding Periods': row_end - row_start + 1,
+            'P&L': pnl,
+            'MAE': mae,
+            'MFE': mfe,
+            'Open': is_open})
+
+    def calculate_trade_gains(self, signal_df: pd.DataFrame,
+                              returns_df: pd.DataFrame,
+                              cum_index: str = 'mult') -> pd.DataFrame:
+        """Calculates the P&L of every closed trade, recorded at the date the
+        trade is exited, with NaN elsewhere (in the same layout as
+        Calculations.calculate_individual_trade_gains)
+
+        Parameters
+        ----------
+        signal_df : DataFrame
+            Trading signals (NaN is treated as flat)
+        returns_df : DataFrame
+            Strategy returns for each asset, aligned with the signals
+        cum_index : str
+            'mult' to compound the returns during each trade or 'add' to sum
+            them (default - 'mult')
+
+        Returns
+        -------
+        DataFrame
+        """
+        trades = self._segment_trades(signal_df, returns_df, cum_index)
+
+        col, row_start, row_end, position, pnl, mae, mfe, is_open = trades
+
+        trade_gains = np.full(returns_df.shape, np.nan)
+        trade_gains[row_end[~is_open], col[~is_open]] = pnl[~is_open]
+
+        return pd.DataFrame(trade_gains, index=returns_df.index,
+                            columns=returns_df.columns)
+
+    def _segment_trades(self, signal_df, returns_df, cum_index):
+        if cum_index not in ['mult', 'add']:
+            raise ValueError('cum_index must be mult or add')
+
+        # Copy into asset major order, so each run is a contiguous block once
+        # flattened (the returns are then overwritten in place)
+        signal = np.nan_to_num(np.array(
+            np.asarray(signal_df, dtype=np.float64).T, order='C'), copy=False)
+        returns = np.nan_to_num(np.array(
+            np.asarray(returns_df, dtype=np.float64).T, order='C'), copy=False)
+
+        if signal.shape != returns.shape:
+            raise ValueError('Signals and returns must have the same shape')
+
+        cols, rows = returns.shape
+
+        if returns.size == 0:
+            empty = np.zeros(0, dtype=np.int64)
+
+            return empty, empty, empty, np.zeros(0), np.zeros(0), \
+                   np.zeros(0), np.zeros(0), np.zeros(0, dtype=bool)
+
+        # held[t] is the position earning returns[t]
+        held = np.empty((cols, rows))
+        held[:, 0] = 0
+        held[:, 1:] = signal[:, :-1]
+
+        is_start = np.empty((cols, rows), dtype=bool)
+        is_start[:, 0] = True
+        np.not_equal(held[:, 1:], held[:, :-1], out=is_start[:, 1:])
+
+        starts = np.flatnonzero(is_start)
+        lengths = np.diff(np.append(starts, rows * cols))
+
+        ends = starts + lengths - 1
+
+        # Running P&L since the start of each run
+        if cum_index == 'mult':
+            # Compound in logs, keeping track of growth factors which are
+            # zero or negative (ie. returns of -100% or worse, which can
+            # happen with leverage), so they only affect their own run
+            growth = np.add(returns, 1, out=returns)
+
+            is_zero = growth == 0
+            is_negative = growth < 0
+
+            with np.errstate(divide='ignore'):
+                log_growth = np.log(np.abs(growth, out=growth), out=growth)
+
+            log_growth[is_zero] = 0
+
+            log_growth = self._run_cumsum(log_growth, starts, lengths, rows)
+            zeros = self._run_cumsum(is_zero.astype(np.float64), starts,
+                                     lengths, rows)
+            negatives = self._run_cumsum(is_negative.astype(np.float64),
+                                         starts, lengths, rows)
+
+            running = np.expm1(log_growth, out=log_growth)
+
+            # An odd number of negative growth factors flips the sign
+            odd = np.mod(negatives, 2) == 1
+            running[odd] = -running[odd] - 2
+            running[zeros > 0] = -1
+
+        else:
+            running = self._run_cumsum(returns, starts, lengths, rows)
+
+        pnl = running[ends]
+
+        # Include the entry point (where the P&L is zero) in the excursions
+        mae = np.minimum(np.minimum.reduceat(running, starts), 0)
+        mfe = np.maximum(np.maximum.reduceat(running, starts), 0)
+
+        position = held.ravel()[starts]
+
+        # Flat periods are not trades
+        is_trade = position != 0
+
+        starts, ends = starts[is_trade], ends[is_trade]
+
+        col = starts // rows
+        row_start = starts % rows
+        row_end = ends % rows
+
+        # A trade at the end is only open if the last signal hasn't exited it
+        is_open = (row_end == rows - 1) & (signal[col, -1] == position[is_trade])
+
+        return col, row_start, row_end, position[is_trade], pnl[is_trade], \
+               mae[is_trade], mfe[is_trade], is_open
+
+    def _run_cumsum(self, x, starts, lengths, rows):
+        # Cumulative sum since the start of each asset's time series
+        running = np.cumsum(x, axis=1, out=x).ravel()
+
+        # Difference against the level just before the start of each run, so
+        # it becomes the cumulative sum since the start of each run
+        running_before = running[starts - 1]
+        running_before[starts % rows == 0] = 0
+
+        running -= np.repeat(running_before, lengths)
+
+        return running
@@ -16,6 +16,34 @@ __author__ = 'saeedamen'  # Saeed Amen
 #
 
 import abc
+import copy
+import os
+import time
+
+import pandas as pd
+
+from findatapy.util import LoggerManager, SwimPool
+from findatapy.util.fxconv import FXConv
+
+from finmarketpy.util.marketconstants import MarketConstants
+from finmarketpy.util.shareddataframe import SharedDataFrame
+
+market_constants = MarketConstants()
+
+
+def _construct_total_return_index_cross(curve, cross, market_df, kwargs):
+    # Can run in a worker, which attaches to the market data published by the parent process
+    if isinstance(market_df, SharedDataFrame):
+        market_df = market_df.get_df()
+
+        kwargs = curve._get_kwargs_from_worker(kwargs)
+
+    start = time.time()
+
+    total_return_index_df = curve._construct_total_return_index_cross(cross, market_df, **kwargs)
+
+    return total_return_index_df, time.time() - start, os.getpid()
+
 
 class AbstractCurve(object):
     """Abstract class for creating total return indices and curves, which is for example implemented by FXSpotCurve
@@ -23,6 +51,10 @@ class AbstractCurve(object):
 
     """
 
+    # Attributes which aren't needed to construct the total return index of each cross, and can be large (eg. hold
+    # market data), so aren't sent to the processes which construct them
+    _worker_excluded_attributes = ['_market_data_generator']
+
     @abc.abstractmethod
     def generate_key(self):
         return
@@ -34,3 +66,234 @@ class AbstractCurve(object):
     @abc.abstractmethod
     def construct_total_returns_index(self):
         return
+
+    def get_cross_timing(self):
+        """Gets how long it took to construct the total return index of each cross (and in which process), the last
+        time construct_total_return_index was called, so we can see which crosses dominate
+
+        Returns
+        -------
+        DataFrame
+        """
+        return self._cross_timing
+
+    def _construct_total_return_index_crosses(self, cross_fx, market_df, run_in_parallel=False, thread_no=None,
+                                              **kwargs):
+        """Constructs the total return index for each cross (with _construct_total_return_index_cross), either one
+        after another or split between several processes. The crosses are independent, so in parallel each process
+        attaches to the same market data, which is published once to shared memory.
+
+        Parameters
+        ----------
+        cross_fx : str(list)
+            Crosses to construct total return indices
+
+        market_df : DataFrame
+            Market data for all the crosses
+
+        run_in_parallel : bool
+            Split the crosses between several processes
+
+        thread_no : int
+            Number of processes (default - MarketConstants.fx_curve_thread_no)
+
+        kwargs : dict
+            Parameters for _construct_total_return_index_cross
+
+        Returns
+        -------
+        DataFrame(list)
+            Total return indices in the same order as cross_fx
+        """
+        logger = LoggerManager().getLogger(__name__)
+
+        if thread_no is None: thread_no = market_constants.fx_curve_thread_no[market_constants.generic_plat]
+
+        thread_no = max(min(thread_no, len(cross_fx)), 1)
+
+        if run_in_parallel and thread_no > 1:
+            logger.info("Constructing total return indices for " + str(len(cross_fx)) + " crosses in "
+                        + str(thread_no) + " processes")
+
+            swim_pool = SwimPool(multiprocessing_library=market_constants.multiprocessing_library)
+
+            pool = swim_pool.create_pool(thread_technique=market_constants.fx_curve_thread_technique,
+                                         thread_no=thread_no)
+
+            curve = self
+            shared_market_df = market_df
+            shared_list = []
+
+            try:
+                # With multiprocessing, every task is pickled, so only send a lightweight copy of the curve, and
+                # publish the market data (and any other large parameters) once to shared memory
+                if market_constants.fx_curve_thread_technique == "multiprocessing" and market_df is not None:
+                    curve = self._get_worker_curve()
+                    shared_market_df = SharedDataFrame(market_df)
+                    shared_list.append(shared_market_df)
+
+                    kwargs = self._get_kwargs_for_worker(kwargs, shared_list)
+
+                # Collect the results in the order of the crosses (not the order they finish)
+                results = [pool.apply_async(_construct_total_return_index_cross,
+                                            args=(curve, cross, shared_market_df, kwargs)) for cross in cross_fx]
+                results = [r.get() for r in results]
+            finally:
+                swim_pool.close_pool(pool, force_process_respawn=True)
+
+                # All the workers have finished with the market data
+                for shared in shared_list:
+                    shared.close()
+        else:
+            results = [_construct_total_return_index_cross(self, cross, market_df, kwargs) for cross in cross_fx]
+
+        self._cross_timing = pd.DataFrame({"time": [r[1] for r in results], "process": [r[2] for r in results]},
+                                          index=pd.Index(cross_fx, name="cross"))
+
+        for cross, t in zip(cross_fx, self._cross_timing["time"]):
+            logger.info("Constructed total return index for " + cross + " in " + str(round(t, 3)) + "s")
+
+        return [r[0] for r in results]
+
+    def _get_worker_curve(self):
+        """Gets a copy of the curve to send to the processes which construct each cross, without the attributes they
+        don't need (see _worker_excluded_attributes)
+
+        Returns
+        -------
+        AbstractCurve
+        """
+        curve = copy.copy(self)
+
+        for attr in self._worker_excluded_attributes:
+            if hasattr(curve, attr):
+                setattr(curve, attr, None)
+
+        return curve
+
+    def _get_kwargs_for_worker(self, kwargs, shared_list):
+        """Replaces any large parameters for _construct_total_return_index_cross (eg. a vol surface holding its own
+        market data) with lightweight handles to send to the processes which construct each cross, which are
+        turned back into the parameters there by _get_kwargs_from_worker
+
+        Parameters
+        ----------
+        kwargs : dict
+            Parameters for _construct_total_return_index_cross
+
+        shared_list : SharedDataFrame(list)
+            Any market data published to shared memory is added, so it can be closed when every cross is done
+
+        Returns
+        -------
+        dict
+        """
+        return kwargs
+
+    def _get_kwargs_from_worker(self, kwargs):
+        """Turns the parameters from _get_kwargs_for_worker back into the parameters for
+        _construct_total_return_index_cross (in the process which constructs the cross)
+
+        Parameters
+        ----------
+        kwargs : dict
+            Parameters from _get_kwargs_for_worker
+
+        Returns
+        -------
+        dict
+        """
+        return kwargs
+
+    def _get_via_currency_legs(self, tickers, construct_via_currency):
+        """Gets the legs we need to construct tickers via a currency (eg. AUDJPY via USD needs AUDUSD and JPYUSD),
+        with each leg only appearing once, however many tickers share it
+
+        Parameters
+        ----------
+        tickers : str(list)
+            Tickers to construct
+
+        construct_via_currency : str
+            Currency to construct the tickers via (eg. 'USD')
+
+        Returns
+        -------
+        str(list)
+        """
+        legs = []
+
+        for tick in tickers:
+            base = tick[0:3]
+            terms = tick[3:6]
+
+            # Special case for USDUSD, which we still need for the dates
+            if base == construct_via_currency and terms == construct_via_currency:
+                tick_legs = [base + construct_via_currency]
+            else:
+                tick_legs = [x + construct_via_currency for x in [base, terms] if x != construct_via_currency]
+
+            for leg in tick_legs:
+                if leg not in legs:
+                    legs.append(leg)
+
+        return legs
+
+    def _construct_via_currency_total_return_index(self, tickers, construct_via_currency, leg_df, postfix):
+        """Constructs total return indices for tickers via a currency, from the total return indices of their legs
+        (from _get_via_currency_legs), subtracting the returns of the terms leg from the base leg
+
+        Parameters
+        ----------
+        tickers : str(list)
+            Tickers to construct
+
+        construct_via_currency : str
+            Currency to construct the tickers via (eg. 'USD')
+
+        leg_df : DataFrame
+            Total return index of each leg (one column for each, starting with the name of the leg)
+
+        postfix : str
+            Postfix for the columns of the total return indices (eg. '-tot.close')
+
+        Returns
+        -------
+        DataFrame
+        """
+        # Returns of each leg are only calculated once
+        leg_rets_df = self._calculations.calculate_returns(leg_df)
+        leg_rets_df.columns = [x[0:6] for x in leg_df.columns]
+
+        fx_conv = FXConv()
+
+        def get_leg_rets(leg):
+            # Some legs are labelled in the correct convention (eg. USDJPY rather than JPYUSD)
+            if leg not in leg_rets_df.columns:
+                leg = fx_conv.correct_notation(leg)
+
+            return leg_rets_df[leg]
+
+        cross_rets = []
+
+        for tick in tickers:
+            base = tick[0:3]
+            terms = tick[3:6]
+
+            # Special case for USDUSD case (and if base or terms USD are USDUSD
+            if base + terms == construct_via_currency + construct_via_currency:
+                rets = pd.Series(0.0, index=leg_rets_df.index)
+            elif base + construct_via_currency == construct_via_currency + construct_via_currency:
+                rets = -get_leg_rets(terms + construct_via_currency)
+            elif terms + construct_via_currency == construct_via_currency + construct_via_currency:
+                rets = get_leg_rets(base + construct_via_currency).copy()
+            else:
+                rets = get_leg_rets(base + construct_via_currency) - get_leg_rets(terms + construct_via_currency)
+
+            # First returns of a time series will by NaN, given we don't know previous point
+            rets.iloc[0] = 0
+            rets.name = tick + postfix
+
+            cross_rets.append(rets)
+
+        return self._calculations.create_mult_index(pd.concat(cross_rets, axis=1))
@@ -19,20 +19,21 @@ __author__ = 'saeedamen'  # Saeed Amen
 import numpy as np
 import pandas as pd
 
-from pandas.tseries.offsets import CustomBusinessDay, CustomBusinessMonthEnd
-
 from findatapy.market import Market, MarketDataRequest
 from findatapy.timeseries import Calculations, Calendar, Filter
 from findatapy.util.dataconstants import DataConstants
 from findatapy.util.fxconv import FXConv
 
-from finmarketpy.curve.rates.fxforwardspricer import FXForwardsPricer
+from finmarketpy.curve.abstractcurve import AbstractCurve
+from finmarketpy.curve.rates.fxforwardspricer import FXForwardsPricer, QuotedDeliveryCache
+from finmarketpy.util.businesscalendar import BusinessDayCalendar
 from finmarketpy.util.marketconstants import MarketConstants
 
 data_constants = DataConstants()
 market_constants = MarketConstants()
 
-class FXForwardsCurve(object):
+
+class FXForwardsCurve(AbstractCurve):
     """Constructs continuous forwards time series total return indices from underlying forwards contracts.
 
     """
@@ -102,16 +103,23 @@ class FXForwardsCurve(object):
 
         self._field = field
 
+        # Roll schedules only depend on the calendar, so can be reused between calls
+        self._roll_schedule_cache = {}
+
+        self._cross_timing = None
+
     def generate_key(self):
         from findatapy.market.ioengine import SpeedCache
 
         # Don't include any "large" objects in the key
-        return SpeedCache().generate_key(self, ['_market_data_generator', '_calculations', '_calendar', '_filter'])
+        return SpeedCache().generate_key(self, ['_market_data_generator', '_calculations', '_calendar', '_filter',
+                                                '_roll_schedule_cache', '_cross_timing'])
 
     def fetch_continuous_time_series(self, md_request, market_data_generator, fx_forwards_trading_tenor=None,
                                      roll_days_before=None, roll_event=None,
                                      construct_via_currency=None, fx_forwards_tenor_for_interpolation=None, base_depos_tenor=None,
-                                     roll_months=None, cum_index=None, output_calculation_fields=False, field=None):
+                                     roll_months=None, cum_index=None, output_calculation_fields=False, field=None,
+                                     run_in_parallel=False, thread_no=None):
 
         if market_data_generator is None: market_data_generator = self._market_data_generator
         if fx_forwards_trading_tenor is None: fx_forwards_trading_tenor = self._fx_forwards_trading_tenor
@@ -153,67 +161,29 @@ class FXForwardsCurve(object):
                                                      roll_months=roll_months,
                                                      cum_index=cum_index,
                                                      output_calculation_fields=output_calculation_fields,
-                                                     field=field)
+                                                     field=field, run_in_parallel=run_in_parallel,
+                                                     thread_no=thread_no)
         else:
             # eg. we calculate via your domestic currency such as USD, so returns will be in your domestic currency
             # Hence AUDJPY would be calculated via AUDUSD and JPYUSD (subtracting the difference in returns)
-            total_return_indices = []
-
-            for tick in md_request.tickers:
-                base = tick[0:3]
-                terms = tick[3:6]
-
-                md_request_base = MarketDataRequest(md_request=md_request)
-                md_request_base.tickers = base + construct_via_currency
-
-                md_request_terms = MarketDataRequest(md_request=md_request)
-                md_request_terms.tickers = terms + construct_via_currency
-
-                # Construct the base and terms separately (ie. AUDJPY => AUDUSD & JPYUSD)
-                base_vals = self.fetch_continuous_time_series(md_request_base, market_data_generator,
-                                     fx_forwards_trading_tenor=fx_forwards_trading_tenor,
-                                     roll_days_before=roll_days_before, roll_event=roll_event,
-                                     fx_forwards_tenor_for_interpolation=fx_forwards_tenor_for_interpolation,
-                                     base_depos_tenor=base_depos_tenor,
-                                     roll_months=roll_months, output_calculation_fields=False,
-                                     cum_index=cum_index,
-                                     construct_via_currency='no',
-                                     field=field)
-
-                terms_vals = self.fetch_continuous_time_series(md_request_terms, market_data_generator,
-                                     fx_forwards_trading_tenor=fx_forwards_trading_tenor,
-                                     roll_days_before=roll_days_before, roll_event=roll_event,
-                                     fx_forwards_tenor_for_interpolation=fx_forwards_tenor_for_interpolation,
-                                     base_depos_tenor=base_depos_tenor,
-                                     roll_months=roll_months,
-                                     cum_index=cum_index,
-                                     output_calculation_fields=False,
-                                     construct_via_currency='no',
-                                     field=field)
-
-                # Special case for USDUSD case (and if base or terms USD are USDUSD
-                if base + terms == construct_via_currency + construct_via_currency:
-                    base_rets = self._calculations.calculate_returns(base_vals)
-                    cross_rets = pd.DataFrame(0, index=base_rets.index, columns=base_rets.columns)
-                elif base + construct_via_currency == construct_via_currency + construct_via_currency:
-                    cross_rets = -self._calculations.calculate_returns(terms_vals)
-                elif terms + construct_via_currency == construct_via_currency + construct_via_currency:
-                    cross_rets = self._calculations.calculate_returns(base_vals)
-                else:
-                    base_rets = self._calculations.calculate_returns(base_vals)
-                    terms_rets = self._calculations.calculate_returns(terms_vals)
-
-                    cross_rets = base_rets.sub(terms_rets.iloc[:, 0], axis=0)
-
-                # First returns of a time series will by NaN, given we don't know previous point
-                cross_rets.iloc[0] = 0
-
-                cross_vals = self._calculations.create_mult_index(cross_rets)
-                cross_vals.columns = [tick + '-forward-tot.' + field]
-
-                total_return_indices.append(cross_vals)
-
-            return self._calculations.join(total_return_indices, how='outer')
+            # Each leg is fetched and constructed only once (and all in one go), however many tickers share it
+            md_request_legs = MarketDataRequest(md_request=md_request)
+            md_request_legs.tickers = self._get_via_currency_legs(md_request.tickers, construct_via_currency)
+
+            leg_df = self.fetch_continuous_time_series(md_request_legs, market_data_generator,
+                                                       fx_forwards_trading_tenor=fx_forwards_trading_tenor,
+                                                       roll_days_before=roll_days_before, roll_event=roll_event,
+                                                       fx_forwards_tenor_for_interpolation=fx_forwards_tenor_for_interpolation,
+                                                       base_depos_tenor=base_depos_tenor,
+                                                       roll_months=roll_months, output_calculation_fields=False,
+                                                       cum_index=cum_index,
+                                                       construct_via_currency='no',
+                                                       field=field,
+                                                       run_in_parallel=run_in_parallel,
+                                                       thread_no=thread_no)
+
+            return self._construct_via_currency_total_return_index(md_request.tickers, construct_via_currency, leg_df,
+                                                                   '-forward-tot.' + field)
 
     def unhedged_asset_fx(self, assets_df, asset_currency, home_curr, start_date, finish_date, spot_df=None):
         pass
@@ -236,7 +206,9 @@ class FXForwardsCurve(object):
                                      fx_forwards_tenor_for_interpolation=None,
                                      cum_index=None,
                                      output_calculation_fields=None,
-                                     field=None):
+                                     field=None,
+                                     run_in_parallel=False,
+                                     thread_no=None):
 
         if not (isinstance(cross_fx, list)):
             cross_fx = [cross_fx]
@@ -249,121 +221,219 @@ class FXForwardsCurve(object):
         if cum_index is None: cum_index = self._cum_index
         if field is None: field = self._field
 
-        total_return_index_df_agg = []
-
         # Remove columns where there is no data (because these points typically aren't quoted)
         forwards_market_df = forwards_market_df.dropna(how='all', axis=1)
 
+        # Each cross is independent, so they can be constructed in parallel
+        total_return_index_df_agg = self._construct_total_return_index_crosses(
+            cross_fx, forwards_market_df, run_in_parallel=run_in_parallel, thread_no=thread_no,
+            fx_forwards_trading_tenor=fx_forwards_trading_tenor, roll_days_before=roll_days_before,
+            roll_event=roll_event, roll_months=roll_months,
+            fx_forwards_tenor_for_interpolation=fx_forwards_tenor_for_interpolation, cum_index=cum_index,
+            output_calculation_fields=output_calculation_fields, field=field)
+
+        return self._calculations.join(total_return_index_df_agg, how='outer')
+
+    def _construct_total_return_index_cross(self, cross, forwards_market_df, fx_forwards_trading_tenor=None,
+                                            roll_days_before=None, roll_event=None, roll_months=None,
+                                            fx_forwards_tenor_for_interpolation=None, cum_index=None,
+                                            output_calculation_fields=None, field=None):
+
         fx_forwards_pricer = FXForwardsPricer()
 
-        def get_roll_date(horizon_d, delivery_d, asset_hols, month_adj=1):
-            if roll_event == 'month-end':
-                roll_d = horizon_d + CustomBusinessMonthEnd(roll_months + month_adj, holidays=asset_hols)
-            elif roll_event == 'delivery-date':
-                roll_d = delivery_d
+        # Eg. if we specify USDUSD
+        if cross[0:3] == cross[3:6]:
+            return pd.DataFrame(100, index=forwards_market_df.index, columns=[cross + "-forward-tot.close"])
+        else:
+            # Is the FX cross in the correct convention
+            old_cross = cross
+            cross = FXConv().correct_notation(cross)
+
+            horizon_date = forwards_market_df.index
+
+            # Get all the delivery dates and roll dates, and when we enter a new trade/contract
+            roll_schedule_df = self.construct_roll_schedule(cross, horizon_date,
+                                                            fx_forwards_trading_tenor=fx_forwards_trading_tenor,
+                                                            roll_days_before=roll_days_before,
+                                                            roll_event=roll_event, roll_months=roll_months)
+
+            new_trade = roll_schedule_df[cross + '-roll.close'].values
+            roll_date = pd.DatetimeIndex(roll_schedule_df[cross + '.roll-date'])
+            delivery_date = pd.DatetimeIndex(roll_schedule_df[cross + '.delivery-date'])
+
+            # The delivery dates of the quoted forwards are the same whichever contract we're pricing, so only
+            # generate them once for all the horizon dates
+            quoted_delivery_df = fx_forwards_pricer.generate_quoted_delivery(cross, forwards_market_df, None,
+                                                                             fx_forwards_tenor_for_interpolation,
+                                                                             cross)
+
+            interpolated_forward = fx_forwards_pricer.price_instrument(cross, horizon_date, delivery_date,
+                market_df=forwards_market_df, quoted_delivery_df=quoted_delivery_df,
+                fx_forwards_tenor_for_interpolation=fx_forwards_tenor_for_interpolation, return_as_df=False)
+
+            # To record MTM prices
+            mtm = np.copy(interpolated_forward)
+
+            # Note: may need to add discount factor when marking to market forwards?
+
+            # Special case: for very first trading day
+            # mtm[0] = interpolated_forward[0]
+
+            # On rolling dates, MTM will be the previous forward contract (interpolated)
+            # otherwise it will be the current forward contract, price all the rolled out contracts in one go
+            roll_ind = np.flatnonzero(new_trade[1:]) + 1
+
+            if len(roll_ind) > 0:
+                mtm[roll_ind] = fx_forwards_pricer.price_instrument(cross, horizon_date[roll_ind],
+                    delivery_date[roll_ind - 1], market_df=forwards_market_df,
+                    quoted_delivery_df=quoted_delivery_df,
+                    fx_forwards_tenor_for_interpolation=fx_forwards_tenor_for_interpolation, return_as_df=False)
+
+            # Eg. if we asked for USDEUR, we first constructed spot/forwards for EURUSD
+            # and then need to invert it
+            if old_cross != cross:
+                mtm = 1.0 / mtm
+                interpolated_forward = 1.0 / interpolated_forward
+
+            forward_rets = mtm / np.roll(interpolated_forward, 1) - 1.0
+            forward_rets[0] = 0
+
+            if cum_index == 'mult':
+                cum_rets = 100 * np.cumprod(1.0 + forward_rets)
+            elif cum_index == 'add':
+                cum_rets = 100 + 100 * np.cumsum(forward_rets)
+
+            total_return_index_df = pd.DataFrame(index=horizon_date, columns=[cross + "-forward-tot." + field])
+            total_return_index_df[cross + "-forward-tot." + field] = cum_rets
+
+            if output_calculation_fields:
+                total_return_index_df[cross + '-interpolated-outright-forward.' + field] = interpolated_forward
+                total_return_index_df[cross + '-mtm.close'] = mtm
+                total_return_index_df[cross + '-roll.close'] = new_trade
+                total_return_index_df[cross + '.roll-date'] = roll_date
+                total_return_index_df[cross + '.delivery-date'] = delivery_date
+                total_return_index_df[cross + '-forward-return.' + field] = forward_rets
+
+            return total_return_index_df
+
+    def construct_roll_schedule(self, cross, horizon_date,
+                                fx_forwards_trading_tenor=None,
+                                roll_days_before=None,
+                                roll_event=None,
+                                roll_months=None):
+        """Calculates when we should roll into a new forward contract, and the delivery date and roll date of the
+        contract we are holding, for every horizon date.
+
+        We enter a new contract at the start and whenever the horizon date reaches the roll date of the contract
+        we're holding. The roll dates are computed for all the horizon dates at once (rather than one by one at each
+        roll), and the delivery dates are computed in one go for all the trades, and cached for each cross and tenor.
 
-            return (roll_d - CustomBusinessDay(n=roll_days_before, holidays=asset_hols))
+        Parameters
+        ----------
+        cross : str
+            Currency pair (in correct convention)
 
-        for cross in cross_fx:
+        horizon_date : DateTimeIndex
+            Horizon dates (sorted)
 
-            # Eg. if we specify USDUSD
-            if cross[0:3] == cross[3:6]:
-                total_return_index_df_agg.append(
-                    pd.DataFrame(100, index=forwards_market_df.index, columns=[cross + "-forward-tot.close"]))
-            else:
-                # Is the FX cross in the correct convention
-                old_cross = cross
-                cross = FXConv().correct_notation(cross)
+        fx_forwards_trading_tenor : str
+            What is primary forward contract being used to trade (default - '1M')
+
+        roll_days_before : int
+            Number of days before roll event to enter into a new forwards contract
 
-                horizon_date = forwards_market_df.index
+        roll_event : str
+            What constitutes a roll event? ('month-end', 'delivery-date')
 
-                delivery_date = []
-                roll_date = []
+        roll_months : int
+            After how many months should we initiate a roll
 
-                new_trade = np.full(len(horizon_date), False, dtype=bool)
+        Returns
+        -------
+        DataFrame
+        """
+        if fx_forwards_trading_tenor is None: fx_forwards_trading_tenor = self._fx_forwards_trading_tenor
+        if roll_days_before is None: roll_days_before = self._roll_days_before
+        if roll_event is None: roll_event = self._roll_event
+        if roll_months is None: roll_months = self._roll_months
 
-                asset_holidays = self._calendar.get_holidays(cal=cross)
+        horizon_date = pd.DatetimeIndex(horizon_date)
 
-                # Get first delivery date
-                delivery_date.append(
-                    self._calendar.get_delivery_date_from_horizon_date(horizon_date[0],
-                        fx_forwards_trading_tenor, cal=cross, asset_class='fx')[0])
+        key = (cross, fx_forwards_trading_tenor, roll_days_before, roll_event, roll_months)
 
-                # For first month want it to expire within that month (for consistency), hence month_adj=0 ONLY here
-                roll_date.append(get_roll_date(horizon_date[0], delivery_date[0], asset_holidays, month_adj=0))
+        if key in self._roll_schedule_cache:
+            roll_schedule_df = self._roll_schedule_cache[key]
 
-                # New trade => entry at beginning AND on every roll
-                new_trade[0] = True
+            if roll_schedule_df.index.equals(horizon_date):
+                return roll_schedule_df.copy()
 
-                # Get all the delivery dates and roll dates
-                # At each "roll/trade" day we need to reset them for the new contract
-                for i in range(1, len(horizon_date)):
+        business_day_calendar = BusinessDayCalendar.get(cross, calendar=self._calendar)
 
-                    # If the horizon date has reached the roll date (from yesterday), we're done, and we have a
-                    # new roll/trade
-                    if (horizon_date[i] - roll_date[i-1]).days == 0:
-                        new_trade[i] = True
-                    # else:
-                    #    new_trade[i] = False
+        def get_roll_date(horizon_d, delivery_d, month_adj=1):
+            if roll_event == 'month-end':
+                roll_d = business_day_calendar.business_month_end_offset(horizon_d, roll_months + month_adj)
+            elif roll_event == 'delivery-date':
+                roll_d = delivery_d
+            else:
+                raise ValueError("roll_event must be month-end or delivery-date")
 
-                    # If we're entering a new trade/contract, we need to get new delivery and roll dates
-                    if new_trade[i]:
-                        delivery_date.append(self._calendar.get_delivery_date_from_horizon_date(horizon_date[i],
-                            fx_forwards_trading_tenor, cal=cross, asset_class='fx')[0])
+            return business_day_calendar.business_day_offset(roll_d, -roll_days_before)
 
-                        roll_date.append(get_roll_date(horizon_date[i], delivery_date[i], asset_holidays))
-                    else:
-                        # Otherwise use previous delivery and roll dates, because we're still holding same contract
-                        delivery_date.append(delivery_date[i-1])
-                        roll_date.append(roll_date[i-1])
+        # Candidate roll dates, if we were to enter a new trade on every horizon date
+        if roll_event == 'delivery-date':
+            all_delivery_date = self._get_delivery_date(cross, horizon_date, fx_forwards_trading_tenor)
+            all_roll_date = get_roll_date(horizon_date, all_delivery_date)
+        else:
+            all_delivery_date = None
+            all_roll_date = get_roll_date(horizon_date, None)
 
-                interpolated_forward = fx_forwards_pricer.price_instrument(cross, horizon_date, delivery_date, market_df=forwards_market_df,
-                         fx_forwards_tenor_for_interpolation=fx_forwards_tenor_for_interpolation)[cross + '-interpolated-outright-forward.' + field].values
+        # For first month want it to expire within that month (for consistency), hence month_adj=0 ONLY here
+        first_roll_date = get_roll_date(horizon_date[0:1], None if all_delivery_date is None
+                                        else all_delivery_date[0:1], month_adj=0)
 
-                # To record MTM prices
-                mtm = np.copy(interpolated_forward)
+        horizon_ns = horizon_date.asi8
+        all_roll_ns = all_roll_date.asi8
+        one_day_ns = pd.Timedelta(days=1).value
 
-                # Note: may need to add discount factor when marking to market forwards?
+        # New trade => entry at beginning AND on every roll, which is the first horizon date which falls on the
+        # roll date of the previous trade (if there's no such date, we keep holding the same contract)
+        trade_ind = [0]
+        roll_ns = first_roll_date.asi8[0]
 
-                # Special case: for very first trading day
-                # mtm[0] = interpolated_forward[0]
+        while True:
+            i = max(np.searchsorted(horizon_ns, roll_ns), trade_ind[-1] + 1)
 
-                # On rolling dates, MTM will be the previous forward contract (interpolated)
-                # otherwise it will be the current forward contract
-                for i in range(1, len(horizon_date)):
-                    if new_trade[i]:
-                        mtm[i] = fx_forwards_pricer.price_instrument(cross, horizon_date[i], delivery_date[i-1],
-                            market_df=forwards_market_df,
-                            fx_forwards_tenor_for_interpolation=fx_forwards_tenor_for_interpolation) \
-                                [cross + '-interpolated-outright-forward.' + field].values
-                    # else:
-                    #    mtm[i] = interpolated_forward[i]
+            if i >= len(horizon_ns) or horizon_ns[i] - roll_ns >= one_day_ns:
+                break
 
-                # Eg. if we asked for USDEUR, we first constructed spot/forwards for EURUSD
-                # and then need to invert it
-                if old_cross != cross:
-                    mtm = 1.0 / mtm
-                    interpolated_forward = 1.0 / interpolated_forward
+            trade_ind.append(i)
+            roll_ns = all_roll_ns[i]
 
-                forward_rets = mtm / np.roll(interpolated_forward, 1) - 1.0
-                forward_rets[0] = 0
+        trade_ind = np.array(trade_ind)
 
-                if cum_index == 'mult':
-                    cum_rets = 100 * np.cumprod(1.0 + forward_rets)
-                elif cum_index == 'add':
-                    cum_rets = 100 + 100 * np.cumsum(forward_rets)
+        new_trade = np.full(len(horizon_date), False, dtype=bool)
+        new_trade[trade_ind] = True
 
-                total_return_index_df = pd.DataFrame(index=horizon_date, columns=[cross + "-forward-tot." + field])
-                total_return_index_df[cross + "-forward-tot." + field] = cum_rets
+        # Get the delivery dates only for the trades (in one batch)
+        if all_delivery_date is None:
+            trade_delivery_date = self._get_delivery_date(cross, horizon_date[trade_ind], fx_forwards_trading_tenor)
+        else:
+            trade_delivery_date = all_delivery_date[trade_ind]
 
-                if output_calculation_fields:
-                    total_return_index_df[cross + '-interpolated-outright-forward.' + field] = interpolated_forward
-                    total_return_index_df[cross + '-mtm.close'] = mtm
-                    total_return_index_df[cross + '-roll.close'] = new_trade
-                    total_return_index_df[cross + '.roll-date'] = roll_date
-                    total_return_index_df[cross + '.delivery-date'] = delivery_date
-                    total_return_index_df[cross + '-forward-return.' + field] = forward_rets
+        trade_roll_date = first_roll_date.append(all_roll_date[trade_ind[1:]])
 
-                total_return_index_df_agg.append(total_return_index_df)
+        # Otherwise use previous delivery and roll dates, because we're still holding same contract
+        trade_no = np.cumsum(new_trade) - 1
 
-        return self._calculations.join(total_return_index_df_agg, how='outer')
+        roll_schedule_df = pd.DataFrame({cross + '-roll.close': new_trade,
+                                         cross + '.roll-date': trade_roll_date[trade_no],
+                                         cross + '.delivery-date': trade_delivery_date[trade_no]},
+                                        index=horizon_date)
+
+        self._roll_schedule_cache[key] = roll_schedule_df
+
+        return roll_schedule_df.copy()
+
+    def _get_delivery_date(self, cross, horizon_date, tenor):
+        # Uses the same process wide cache as the quoted forwards, so only calculates dates we haven't seen before
+        return QuotedDeliveryCache().get_delivery_date(cross, horizon_date, tenor, cal=cross, calendar=self._calendar)
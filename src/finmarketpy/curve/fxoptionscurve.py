@@ -18,26 +18,30 @@ __author__ = 'saeedamen'  # Saeed Amen
 import numpy as np
 import pandas as pd
 
-from pandas.tseries.offsets import CustomBusinessDay, CustomBusinessMonthEnd
-
 from findatapy.market import Market, MarketDataRequest
 from findatapy.timeseries import Calculations, Calendar, Filter
 from findatapy.util.dataconstants import DataConstants
 from findatapy.util.fxconv import FXConv
 
+from finmarketpy.curve.abstractcurve import AbstractCurve
 from finmarketpy.curve.volatility.fxoptionspricer import FXOptionsPricer
-from finmarketpy.curve.volatility.fxvolsurface import FXVolSurface
+from finmarketpy.curve.volatility.fxvolsurface import FXVolSurface, _SharedFXVolSurface
+from finmarketpy.util.businesscalendar import BusinessDayCalendar
 from finmarketpy.util.marketconstants import MarketConstants
 
 data_constants = DataConstants()
 market_constants = MarketConstants()
 
 
-class FXOptionsCurve(object):
+class FXOptionsCurve(AbstractCurve):
     """Constructs continuous forwards time series total return indices from underlying forwards contracts.
 
     """
 
+    # The vol surface holds its own copy of the market data, so it isn't sent to the processes which construct each
+    # cross (they create it again from shared memory, see _get_kwargs_for_worker)
+    _worker_excluded_attributes = AbstractCurve._worker_excluded_attributes + ['_fx_vol_surface']
+
     def __init__(self, market_data_generator=None,
                  fx_vol_surface=None,
                  enter_trading_dates=None,
@@ -137,13 +141,15 @@ class FXOptionsCurve(object):
 
         self._output_calculation_fields = output_calculation_fields
 
+        self._cross_timing = None
+
     def generate_key(self):
         from findatapy.market.ioengine import SpeedCache
 
         # Don't include any "large" objects in the key
         return SpeedCache().generate_key(self, ['_market_data_generator',
                                                 '_calculations', '_calendar',
-                                                '_filter'])
+                                                '_filter', '_cross_timing'])
 
     def fetch_continuous_time_series(self, md_request, market_data_generator,
                                      fx_vol_surface=None,
@@ -160,7 +166,9 @@ class FXOptionsCurve(object):
                                      depo_tenor_for_option=None,
                                      freeze_implied_vol=None,
                                      tot_label=None, cal=None,
-                                     output_calculation_fields=None):
+                                     output_calculation_fields=None,
+                                     run_in_parallel=False,
+                                     thread_no=None):
 
         if fx_vol_surface is None: fx_vol_surface = self._fx_vol_surface
         if enter_trading_dates is None: enter_trading_dates = self._enter_trading_dates
@@ -232,7 +240,9 @@ class FXOptionsCurve(object):
                                                      depo_tenor_for_option=depo_tenor_for_option,
                                                      tot_label=tot_label,
                                                      cal=cal,
-                                                     output_calculation_fields=output_calculation_fields)
+                                                     output_calculation_fields=output_calculation_fields,
+                                                     run_in_parallel=run_in_parallel,
+                                                     thread_no=thread_no)
         else:
             # eg. we calculate via your domestic currency such as USD, so returns will be in your domestic currency
             # Hence AUDJPY would be calculated via AUDUSD and JPYUSD (subtracting the difference in returns)
@@ -348,7 +358,9 @@ class FXOptionsCurve(object):
                                      depo_tenor_for_option=None,
                                      tot_label=None,
                                      cal=None,
-                                     output_calculation_fields=None):
+                                     output_calculation_fields=None,
+                                     run_in_parallel=False,
+                                     thread_no=None):
 
         if fx_vol_surface is None: fx_vol_surface = self._fx_vol_surface
         if enter_trading_dates is None: enter_trading_dates = self._enter_trading_dates
@@ -374,389 +386,448 @@ class FXOptionsCurve(object):
         if not (isinstance(cross_fx, list)):
             cross_fx = [cross_fx]
 
-        total_return_index_df_agg = []
-
         # Remove columns where there is no data (because these vols typically aren't quoted)
         if market_df is not None:
             market_df = market_df.dropna(how='all', axis=1)
 
-        fx_options_pricer = FXOptionsPricer(premium_output=premium_output)
+        # Each cross is independent, so they can be constructed in parallel
+        total_return_index_df_agg = self._construct_total_return_index_crosses(
+            cross_fx, market_df, run_in_parallel=run_in_parallel, thread_no=thread_no, fx_vol_surface=fx_vol_surface,
+            enter_trading_dates=enter_trading_dates, fx_options_trading_tenor=fx_options_trading_tenor,
+            roll_days_before=roll_days_before, roll_event=roll_event, roll_months=roll_months, cum_index=cum_index,
+            strike=strike, contract_type=contract_type, premium_output=premium_output,
+            position_multiplier=position_multiplier,
+            fx_options_tenor_for_interpolation=fx_options_tenor_for_interpolation,
+            freeze_implied_vol=freeze_implied_vol, depo_tenor_for_option=depo_tenor_for_option, tot_label=tot_label,
+            cal=cal, output_calculation_fields=output_calculation_fields)
 
-        def get_roll_date(horizon_d, expiry_d, asset_hols, month_adj=0):
-            if roll_event == 'month-end':
-                roll_d = horizon_d + CustomBusinessMonthEnd(
-                    roll_months + month_adj, holidays=asset_hols)
+        return self._calculations.join(total_return_index_df_agg, how='outer')
 
-                # Special case so always rolls on month end date, if specify 0 days
-                if roll_days_before > 0:
-                    return (roll_d - CustomBusinessDay(n=roll_days_before,
-                                                       holidays=asset_hols))
+    def _get_kwargs_for_worker(self, kwargs, shared_list):
+        # Publish the vol surface's market data once, rather than pickling the vol surface for every cross
+        if isinstance(kwargs.get('fx_vol_surface'), FXVolSurface):
+            shared_fx_vol_surface = _SharedFXVolSurface(kwargs['fx_vol_surface'])
+            shared_list.append(shared_fx_vol_surface)
 
-            elif roll_event == 'expiry-date':
-                roll_d = expiry_d
+            kwargs = dict(kwargs, fx_vol_surface=shared_fx_vol_surface)
 
-                # Special case so always rolls on expiry date, if specify 0 days
-                if roll_days_before > 0:
-                    return (roll_d - CustomBusinessDay(n=roll_days_before,
-                                                       holidays=asset_hols))
+        return kwargs
 
-            return roll_d
+    def _get_kwargs_from_worker(self, kwargs):
+        if isinstance(kwargs.get('fx_vol_surface'), _SharedFXVolSurface):
+            kwargs = dict(kwargs, fx_vol_surface=kwargs['fx_vol_surface'].get_fx_vol_surface())
 
-        for cross in cross_fx:
+        return kwargs
 
-            if cal is None:
-                cal = cross
+    def _construct_total_return_index_cross(self, cross, market_df, fx_vol_surface=None, enter_trading_dates=None,
+                                            fx_options_trading_tenor=None, roll_days_before=None, roll_event=None,
+                                            roll_months=None, cum_index=None, strike=None, contract_type=None,
+                                            premium_output=None, position_multiplier=None,
+                                            fx_options_tenor_for_interpolation=None, freeze_implied_vol=None,
+                                            depo_tenor_for_option=None, tot_label=None, cal=None,
+                                            output_calculation_fields=None):
 
-            # Eg. if we specify USDUSD
-            if cross[0:3] == cross[3:6]:
-                total_return_index_df_agg.append(
-                    pd.DataFrame(100, index=market_df.index,
-                                 columns=[cross + "-option-tot.close"]))
-            else:
-                # Is the FX cross in the correct convention
-                old_cross = cross
-
-                cross = FXConv().correct_notation(cross)
-
-                # TODO also specification of non-standard crosses like USDGBP
-                if old_cross != cross:
-                    pass
-
-                if fx_vol_surface is None:
-                    fx_vol_surface = FXVolSurface(market_df=market_df,
-                                                  asset=cross,
-                                                  tenors=fx_options_tenor_for_interpolation,
-                                                  depo_tenor=depo_tenor_for_option)
-
-                    market_df = fx_vol_surface.get_all_market_data()
-
-                horizon_date = market_df.index
-
-                expiry_date = np.zeros(len(horizon_date), dtype=object)
-                roll_date = np.zeros(len(horizon_date), dtype=object)
-
-                new_trade = np.full(len(horizon_date), False, dtype=bool)
-                exit_trade = np.full(len(horizon_date), False, dtype=bool)
-                has_position = np.full(len(horizon_date), False, dtype=bool)
-
-                asset_holidays = self._calendar.get_holidays(cal=cross)
-
-                # If no entry dates specified, assume we just keep rolling
-                if enter_trading_dates is None:
-                    # Get first expiry date
-                    expiry_date[0] = \
-                    self._calendar.get_expiry_date_from_horizon_date(
-                        pd.DatetimeIndex([horizon_date[0]]),
-                        fx_options_trading_tenor, cal=cal,
-                        asset_class='fx-vol')[0]
-
-                    # For first month want it to expire within that month (for consistency), hence month_adj=0 ONLY here
-                    roll_date[0] = get_roll_date(horizon_date[0],
-                                                 expiry_date[0],
-                                                 asset_holidays, month_adj=0)
-
-                    # New trade => entry at beginning AND on every roll
-                    new_trade[0] = True
-                    exit_trade[0] = False
-                    has_position[0] = True
-
-                    # Get all the expiry dates and roll dates
-                    # At each "roll/trade" day we need to reset them for the new contract
-                    for i in range(1, len(horizon_date)):
-                        has_position[i] = True
-
-                        # If the horizon date has reached the roll date (from yesterday), we're done, and we have a
-                        # new roll/trade
-                        if (horizon_date[i] - roll_date[i - 1]).days >= 0:
-                            new_trade[i] = True
-                        else:
-                            new_trade[i] = False
-
-                        # If we're entering a new trade/contract (and exiting an old trade) we need to get new expiry and roll dates
-                        if new_trade[i]:
-                            exp = \
-                            self._calendar.get_expiry_date_from_horizon_date(
-                                pd.DatetimeIndex([horizon_date[i]]),
-                                fx_options_trading_tenor, cal=cal,
-                                asset_class='fx-vol')[0]
-
-                            # Make sure we don't expire on a date in the history where there isn't market data
-                            # It is ok for future values to expire after market data (just not in the backtest!)
-                            if exp not in market_df.index:
-                                exp_index = market_df.index.searchsorted(exp)
-
-                                if exp_index < len(market_df.index):
-                                    exp_index = min(exp_index,
-                                                    len(market_df.index))
-
-                                    exp = market_df.index[exp_index]
-
-                            expiry_date[i] = exp
-
-                            roll_date[i] = get_roll_date(horizon_date[i],
-                                                         expiry_date[i],
-                                                         asset_holidays)
-                            exit_trade[i] = True
-                        else:
-                            if horizon_date[i] <= expiry_date[i - 1]:
-                                # Otherwise use previous expiry and roll dates, because we're still holding same contract
-                                expiry_date[i] = expiry_date[i - 1]
-                                roll_date[i] = roll_date[i - 1]
-                                exit_trade[i] = False
-                            else:
-                                exit_trade[i] = True
-                else:
-                    new_trade[
-                        horizon_date.searchsorted(enter_trading_dates)] = True
-                    has_position[
-                        horizon_date.searchsorted(enter_trading_dates)] = True
-
-                    # Get first expiry date
-                    # expiry_date[0] = \
-                    #    self._calendar.get_expiry_date_from_horizon_date(pd.DatetimeIndex([horizon_date[0]]),
-                    #                                                     fx_options_trading_tenor, cal=cal,
-                    #                                                     asset_class='fx-vol')[0]
-
-                    # For first month want it to expire within that month (for consistency), hence month_adj=0 ONLY here
-                    # roll_date[0] = get_roll_date(horizon_date[0], expiry_date[0], asset_holidays, month_adj=0)
-
-                    # New trade => entry at beginning AND on every roll
-                    # new_trade[0] = True
-                    # exit_trade[0] = False
-                    # has_position[0] = True
-
-                    # Get all the expiry dates and roll dates
-                    # At each "roll/trade" day we need to reset them for the new contract
-                    for i in range(0, len(horizon_date)):
-
-                        # If we're entering a new trade/contract (and exiting an old trade) we need to get new expiry and roll dates
-                        if new_trade[i]:
-                            exp = \
-                                self._calendar.get_expiry_date_from_horizon_date(
-                                    pd.DatetimeIndex([horizon_date[i]]),
-                                    fx_options_trading_tenor, cal=cal,
-                                    asset_class='fx-vol')[0]
-
-                            # Make sure we don't expire on a date in the history where there isn't market data
-                            # It is ok for future values to expire after market data (just not in the backtest!)
-                            if exp not in market_df.index:
-                                exp_index = market_df.index.searchsorted(exp)
-
-                                if exp_index < len(market_df.index):
-                                    exp_index = min(exp_index,
-                                                    len(market_df.index))
-
-                                    exp = market_df.index[exp_index]
-
-                            expiry_date[i] = exp
-
-                            # roll_date[i] = get_roll_date(horizon_date[i], expiry_date[i], asset_holidays)
-                            # if i > 0:
-                            # Makes the assumption we aren't rolling contracts
-                            exit_trade[i] = False
-                        else:
-                            if i > 0:
-                                # Check there's valid expiry on previous day (if not then we're not in an option trade here!)
-                                if expiry_date[i - 1] == 0:
-                                    has_position[i] = False
-                                else:
-                                    if horizon_date[i] <= expiry_date[i - 1]:
-                                        # Otherwise use previous expiry and roll dates, because we're still holding same contract
-                                        expiry_date[i] = expiry_date[i - 1]
-                                        # roll_date[i] = roll_date[i - 1]
-                                        has_position[i] = True
-
-                                    if horizon_date[i] == expiry_date[i]:
-                                        exit_trade[i] = True
-                                    else:
-                                        exit_trade[i] = False
-
-                # Note: may need to add discount factor when marking to market option
-
-                mtm = np.zeros(len(horizon_date))
-                calculated_strike = np.zeros(len(horizon_date))
-                interpolated_option = np.zeros(len(horizon_date))
-                implied_vol = np.zeros(len(horizon_date))
-                delta = np.zeros(len(horizon_date))
-
-                # For debugging
-                df_temp = pd.DataFrame()
-
-                df_temp['expiry-date'] = expiry_date
-                df_temp['horizon-date'] = horizon_date
-                df_temp['roll-date'] = roll_date
-                df_temp['new-trade'] = new_trade
-                df_temp['exit-trade'] = exit_trade
-                df_temp['has-position'] = has_position
-
-                if has_position[0]:
-                    # Special case: for first day of history (given have no previous positions)
+        fx_options_pricer = FXOptionsPricer(premium_output=premium_output)
+
+        if cal is None:
+            cal = cross
+
+        # Eg. if we specify USDUSD
+        if cross[0:3] == cross[3:6]:
+            return pd.DataFrame(100, index=market_df.index,
+                                columns=[cross + "-option-tot.close"])
+        else:
+            # Is the FX cross in the correct convention
+            old_cross = cross
+
+            cross = FXConv().correct_notation(cross)
+
+            # TODO also specification of non-standard crosses like USDGBP
+            if old_cross != cross:
+                pass
+
+            if fx_vol_surface is None:
+                fx_vol_surface = FXVolSurface(market_df=market_df,
+                                              asset=cross,
+                                              tenors=fx_options_tenor_for_interpolation,
+                                              depo_tenor=depo_tenor_for_option)
+
+                market_df = fx_vol_surface.get_all_market_data()
+
+            horizon_date = market_df.index
+
+            roll_schedule_df = self.construct_roll_schedule(cross, horizon_date,
+                                                            enter_trading_dates=enter_trading_dates,
+                                                            fx_options_trading_tenor=fx_options_trading_tenor,
+                                                            roll_days_before=roll_days_before,
+                                                            roll_event=roll_event, roll_months=roll_months,
+                                                            cal=cal)
+
+            expiry_date = roll_schedule_df[cross + '.expiry-date'].values
+            roll_date = roll_schedule_df[cross + '.roll-date'].values
+
+            new_trade = roll_schedule_df[cross + '-new-trade.close'].values
+            exit_trade = roll_schedule_df[cross + '-exit-trade.close'].values
+            has_position = roll_schedule_df[cross + '-has-position.close'].values
+
+            # Note: may need to add discount factor when marking to market option
+
+            mtm = np.zeros(len(horizon_date))
+            calculated_strike = np.zeros(len(horizon_date))
+            interpolated_option = np.zeros(len(horizon_date))
+            implied_vol = np.zeros(len(horizon_date))
+            delta = np.zeros(len(horizon_date))
+
+            # For debugging
+            df_temp = pd.DataFrame()
+
+            df_temp['expiry-date'] = expiry_date
+            df_temp['horizon-date'] = horizon_date
+            df_temp['roll-date'] = roll_date
+            df_temp['new-trade'] = new_trade
+            df_temp['exit-trade'] = exit_trade
+            df_temp['has-position'] = has_position
+
+            if has_position[0]:
+                # Special case: for first day of history (given have no previous positions)
+                option_values_, spot_, strike_, vol_, delta_, expiry_date_, intrinsic_values_ = \
+                    fx_options_pricer.price_instrument(cross,
+                                                       horizon_date[0],
+                                                       strike,
+                                                       expiry_date[0],
+                                                       contract_type=contract_type,
+                                                       tenor=fx_options_trading_tenor,
+                                                       fx_vol_surface=fx_vol_surface,
+                                                       return_as_df=False)
+
+                interpolated_option[0] = option_values_
+                calculated_strike[0] = strike_
+                implied_vol[0] = vol_
+
+            mtm[0] = 0
+
+            # Now price options for rest of history
+            # On rolling dates: MTM will be the previous option contract (interpolated)
+            # On non-rolling dates: it will be the current option contract
+            for i in range(1, len(horizon_date)):
+                if exit_trade[i]:
+                    # Price option trade being exited
                     option_values_, spot_, strike_, vol_, delta_, expiry_date_, intrinsic_values_ = \
                         fx_options_pricer.price_instrument(cross,
-                                                           horizon_date[0],
+                                                           horizon_date[i],
+                                                           calculated_strike[
+                                                               i - 1],
+                                                           expiry_date[
+                                                               i - 1],
+                                                           contract_type=contract_type,
+                                                           tenor=fx_options_trading_tenor,
+                                                           fx_vol_surface=fx_vol_surface,
+                                                           return_as_df=False)
+
+                    # Store as MTM
+                    mtm[i] = option_values_
+                    delta[
+                        i] = 0  # Note: this will get overwritten if there's a new trade
+                    calculated_strike[i] = calculated_strike[
+                        i - 1]  # Note: this will get overwritten if there's a new trade
+
+                if new_trade[i]:
+                    # Price new option trade being entered
+                    option_values_, spot_, strike_, vol_, delta_, expiry_date_, intrinsic_values_ = \
+                        fx_options_pricer.price_instrument(cross,
+                                                           horizon_date[i],
                                                            strike,
-                                                           expiry_date[0],
+                                                           expiry_date[i],
                                                            contract_type=contract_type,
                                                            tenor=fx_options_trading_tenor,
                                                            fx_vol_surface=fx_vol_surface,
                                                            return_as_df=False)
 
-                    interpolated_option[0] = option_values_
-                    calculated_strike[0] = strike_
-                    implied_vol[0] = vol_
-
-                mtm[0] = 0
-
-                # Now price options for rest of history
-                # On rolling dates: MTM will be the previous option contract (interpolated)
-                # On non-rolling dates: it will be the current option contract
-                for i in range(1, len(horizon_date)):
-                    if exit_trade[i]:
-                        # Price option trade being exited
-                        option_values_, spot_, strike_, vol_, delta_, expiry_date_, intrinsic_values_ = \
-                            fx_options_pricer.price_instrument(cross,
-                                                               horizon_date[i],
-                                                               calculated_strike[
-                                                                   i - 1],
-                                                               expiry_date[
-                                                                   i - 1],
-                                                               contract_type=contract_type,
-                                                               tenor=fx_options_trading_tenor,
-                                                               fx_vol_surface=fx_vol_surface,
-                                                               return_as_df=False)
-
-                        # Store as MTM
-                        mtm[i] = option_values_
-                        delta[
-                            i] = 0  # Note: this will get overwritten if there's a new trade
-                        calculated_strike[i] = calculated_strike[
-                            i - 1]  # Note: this will get overwritten if there's a new trade
-
-                    if new_trade[i]:
-                        # Price new option trade being entered
-                        option_values_, spot_, strike_, vol_, delta_, expiry_date_, intrinsic_values_ = \
-                            fx_options_pricer.price_instrument(cross,
-                                                               horizon_date[i],
-                                                               strike,
-                                                               expiry_date[i],
-                                                               contract_type=contract_type,
-                                                               tenor=fx_options_trading_tenor,
-                                                               fx_vol_surface=fx_vol_surface,
-                                                               return_as_df=False)
-
-                        calculated_strike[
-                            i] = strike_  # option_output[cross + '-strike.close'].values
-                        implied_vol[i] = vol_
-                        interpolated_option[i] = option_values_
-                        delta[i] = delta_
-
-                    elif has_position[i] and not (exit_trade[i]):
-                        # Price current option trade
-                        # - strike/expiry the same as yesterday
-                        # - other market inputs taken live, closer to expiry
-                        calculated_strike[i] = calculated_strike[i - 1]
-
-                        if freeze_implied_vol:
-                            frozen_vol = implied_vol[i - 1]
-                        else:
-                            frozen_vol = None
-
-                        option_values_, spot_, strike_, vol_, delta_, expiry_date_, intrinsic_values_ = \
-                            fx_options_pricer.price_instrument(cross,
-                                                               horizon_date[i],
-                                                               calculated_strike[
-                                                                   i],
-                                                               expiry_date[i],
-                                                               vol=frozen_vol,
-                                                               contract_type=contract_type,
-                                                               tenor=fx_options_trading_tenor,
-                                                               fx_vol_surface=fx_vol_surface,
-                                                               return_as_df=False)
-
-                        interpolated_option[i] = option_values_
-                        implied_vol[i] = vol_
-                        mtm[i] = interpolated_option[i]
-                        delta[i] = delta_
-
-                # Calculate delta hedging P&L
-                spot_rets = (market_df[cross + ".close"] / market_df[
-                    cross + ".close"].shift(1) - 1).values
-
-                if tot_label == '':
-                    tot_rets = spot_rets
-                else:
-                    tot_rets = (market_df[cross + "-" + tot_label + ".close"]
-                                / market_df[
-                                    cross + "-" + tot_label + ".close"].shift(
-                                1) - 1).values
-
-                # Remember to take the inverted sign, eg. if call is +20%, we need to -20% of spot to flatten delta
-                # Also invest for whether we are long or short the option
-                delta_hedging_pnl = -np.roll(delta,
-                                             1) * tot_rets * position_multiplier
-                delta_hedging_pnl[0] = 0
-
-                # Calculate options P&L (given option premium is already percentage, only need to subtract)
-                # Again need to invert if we are short option
-                option_rets = (mtm - np.roll(interpolated_option,
-                                             1)) * position_multiplier
-                option_rets[0] = 0
-
-                # Calculate option + delta hedging P&L
-                option_delta_rets = delta_hedging_pnl + option_rets
-
-                if cum_index == 'mult':
-                    cum_rets = 100 * np.cumprod(1.0 + option_rets)
-                    cum_delta_rets = 100 * np.cumprod(1.0 + delta_hedging_pnl)
-                    cum_option_delta_rets = 100 * np.cumprod(
-                        1.0 + option_delta_rets)
-
-                elif cum_index == 'add':
-                    cum_rets = 100 + 100 * np.cumsum(option_rets)
-                    cum_delta_rets = 100 + 100 * np.cumsum(delta_hedging_pnl)
-                    cum_option_delta_rets = 100 + 100 * np.cumsum(
-                        option_delta_rets)
-
-                total_return_index_df = pd.DataFrame(index=horizon_date,
-                                                     columns=[
-                                                         cross + "-option-tot.close"])
-                total_return_index_df[cross + "-option-tot.close"] = cum_rets
-
-                if output_calculation_fields:
-                    total_return_index_df[
-                        cross + '-interpolated-option.close'] = interpolated_option
-                    total_return_index_df[cross + '-mtm.close'] = mtm
-                    total_return_index_df[cross + ".close"] = market_df[
-                        cross + ".close"].values
-                    total_return_index_df[
-                        cross + '-implied-vol.close'] = implied_vol
-                    total_return_index_df[
-                        cross + '-new-trade.close'] = new_trade
-                    total_return_index_df[cross + '.roll-date'] = roll_date
-                    total_return_index_df[
-                        cross + '-exit-trade.close'] = exit_trade
-                    total_return_index_df[cross + '.expiry-date'] = expiry_date
-                    total_return_index_df[
-                        cross + '-calculated-strike.close'] = calculated_strike
-                    total_return_index_df[
-                        cross + '-option-return.close'] = option_rets
-                    total_return_index_df[
-                        cross + '-spot-return.close'] = spot_rets
-                    total_return_index_df[
-                        cross + '-tot-return.close'] = tot_rets
-                    total_return_index_df[cross + '-delta.close'] = delta
-                    total_return_index_df[
-                        cross + '-delta-pnl-return.close'] = delta_hedging_pnl
-                    total_return_index_df[
-                        cross + '-delta-pnl-index.close'] = cum_delta_rets
-                    total_return_index_df[
-                        cross + '-option-delta-return.close'] = option_delta_rets
-                    total_return_index_df[
-                        cross + '-option-delta-tot.close'] = cum_option_delta_rets
+                    calculated_strike[
+                        i] = strike_  # option_output[cross + '-strike.close'].values
+                    implied_vol[i] = vol_
+                    interpolated_option[i] = option_values_
+                    delta[i] = delta_
 
-                total_return_index_df_agg.append(total_return_index_df)
+                elif has_position[i] and not (exit_trade[i]):
+                    # Price current option trade
+                    # - strike/expiry the same as yesterday
+                    # - other market inputs taken live, closer to expiry
+                    calculated_strike[i] = calculated_strike[i - 1]
 
-        return self._calculations.join(total_return_index_df_agg, how='outer')
+                    if freeze_implied_vol:
+                        frozen_vol = implied_vol[i - 1]
+                    else:
+                        frozen_vol = None
+
+                    option_values_, spot_, strike_, vol_, delta_, expiry_date_, intrinsic_values_ = \
+                        fx_options_pricer.price_instrument(cross,
+                                                           horizon_date[i],
+                                                           calculated_strike[
+                                                               i],
+                                                           expiry_date[i],
+                                                           vol=frozen_vol,
+                                                           contract_type=contract_type,
+                                                           tenor=fx_options_trading_tenor,
+                                                           fx_vol_surface=fx_vol_surface,
+                                                           return_as_df=False)
+
+                    interpolated_option[i] = option_values_
+                    implied_vol[i] = vol_
+                    mtm[i] = interpolated_option[i]
+                    delta[i] = delta_
+
+            # Calculate delta hedging P&L
+            spot_rets = (market_df[cross + ".close"] / market_df[
+                cross + ".close"].shift(1) - 1).values
+
+            if tot_label == '':
+                tot_rets = spot_rets
+            else:
+                tot_rets = (market_df[cross + "-" + tot_label + ".close"]
+                            / market_df[
+                                cross + "-" + tot_label + ".close"].shift(
+                            1) - 1).values
+
+            # Remember to take the inverted sign, eg. if call is +20%, we need to -20% of spot to flatten delta
+            # Also invest for whether we are long or short the option
+            delta_hedging_pnl = -np.roll(delta,
+                                         1) * tot_rets * position_multiplier
+            delta_hedging_pnl[0] = 0
+
+            # Calculate options P&L (given option premium is already percentage, only need to subtract)
+            # Again need to invert if we are short option
+            option_rets = (mtm - np.roll(interpolated_option,
+                                         1)) * position_multiplier
+            option_rets[0] = 0
+
+            # Calculate option + delta hedging P&L
+            option_delta_rets = delta_hedging_pnl + option_rets
+
+            if cum_index == 'mult':
+                cum_rets = 100 * np.cumprod(1.0 + option_rets)
+                cum_delta_rets = 100 * np.cumprod(1.0 + delta_hedging_pnl)
+                cum_option_delta_rets = 100 * np.cumprod(
+                    1.0 + option_delta_rets)
+
+            elif cum_index == 'add':
+                cum_rets = 100 + 100 * np.cumsum(option_rets)
+                cum_delta_rets = 100 + 100 * np.cumsum(delta_hedging_pnl)
+                cum_option_delta_rets = 100 + 100 * np.cumsum(
+                    option_delta_rets)
+
+            total_return_index_df = pd.DataFrame(index=horizon_date,
+                                                 columns=[
+                                                     cross + "-option-tot.close"])
+            total_return_index_df[cross + "-option-tot.close"] = cum_rets
+
+            if output_calculation_fields:
+                total_return_index_df[
+                    cross + '-interpolated-option.close'] = interpolated_option
+                total_return_index_df[cross + '-mtm.close'] = mtm
+                total_return_index_df[cross + ".close"] = market_df[
+                    cross + ".close"].values
+                total_return_index_df[
+                    cross + '-implied-vol.close'] = implied_vol
+                total_return_index_df[
+                    cross + '-new-trade.close'] = new_trade
+                total_return_index_df[cross + '.roll-date'] = roll_date
+                total_return_index_df[
+                    cross + '-exit-trade.close'] = exit_trade
+                total_return_index_df[cross + '.expiry-date'] = expiry_date
+                total_return_index_df[
+                    cross + '-calculated-strike.close'] = calculated_strike
+                total_return_index_df[
+                    cross + '-option-return.close'] = option_rets
+                total_return_index_df[
+                    cross + '-spot-return.close'] = spot_rets
+                total_return_index_df[
+                    cross + '-tot-return.close'] = tot_rets
+                total_return_index_df[cross + '-delta.close'] = delta
+                total_return_index_df[
+                    cross + '-delta-pnl-return.close'] = delta_hedging_pnl
+                total_return_index_df[
+                    cross + '-delta-pnl-index.close'] = cum_delta_rets
+                total_return_index_df[
+                    cross + '-option-delta-return.close'] = option_delta_rets
+                total_return_index_df[
+                    cross + '-option-delta-tot.close'] = cum_option_delta_rets
+
+            return total_return_index_df
+
+    def construct_roll_schedule(self, cross, horizon_date,
+                                enter_trading_dates=None,
+                                fx_options_trading_tenor=None,
+                                roll_days_before=None,
+                                roll_event=None,
+                                roll_months=None,
+                                cal=None):
+        """Calculates when we enter and exit option contracts, and the expiry date and roll date of the contract we
+        are holding, for every horizon date.
+
+        If no entry dates are specified, we enter a new contract at the start and whenever the horizon date reaches the
+        roll date of the contract we're holding. Otherwise, we only enter contracts on the entry dates and hold them to
+        expiry. The roll dates are computed for all the horizon dates at once, and the expiry dates are computed in one
+        go for all the trades (rather than one by one at each trade). Where there's no contract, the expiry date and
+        roll date are 0.
+
+        Parameters
+        ----------
+        cross : str
+            Currency pair (in correct convention)
+
+        horizon_date : DateTimeIndex
+            Horizon dates (sorted)
+
+        enter_trading_dates : DateTimeIndex
+            Dates to enter option contracts (if None, we keep rolling)
+
+        fx_options_trading_tenor : str
+            What is primary option contract being used to trade (default - '1M')
+
+        roll_days_before : int
+            Number of days before roll event to enter into a new option contract
+
+        roll_event : str
+            What constitutes a roll event? ('month-end', 'expiry-date')
+
+        roll_months : int
+            After how many months should we initiate a roll
+
+        cal : str
+            Calendar to use for expiry (if None, uses that of FX pair)
+
+        Returns
+        -------
+        DataFrame
+        """
+        if enter_trading_dates is None: enter_trading_dates = self._enter_trading_dates
+        if fx_options_trading_tenor is None: fx_options_trading_tenor = self._fx_options_trading_tenor
+        if roll_days_before is None: roll_days_before = self._roll_days_before
+        if roll_event is None: roll_event = self._roll_event
+        if roll_months is None: roll_months = self._roll_months
+        if cal is None: cal = self._cal
+
+        if cal is None:
+            cal = cross
+
+        horizon_date = pd.DatetimeIndex(horizon_date)
+
+        business_day_calendar = BusinessDayCalendar.get(cross, calendar=self._calendar)
+
+        def get_expiry_date(horizon_d):
+            return pd.DatetimeIndex(self._calendar.get_expiry_date_from_horizon_date(
+                horizon_d, fx_options_trading_tenor, cal=cal, asset_class='fx-vol'))
+
+        def get_traded_expiry_date(horizon_d):
+            # Make sure we don't expire on a date in the history where there isn't market data
+            # It is ok for future values to expire after market data (just not in the backtest!)
+            expiry_d = get_expiry_date(horizon_d)
+            expiry_index = horizon_date.searchsorted(expiry_d)
+
+            return horizon_date[np.minimum(expiry_index, len(horizon_date) - 1)].where(
+                expiry_index < len(horizon_date), expiry_d)
+
+        def get_roll_date(horizon_d, expiry_d):
+            if roll_event == 'month-end':
+                roll_d = business_day_calendar.business_month_end_offset(horizon_d, roll_months)
+            elif roll_event == 'expiry-date':
+                roll_d = expiry_d
+            else:
+                raise ValueError("roll_event must be month-end or expiry-date")
+
+            # Special case so always rolls on roll event, if specify 0 days
+            if roll_days_before > 0:
+                roll_d = business_day_calendar.business_day_offset(roll_d, -roll_days_before)
+
+            return roll_d
+
+        horizon_ns = horizon_date.asi8
+
+        if enter_trading_dates is None:
+            # Candidate roll dates, if we were to enter a new trade on every horizon date
+            if roll_event == 'expiry-date':
+                all_expiry_date = get_traded_expiry_date(horizon_date)
+            else:
+                all_expiry_date = None
+
+            all_roll_date = get_roll_date(horizon_date, all_expiry_date)
+
+            # First expiry isn't moved onto the market data
+            first_expiry_date = get_expiry_date(horizon_date[0:1])
+            first_roll_date = get_roll_date(horizon_date[0:1], first_expiry_date)
+
+            # New trade => entry at beginning AND on every roll, which is the first horizon date which has reached the
+            # roll date of the previous trade
+            all_roll_ns = all_roll_date.asi8
+
+            trade_ind = [0]
+            roll_ns = first_roll_date.asi8[0]
+
+            while True:
+                i = max(np.searchsorted(horizon_ns, roll_ns), trade_ind[-1] + 1)
+
+                if i >= len(horizon_ns):
+                    break
+
+                trade_ind.append(i)
+                roll_ns = all_roll_ns[i]
+
+            trade_ind = np.array(trade_ind)
+
+            # Get the expiry dates only for the trades (in one batch)
+            if all_expiry_date is None:
+                trade_expiry_date = first_expiry_date.append(get_traded_expiry_date(horizon_date[trade_ind[1:]]))
+            else:
+                trade_expiry_date = first_expiry_date.append(all_expiry_date[trade_ind[1:]])
+
+            trade_roll_date = first_roll_date.append(all_roll_date[trade_ind[1:]])
+        else:
+            trade_ind = np.unique(horizon_date.searchsorted(enter_trading_dates))
+
+            trade_expiry_date = get_traded_expiry_date(horizon_date[trade_ind])
+            trade_roll_date = None
+
+        new_trade = np.full(len(horizon_date), False, dtype=bool)
+        new_trade[trade_ind] = True
+
+        # We hold each contract from when we trade it until it expires (or we enter a new trade)
+        trade_no = np.cumsum(new_trade) - 1
+        in_trade = trade_no >= 0
+
+        trade_expiry_ns = np.full(len(horizon_date), np.iinfo(np.int64).min)
+        trade_expiry_ns[in_trade] = trade_expiry_date.asi8[trade_no[in_trade]]
+
+        has_position = new_trade | (in_trade & (horizon_ns <= trade_expiry_ns))
+
+        if enter_trading_dates is None:
+            # On a roll we exit the previous contract, or if it has expired before the roll, on the day after expiry
+            # (after which we have no position until the roll)
+            had_position = np.roll(has_position, 1)
+            had_position[0] = False
+
+            exit_trade = had_position & (new_trade | ~has_position)
+            has_position = has_position | exit_trade
+            holding = has_position & ~(exit_trade & ~new_trade)
+        else:
+            # Makes the assumption we aren't rolling contracts, so we only exit on expiry
+            exit_trade = has_position & ~new_trade & (horizon_ns == trade_expiry_ns)
+            holding = has_position
+
+        def get_contract_date(trade_d):
+            contract_d = np.zeros(len(horizon_date), dtype=object)
+
+            if trade_d is not None:
+                contract_d[holding] = trade_d[trade_no[holding]].to_numpy(dtype=object)
+
+            return pd.Series(contract_d, index=horizon_date, dtype=object)
+
+        return pd.DataFrame({cross + '-new-trade.close': new_trade,
+                             cross + '-exit-trade.close': exit_trade,
+                             cross + '-has-position.close': has_position,
+                             cross + '.expiry-date': get_contract_date(trade_expiry_date),
+                             cross + '.roll-date': get_contract_date(trade_roll_date)},
+                            index=horizon_date)
 
     def apply_tc_signals_to_total_return_index(self, cross_fx,
                                                total_return_index_orig_df,
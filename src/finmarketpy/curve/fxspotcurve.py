@@ -16,6 +16,7 @@ __author__ = 'saeedamen'  # Saeed Amen
 #
 
 
+import numpy as np
 import pandas as pd
 
 from numba import guvectorize
@@ -23,17 +24,18 @@ from numba import guvectorize
 from findatapy.market import Market, MarketDataRequest
 from findatapy.timeseries import Calculations
 
+from finmarketpy.curve.abstractcurve import AbstractCurve
 from finmarketpy.util.marketconstants import MarketConstants
 
 market_constants = MarketConstants()
 
 
-@guvectorize(['void(f8[:], f8[:], f8[:], f8[:], f8, f8, f8[:])'],
-             '(n),(n),(n),(n),(),()->(n)', cache=True, target="cpu",
+@guvectorize(['void(f8[:], f8[:], f8[:], f8[:], f8, f8, f8, f8[:])'],
+             '(n),(n),(n),(n),(),(),()->(n)', cache=True, target="cpu",
              nopython=True)
 def _spot_index_numba(spot, time_diff, base_deposit, terms_deposit,
-                      base_daycount, terms_daycount, out):
-    out[0] = 100
+                      base_daycount, terms_daycount, start_level, out):
+    out[0] = start_level
 
     for i in range(1, len(out)):
         # Calculate total return index as product of yesterday, changes in spot and carry accrued
@@ -60,7 +62,7 @@ def _spot_index(spot, time_diff, base_deposit, terms_deposit, base_daycount,
     return out
 
 
-class FXSpotCurve(object):
+class FXSpotCurve(AbstractCurve):
     """Construct total return (spot) indices for FX. In future will also convert assets from local currency to foreign currency
     denomination and construct indices from forwards series.
 
@@ -79,18 +81,23 @@ class FXSpotCurve(object):
         self._output_calculation_fields = output_calculation_fields
         self._field = field
 
+        self._cross_timing = None
+
     def generate_key(self):
         from findatapy.market.ioengine import SpeedCache
 
         # Don't include any "large" objects in the key
         return SpeedCache().generate_key(self, ['_market_data_generator',
-                                                '_calculations'])
+                                                '_calculations',
+                                                '_cross_timing'])
 
     def fetch_continuous_time_series(self, md_request, market_data_generator,
                                      depo_tenor=None,
                                      construct_via_currency=None,
                                      output_calculation_fields=None,
-                                     field=None):
+                                     field=None,
+                                     run_in_parallel=False,
+                                     thread_no=None):
 
         if market_data_generator is None: market_data_generator = self._market_data_generator
         if depo_tenor is None: depo_tenor = self._depo_tenor
@@ -132,60 +139,32 @@ class FXSpotCurve(object):
                  how='outer'),
                 depo_tenor=depo_tenor,
                 output_calculation_fields=output_calculation_fields,
-                field=field)
+                field=field,
+                run_in_parallel=run_in_parallel,
+                thread_no=thread_no)
         else:
             # eg. we calculate via your domestic currency such as USD, so
             # returns will be in your domestic currency
             # Hence AUDJPY would be calculated via AUDUSD and JPYUSD
             # (subtracting the difference in returns)
-            total_return_indices = []
-
-            for tick in md_request.tickers:
-                base = tick[0:3]
-                terms = tick[3:6]
-
-                md_request_base = MarketDataRequest(md_request=md_request)
-                md_request_base.tickers = base + construct_via_currency
-
-                md_request_terms = MarketDataRequest(md_request=md_request)
-                md_request_terms.tickers = terms + construct_via_currency
-
-                base_vals = self.fetch_continuous_time_series(
-                    md_request_base,
-                    market_data_generator,
-                    construct_via_currency='no',
-                    field=field)
-                terms_vals = self.fetch_continuous_time_series(
-                    md_request_terms, market_data_generator,
-                    construct_via_currency='no', field=field)
-
-                # Special case for USDUSD case (and if base or terms USD are USDUSD
-                if base + terms == construct_via_currency + construct_via_currency:
-                    base_rets = self._calculations.calculate_returns(base_vals)
-                    cross_rets = pd.DataFrame(0, index=base_rets.index,
-                                              columns=base_rets.columns)
-                elif base + construct_via_currency == construct_via_currency + construct_via_currency:
-                    cross_rets = -self._calculations.calculate_returns(
-                        terms_vals)
-                elif terms + construct_via_currency == construct_via_currency + construct_via_currency:
-                    cross_rets = self._calculations.calculate_returns(
-                        base_vals)
-                else:
-                    base_rets = self._calculations.calculate_returns(base_vals)
-                    terms_rets = self._calculations.calculate_returns(
-                        terms_vals)
-
-                    cross_rets = base_rets.sub(terms_rets.iloc[:, 0], axis=0)
-
-                # First returns of a time series will by NaN, given we don't know previous point
-                cross_rets.iloc[0] = 0
-
-                cross_vals = self._calculations.create_mult_index(cross_rets)
-                cross_vals.columns = [tick + '-tot.close']
-
-                total_return_indices.append(cross_vals)
-
-            return self._calculations.join(total_return_indices, how='outer')
+            # Each leg is fetched and constructed only once (and all in one
+            # go), however many tickers share it
+            md_request_legs = MarketDataRequest(md_request=md_request)
+            md_request_legs.tickers = self._get_via_currency_legs(
+                md_request.tickers, construct_via_currency)
+
+            leg_df = self.fetch_continuous_time_series(
+                md_request_legs, market_data_generator,
+                depo_tenor=depo_tenor,
+                construct_via_currency='no',
+                output_calculation_fields=False,
+                field=field,
+                run_in_parallel=run_in_parallel,
+                thread_no=thread_no)
+
+            return self._construct_via_currency_total_return_index(
+                md_request.tickers, construct_via_currency, leg_df,
+                '-tot.close')
 
     def unhedged_asset_fx(self, assets_df, asset_currency, home_curr,
                           start_date, finish_date, spot_df=None):
@@ -205,7 +184,9 @@ class FXSpotCurve(object):
     def construct_total_return_index(self, cross_fx, market_df,
                                      depo_tenor=None,
                                      output_calculation_fields=None,
-                                     field=None):
+                                     field=None,
+                                     run_in_parallel=False,
+                                     thread_no=None):
         """Creates total return index for selected FX crosses from spot and
         deposit data
 
@@ -219,6 +200,10 @@ class FXSpotCurve(object):
             Spot data (must include crosses we select)
         deposit_df : pd.DataFrame
             Deposit data
+        run_in_parallel : bool
+            Split the crosses between several processes
+        thread_no : int
+            Number of processes (default - MarketConstants.fx_curve_thread_no)
 
         Returns
         -------
@@ -232,79 +217,228 @@ class FXSpotCurve(object):
             output_calculation_fields = self._output_calculation_fields
         if field is None: field = self._field
 
-        total_return_index_df_agg = []
+        total_return_index_df_agg = self._construct_total_return_index_crosses(
+            cross_fx, market_df, run_in_parallel=run_in_parallel, thread_no=thread_no, depo_tenor=depo_tenor,
+            output_calculation_fields=output_calculation_fields, field=field)
 
-        for cross in cross_fx:
-            # Get the spot series, base deposit
-            base_deposit = market_df[
-                cross[0:3] + depo_tenor + "." + field].to_frame()
-            terms_deposit = market_df[
-                cross[3:6] + depo_tenor + "." + field].to_frame()
+        return self._calculations.join(total_return_index_df_agg, how='outer')
+
+    def construct_total_return_index_stream(self, cross_fx, market_df_chunks, depo_tenor=None, field=None,
+                                            stream_state=None, max_pending_rows=None):
+        """Creates total return index for selected FX crosses from spot and deposit data, which arrives in chunks (eg.
+        years of tick/minute data, which won't fit in memory). Only the last index level, spot, deposits and time
+        are carried between chunks, so the memory needed depends only on the size of each chunk. The index is the
+        same as if all the chunks had been given to construct_total_return_index together.
+
+        Parameters
+        ----------
+        cross_fx : String
+            Crosses to construct total return indices (can be a list)
+        market_df_chunks : pd.DataFrame (iterable) or str
+            Chunks of spot and deposit data in time order (eg. from a generator) or the path of a Parquet file, which
+            is read one row group at a time
+        depo_tenor : String
+            Tenor of deposit rates to use to compute carry (typically ON for spot)
+        field : String
+            Field of the market data (eg. close)
+        stream_state : dict
+            Updated with the last values of each cross (and which currencies have had deposit data) after every
+            chunk, so it can be given again to carry on the index later with new data (default - start every index at
+            100)
+        max_pending_rows : int
+            How many rows to hold back waiting for the first deposit data of every currency, before raising an
+            exception (default - MarketConstants.fx_spot_stream_max_pending_rows)
+
+        Returns
+        -------
+        pd.DataFrame (generator)
+            Total return indices for each chunk
+        """
+        if not (isinstance(cross_fx, list)):
+            cross_fx = [cross_fx]
+
+        if depo_tenor is None: depo_tenor = self._depo_tenor
+        if field is None: field = self._field
+        if stream_state is None: stream_state = {}
+        if max_pending_rows is None: max_pending_rows = market_constants.fx_spot_stream_max_pending_rows
+
+        # Currencies which have had some deposit data, so we don't have to look through the held back chunks again
+        deposits_seen = stream_state.setdefault('deposits_seen', set())
+
+        if isinstance(market_df_chunks, str):
+            market_df_chunks = self._read_parquet_row_groups(market_df_chunks)
+
+        # Until we've had some deposit data for every cross, we can't fill it back to the start, so hold back the
+        # chunks until then
+        pending = []
+        pending_rows = 0
+
+        for market_df in market_df_chunks:
+            # Nothing to add to the index (eg. an empty row group)
+            if market_df.empty: continue
+
+            pending.append(market_df)
+            pending_rows = pending_rows + len(market_df.index)
+
+            if not (all([self._has_stream_deposits(cross, stream_state, deposits_seen, market_df, depo_tenor, field)
+                         for cross in cross_fx])):
+                if pending_rows > max_pending_rows:
+                    raise Exception("No deposit data for some currencies in the first " + str(pending_rows)
+                                    + " rows, so can't construct total return indices for " + str(cross_fx))
 
+                continue
+
+            market_df = pd.concat(pending) if len(pending) > 1 else pending[0]
+            pending = []
+            pending_rows = 0
+
+            yield self._construct_total_return_index_stream_chunk(cross_fx, market_df, depo_tenor, field,
+                                                                  stream_state)
+
+        if pending:
+            yield self._construct_total_return_index_stream_chunk(cross_fx, pd.concat(pending), depo_tenor, field,
+                                                                  stream_state)
+
+    def _read_parquet_row_groups(self, path):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception("pyarrow is needed to stream total return indices from a Parquet file, install it with "
+                            "pip install pyarrow")
+
+        parquet_file = pq.ParquetFile(path)
+
+        for i in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(i).to_pandas()
+
+    def _has_stream_deposits(self, cross, stream_state, deposits_seen, market_df, depo_tenor, field):
+        if cross in stream_state or cross[0:3] == cross[3:6]:
+            return True
+
+        # Only need to look at the newest chunk, for currencies we haven't had deposits for yet
+        for ccy in [cross[0:3], cross[3:6]]:
+            if ccy not in deposits_seen and market_df[ccy + depo_tenor + "." + field].notna().any():
+                deposits_seen.add(ccy)
+
+        return cross[0:3] in deposits_seen and cross[3:6] in deposits_seen
+
+    def _construct_total_return_index_stream_chunk(self, cross_fx, market_df, depo_tenor, field, stream_state):
+        total_return_index_df = pd.DataFrame(index=market_df.index)
+
+        for cross in cross_fx:
             # Eg. if we specify USDUSD
             if cross[0:3] == cross[3:6]:
-                total_return_index_df_agg.append(
-                    pd.DataFrame(100, index=base_deposit.index,
-                                 columns=[cross + "-tot.close"]))
-            else:
-                carry = base_deposit.join(terms_deposit, how='inner')
-
-                spot = market_df[cross + "." + field].to_frame()
-
-                base_daycount = self.get_day_count_conv(cross[0:3])
-                terms_daycount = self.get_day_count_conv(cross[4:6])
-
-                # Align the base & terms deposits series to spot (this should
-                # already be done by construction)
-                # spot, carry = spot.align(carry, join='left', axis=0)
-
-                # Sometimes depo data can be patchy, ok to fill down, given not
-                # very volatile (don't do this with spot!)
-                carry = carry.ffill() / 100.0
-
-                # In case there are values missing at start of list (fudge for
-                # old data!)
-                carry = carry.bfill()
-
-                spot = spot[cross + "." + field].to_frame()
-
-                spot_vals = spot[cross + "." + field].values
-                base_deposit_vals = carry[
-                    cross[0:3] + depo_tenor + "." + field].values
-                terms_deposit_vals = carry[
-                    cross[3:6] + depo_tenor + "." + field].values
-
-                # Calculate the time difference between each data point (
-                # flooring it to whole days, because carry
-                # is accured when there's a new day)
-                spot['index_col'] = spot.index.floor('D')
-                time = spot['index_col'].diff()
-                spot = spot.drop('index_col', axis=1)
-
-                time_diff = time.values.astype(
-                    float) / 86400000000000.0  # get time difference in days
-                time_diff[0] = 0.0
-
-                # Use Numba to do total return index calculation given has many loops
-                total_return_index_df = pd.DataFrame(index=spot.index,
-                                                     columns=[
-                                                         cross + "-tot.close"],
-                                                     data=_spot_index_numba(
-                                                         spot_vals, time_diff,
-                                                         base_deposit_vals,
-                                                         terms_deposit_vals,
-                                                         base_daycount,
-                                                         terms_daycount))
-
-                if output_calculation_fields:
-                    total_return_index_df[cross + '-carry.' + field] = carry
-                    total_return_index_df[
-                        cross + '-tot-return.' + field] = total_return_index_df / total_return_index_df.shift(
-                        1) - 1.0
-                    total_return_index_df[
-                        cross + '-spot-return.' + field] = spot / spot.shift(
-                        1) - 1.0
-
-                total_return_index_df_agg.append(total_return_index_df)
+                total_return_index_df[cross + "-tot.close"] = 100.0
 
-        return self._calculations.join(total_return_index_df_agg, how='outer')
+                continue
+
+            spot_vals = market_df[cross + "." + field].values.astype(float)
+            base_deposit_vals = market_df[cross[0:3] + depo_tenor + "." + field].values.astype(float)
+            terms_deposit_vals = market_df[cross[3:6] + depo_tenor + "." + field].values.astype(float)
+
+            # Flooring time to whole days, because carry is accrued when there's a new day
+            day = market_df.index.floor('D').asi8
+
+            # Start from the last point of the previous chunk (if there is one)
+            state = stream_state.get(cross)
+
+            if state is not None:
+                spot_vals = np.append(state['spot'], spot_vals)
+                base_deposit_vals = np.append(state['base_deposit'], base_deposit_vals)
+                terms_deposit_vals = np.append(state['terms_deposit'], terms_deposit_vals)
+                day = np.append(state['day'], day)
+
+            # Fill down deposits (also from the previous chunk), and back to the start if they're missing there
+            carry = pd.DataFrame({'base': base_deposit_vals, 'terms': terms_deposit_vals}).ffill().bfill()
+
+            # Get time difference in days
+            time_diff = np.diff(day, prepend=day[0]) / 86400000000000.0
+
+            total_return_index = _spot_index_numba(
+                spot_vals, time_diff, carry['base'].values / 100.0, carry['terms'].values / 100.0,
+                self.get_day_count_conv(cross[0:3]), self.get_day_count_conv(cross[4:6]),
+                100.0 if state is None else state['level'])
+
+            if state is not None:
+                total_return_index = total_return_index[1:]
+
+            total_return_index_df[cross + "-tot.close"] = total_return_index
+
+            stream_state[cross] = {'level': total_return_index[-1], 'spot': spot_vals[-1], 'day': day[-1],
+                                   'base_deposit': carry['base'].values[-1],
+                                   'terms_deposit': carry['terms'].values[-1]}
+
+        return total_return_index_df
+
+    def _construct_total_return_index_cross(self, cross, market_df, depo_tenor=None, output_calculation_fields=None,
+                                            field=None):
+        # Get the spot series, base deposit
+        base_deposit = market_df[
+            cross[0:3] + depo_tenor + "." + field].to_frame()
+        terms_deposit = market_df[
+            cross[3:6] + depo_tenor + "." + field].to_frame()
+
+        # Eg. if we specify USDUSD
+        if cross[0:3] == cross[3:6]:
+            return pd.DataFrame(100, index=base_deposit.index,
+                                columns=[cross + "-tot.close"])
+        else:
+            carry = base_deposit.join(terms_deposit, how='inner')
+
+            spot = market_df[cross + "." + field].to_frame()
+
+            base_daycount = self.get_day_count_conv(cross[0:3])
+            terms_daycount = self.get_day_count_conv(cross[4:6])
+
+            # Align the base & terms deposits series to spot (this should
+            # already be done by construction)
+            # spot, carry = spot.align(carry, join='left', axis=0)
+
+            # Sometimes depo data can be patchy, ok to fill down, given not
+            # very volatile (don't do this with spot!)
+            carry = carry.ffill() / 100.0
+
+            # In case there are values missing at start of list (fudge for
+            # old data!)
+            carry = carry.bfill()
+
+            spot = spot[cross + "." + field].to_frame()
+
+            spot_vals = spot[cross + "." + field].values
+            base_deposit_vals = carry[
+                cross[0:3] + depo_tenor + "." + field].values
+            terms_deposit_vals = carry[
+                cross[3:6] + depo_tenor + "." + field].values
+
+            # Calculate the time difference between each data point (
+            # flooring it to whole days, because carry
+            # is accured when there's a new day)
+            spot['index_col'] = spot.index.floor('D')
+            time = spot['index_col'].diff()
+            spot = spot.drop('index_col', axis=1)
+
+            time_diff = time.values.astype(
+                float) / 86400000000000.0  # get time difference in days
+            time_diff[0] = 0.0
+
+            # Use Numba to do total return index calculation given has many loops
+            total_return_index_df = pd.DataFrame(index=spot.index,
+                                                 columns=[
+                                                     cross + "-tot.close"],
+                                                 data=_spot_index_numba(
+                                                     spot_vals, time_diff,
+                                                     base_deposit_vals,
+                                                     terms_deposit_vals,
+                                                     base_daycount,
+                                                     terms_daycount, 100.0))
+
+            if output_calculation_fields:
+                total_return_index_df[cross + '-carry.' + field] = carry
+                total_return_index_df[
+                    cross + '-tot-return.' + field] = total_return_index_df / total_return_index_df.shift(
+                    1) - 1.0
+                total_return_index_df[
+                    cross + '-spot-return.' + field] = spot / spot.shift(
+                    1) - 1.0
+
+            return total_return_index_df
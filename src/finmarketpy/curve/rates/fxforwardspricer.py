@@ -15,66 +15,133 @@ __author__ = 'saeedamen'  # Saeed Amen
 # limitations under the License.
 #
 
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 
+import numba
 from numba import guvectorize
 
 from findatapy.timeseries import Calendar
+from findatapy.util.dataconstants import DataConstants
+from finmarketpy.util.businesscalendar import get_holidays_version
 from finmarketpy.util.marketconstants import MarketConstants
 from finmarketpy.curve.abstractpricer import AbstractPricer
 
+data_constants = DataConstants()
 market_constants = MarketConstants()
 
 
-@guvectorize(['void(f8[:], f8[:], f8[:,:], f8[:,:], intp, f8[:])'],
-             '(n),(n),(n,m),(n,m),()->(n)', cache=True, target="cpu",
-             nopython=True)
-def _forwards_interpolate_numba(spot_arr, spot_delivery_days_arr,
+def _forwards_interpolate_kernel(spot_arr, spot_delivery_days_arr,
                                 quoted_delivery_days_arr,
                                 forwards_points_arr, no_of_tenors, out):
     for i, delivery_day in enumerate(spot_delivery_days_arr):
-        for j in range(no_of_tenors):
 
-            # curr_forward_pts = forwards_points_arr[i, j]
-            # curr_delivery_days = quoted_delivery_days_arr[i, j]
-            # next_forward_pts = forwards_points_arr[i, j+1]
-            # next_delivery_days = quoted_delivery_days_arr[i, j+1]
+        # In other words, SP (Spot)
+        if delivery_day == 0:
+            out[i] = spot_arr[i]
 
-            # In other words, SP (Spot)
-            if delivery_day == 0:
-                out[i] = spot_arr[i]
+            continue
 
-                break
+        # First tenor which delivers on/after our delivery date (with so few tenors, a scan is quicker than a
+        # binary search, whose branches are harder to predict)
+        j = 0
 
-            # Say if we're in between SP and 1W
-            elif delivery_day <= quoted_delivery_days_arr[i, j]:
-                out[i] = spot_arr[i] + (forwards_points_arr[i, j] /
-                                        quoted_delivery_days_arr[
-                                            i, j]) * delivery_day
+        while j < no_of_tenors and quoted_delivery_days_arr[i, j] < delivery_day:
+            j = j + 1
 
-                break
-            # Eg. if we're in between 1W and 2W
-            elif delivery_day >= quoted_delivery_days_arr[
-                i, j] and delivery_day <= quoted_delivery_days_arr[i, j + 1]:
+        # Say if we're in between SP and 1W
+        if j == 0:
+            out[i] = spot_arr[i] + (forwards_points_arr[i, 0] /
+                                    quoted_delivery_days_arr[i, 0]) * delivery_day
 
-                # Alternative interpolation
-                # interpolated_forwards_arr[i] = spot_arr[i] + \
-                #                                delivery_day * (forwards_points_arr[i, j+1] - forwards_points_arr[i, j]) \
-                #                                / (quoted_delivery_days_arr[i, j+1] - quoted_delivery_days_arr[i, j])
+        # Eg. if we're in between 1W and 2W
+        elif j < no_of_tenors:
 
-                forward_points_per_day = (forwards_points_arr[i, j + 1] -
-                                          forwards_points_arr[i, j]) \
-                                         / (quoted_delivery_days_arr[
-                                                i, j + 1] -
-                                            quoted_delivery_days_arr[i, j])
+            # Alternative interpolation
+            # out[i] = spot_arr[i] + delivery_day * (forwards_points_arr[i, j] - forwards_points_arr[i, j-1]) \
+            #          / (quoted_delivery_days_arr[i, j] - quoted_delivery_days_arr[i, j-1])
 
-                out[i] = spot_arr[i] + forward_points_per_day * delivery_day \
-                         + forwards_points_arr[i, j] - (
-                                     forward_points_per_day *
-                                     quoted_delivery_days_arr[i, j])
+            forward_points_per_day = (forwards_points_arr[i, j] -
+                                      forwards_points_arr[i, j - 1]) \
+                                     / (quoted_delivery_days_arr[i, j] -
+                                        quoted_delivery_days_arr[i, j - 1])
 
-                break
+            out[i] = spot_arr[i] + forward_points_per_day * delivery_day \
+                     + forwards_points_arr[i, j - 1] - (
+                             forward_points_per_day *
+                             quoted_delivery_days_arr[i, j - 1])
+
+        # We don't extrapolate beyond the longest tenor
+        else:
+            out[i] = np.nan
+
+
+_forwards_interpolate_numba_cpu = guvectorize(
+    ['void(f8[:], f8[:], f8[:,:], f8[:,:], intp, f8[:])'],
+    '(n),(n),(n,m),(n,m),()->(n)', cache=True, target="cpu",
+    nopython=True)(_forwards_interpolate_kernel)
+
+_forwards_interpolate_numba_parallel = None
+
+
+def _get_forwards_interpolate_numba_parallel():
+    # The "parallel" target splits the outer (broadcast) dimension across the cores, so we use it on chunks. It's only
+    # compiled when first needed, as this starts Numba's threads (which would hang any processes forked afterwards,
+    # eg. when constructing curves for many crosses in parallel)
+    global _forwards_interpolate_numba_parallel
+
+    if _forwards_interpolate_numba_parallel is None:
+        _forwards_interpolate_numba_parallel = guvectorize(
+            ['void(f8[:], f8[:], f8[:,:], f8[:,:], intp, f8[:])'],
+            '(n),(n),(n,m),(n,m),()->(n)', target="parallel",
+            nopython=True)(_forwards_interpolate_kernel)
+
+    return _forwards_interpolate_numba_parallel
+
+
+def _forwards_interpolate_numba(spot_arr, spot_delivery_days_arr,
+                                quoted_delivery_days_arr,
+                                forwards_points_arr, no_of_tenors,
+                                parallel_threshold=market_constants.fx_forwards_interpolate_parallel_threshold,
+                                chunks_per_thread=market_constants.fx_forwards_interpolate_chunks_per_thread):
+    """Interpolates outright forwards for many delivery dates (eg. every business day x every broken date for risk
+    ladders). Large requests are split into chunks which are interpolated across all the cores, whereas for smaller
+    requests, we avoid the overhead of the threads.
+    """
+    spot_arr = np.asarray(spot_arr, dtype=np.float64)
+    spot_delivery_days_arr = np.asarray(spot_delivery_days_arr, dtype=np.float64)
+
+    n = len(spot_arr)
+
+    if n < parallel_threshold or numba.config.NUMBA_NUM_THREADS == 1:
+        return _forwards_interpolate_numba_cpu(
+            spot_arr, spot_delivery_days_arr, quoted_delivery_days_arr,
+            forwards_points_arr, no_of_tenors)
+
+    quoted_delivery_days_arr = np.asarray(quoted_delivery_days_arr, dtype=np.float64)
+    forwards_points_arr = np.asarray(forwards_points_arr, dtype=np.float64)
+
+    no_of_chunks = numba.get_num_threads() * chunks_per_thread
+    chunk_size = -(-n // no_of_chunks)
+
+    # Pad the last chunk with spot dates (which are cheap to interpolate) and drop them afterwards
+    pad = no_of_chunks * chunk_size - n
+
+    def chunk(arr):
+        return np.pad(arr, [(0, pad)] + [(0, 0)] * (arr.ndim - 1)).reshape(
+            (no_of_chunks, chunk_size) + arr.shape[1:])
+
+    out = _get_forwards_interpolate_numba_parallel()(
+        chunk(spot_arr), chunk(spot_delivery_days_arr),
+        chunk(quoted_delivery_days_arr), chunk(forwards_points_arr),
+        no_of_tenors)
+
+    return out.ravel()[:n]
 
 
 @guvectorize(['void(f8[:], f8[:,:], f8[:,:], f8[:,:], f8, f8, intp, f8[:,:])'],
@@ -156,6 +223,137 @@ def _forwards_interpolate(spot_arr, spot_delivery_days_arr,
     return out
 
 
+class QuotedDeliveryCache(object):
+    """Process wide LRU cache of the delivery dates of quoted FX forwards (eg. EURUSD 1W, 1M etc.) for every horizon
+    date, keyed by the cross, tenor, holiday calendar and the version of the holiday calendars. Each entry covers all
+    the horizon dates which have been asked for so far, so any sub-range can be served by selecting those dates, and
+    only horizon dates which haven't been seen before need any calendar calculations.
+
+    Entries can also be persisted to disk (eg. so they survive between pricing runs during the day), by setting
+    MarketConstants.fx_forwards_quoted_delivery_cache_folder
+    """
+
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, max_size=None, folder=None):
+        if max_size is None: max_size = market_constants.fx_forwards_quoted_delivery_cache_size
+        if folder is None: folder = market_constants.fx_forwards_quoted_delivery_cache_folder
+
+        self._max_size = max_size
+        self._folder = folder
+
+    def get_delivery_date(self, cross, horizon_date, tenor, cal=None, calendar=None) -> pd.DatetimeIndex:
+        """Gets the delivery dates of a quoted FX forward for each horizon date, calculating (in one batch) only
+        those which aren't already in the cache
+
+        Parameters
+        ----------
+        cross : str
+            Currency pair
+
+        horizon_date : DateTimeIndex
+            Horizon dates
+
+        tenor : str
+            Tenor of the forward eg. '1W'
+
+        cal : str
+            Holiday calendar (default - cross)
+
+        calendar : Calendar
+            Used to calculate the delivery dates
+
+        Returns
+        -------
+        DateTimeIndex
+        """
+        if cal is None: cal = cross
+        if calendar is None: calendar = Calendar()
+
+        horizon_date = pd.DatetimeIndex(horizon_date)
+
+        if self._max_size <= 0:
+            return pd.DatetimeIndex(calendar.get_delivery_date_from_horizon_date(horizon_date, tenor, cal=cal))
+
+        key = (cross, tenor, cal, str(horizon_date.tz), self._calendar_version())
+
+        with self._lock:
+            delivery_date_ser = self._cache.get(key)
+
+            if delivery_date_ser is not None:
+                self._cache.move_to_end(key)
+
+        if delivery_date_ser is None:
+            delivery_date_ser = self._load(key)
+
+        if delivery_date_ser is None:
+            missing_date = horizon_date.unique()
+        else:
+            missing_date = horizon_date[~horizon_date.isin(delivery_date_ser.index)].unique()
+
+        if len(missing_date) > 0:
+            missing_ser = pd.Series(pd.DatetimeIndex(calendar.get_delivery_date_from_horizon_date(
+                missing_date, tenor, cal=cal)), index=missing_date)
+
+            if delivery_date_ser is None:
+                delivery_date_ser = missing_ser
+            else:
+                delivery_date_ser = pd.concat([delivery_date_ser, missing_ser]).sort_index()
+
+            self._save(key, delivery_date_ser)
+
+        with self._lock:
+            self._cache[key] = delivery_date_ser
+            self._cache.move_to_end(key)
+
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+
+        return pd.DatetimeIndex(delivery_date_ser.reindex(horizon_date))
+
+    def clear(self):
+        """Clears the cache in memory (but not any files on disk)
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def _calendar_version(self):
+        # Holidays are read from the findatapy holidays table, so if it is edited the dates need recalculating
+        return get_holidays_version()
+
+    def _get_path(self, key):
+        return os.path.join(self._folder, 'quoted_delivery_' + key[0] + '_' + key[1] + '_' +
+                            hashlib.md5(str(key).encode('utf-8')).hexdigest() + '.pkl')
+
+    def _load(self, key):
+        if self._folder is None:
+            return None
+
+        path = self._get_path(key)
+
+        if os.path.exists(path):
+            try:
+                return pd.read_pickle(path)
+            except Exception:
+                return None
+
+        return None
+
+    def _save(self, key, delivery_date_ser):
+        if self._folder is None:
+            return
+
+        os.makedirs(self._folder, exist_ok=True)
+
+        # Write to a temporary file first, so other processes never read a partially written file
+        path = self._get_path(key)
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+
+        delivery_date_ser.to_pickle(temp_path)
+        os.replace(temp_path, path)
+
+
 class FXForwardsPricer(AbstractPricer):
     """Prices forwards for odd dates which are not quoted using linear interpolation,
     eg. if we have forward points for 1W and 1M, and spot date but we want to price a 3W forward, or any arbitrary horizon
@@ -168,6 +366,7 @@ class FXForwardsPricer(AbstractPricer):
         self._calendar = Calendar()
         self._market_df = market_df
         self._quoted_delivery_df = quoted_delivery_df
+        self._quoted_delivery_cache = QuotedDeliveryCache()
 
     def price_instrument(self, cross, horizon_date, delivery_date,
                          option_expiry_date=None, market_df=None,
@@ -331,10 +530,12 @@ class FXForwardsPricer(AbstractPricer):
                                                   for tenor in
                                                   fx_forwards_tenor])
 
+            # Delivery dates only depend on the calendar, so are cached between calls
             for tenor in fx_forwards_tenor:
                 quoted_delivery_df[cross + tenor + ".delivery"] = \
-                    self._calendar.get_delivery_date_from_horizon_date(
-                        quoted_delivery_df.index, tenor, cal=cal)
+                    self._quoted_delivery_cache.get_delivery_date(
+                        cross, quoted_delivery_df.index, tenor, cal=cal,
+                        calendar=self._calendar)
 
         return quoted_delivery_df
 
@@ -449,3 +650,110 @@ class FXForwardsPricer(AbstractPricer):
                                 implied_currency + x + "-implied-depo.close"
                                 for x in fx_forwards_tenor],
                             data=implied_depo_arr * 100.0)
+
+    def calculate_implied_depo_panel(self, crosses, implied_currency=None, market_df=None,
+                                     fx_forwards_tenor=market_constants.fx_forwards_tenor_for_interpolation,
+                                     depo_tenor=None):
+        """Calculates implied deposit rates for many currency pairs and tenors in one go (eg. to monitor the
+        cross-currency basis every day), in the same way as calculate_implied_depo. The spot dates and quoted delivery
+        dates are only generated once for each currency pair, and the implied deposits for every currency pair, date
+        and tenor are then calculated together.
+
+        Parameters
+        ----------
+        crosses : str (list)
+            Currency pairs
+
+        implied_currency : str (list)
+            Currency for which we want to imply deposit, for each currency pair (default - base currency of each)
+
+        market_df : DataFrame
+            With FX spot rate, FX forward points and deposit rates for all the currency pairs
+
+        fx_forwards_tenor : str (list)
+            Tenors of forwards where we want to imply deposit
+
+        depo_tenor : str (list)
+            Deposit rate to use for each tenor (default - same as the forwards tenor)
+
+        Returns
+        -------
+        DataFrame
+            One row for each date, currency pair and tenor, with the implied deposit (and the deposit of the other
+            currency which was used), both in %
+        """
+        if not (isinstance(crosses, list)):
+            crosses = [crosses]
+
+        if not (isinstance(fx_forwards_tenor, list)):
+            fx_forwards_tenor = [fx_forwards_tenor]
+
+        if market_df is None: market_df = self._market_df
+        if implied_currency is None: implied_currency = [x[0:3] for x in crosses]
+        if depo_tenor is None: depo_tenor = fx_forwards_tenor
+
+        if not (isinstance(implied_currency, list)):
+            implied_currency = [implied_currency] * len(crosses)
+
+        if not (isinstance(depo_tenor, list)):
+            depo_tenor = [depo_tenor] * len(fx_forwards_tenor)
+
+        no_of_tenors = len(fx_forwards_tenor)
+
+        spot_arr = np.zeros((len(crosses), len(market_df.index)))
+        outright_forwards_arr = np.zeros((len(crosses), len(market_df.index), no_of_tenors))
+        depo_arr = np.zeros((len(crosses), len(market_df.index), no_of_tenors))
+        quoted_delivery_days_arr = np.zeros((len(crosses), len(market_df.index), no_of_tenors))
+        base_conv = np.zeros(len(crosses))
+        terms_conv = np.zeros(len(crosses))
+
+        implied_base = np.zeros(len(crosses), dtype=bool)
+        original_currency = []
+
+        for i, cross in enumerate(crosses):
+            if implied_currency[i] == cross[0:3]:
+                implied_base[i] = True
+                original_currency.append(cross[3:6])
+            elif implied_currency[i] == cross[3:6]:
+                original_currency.append(cross[0:3])
+            else:
+                raise ValueError(implied_currency[i] + " is not a currency of " + cross)
+
+            # Get the spot date (different currency pairs have different conventions for this!)
+            spot_date = self._calendar.get_spot_date_from_horizon_date(market_df.index, cross)
+
+            _, quoted_delivery_days_arr[i], forwards_points_arr, _ = \
+                self._setup_forwards_calculation(cross, spot_date, market_df, None, fx_forwards_tenor)
+
+            spot_arr[i] = market_df[cross + '.close'].values
+            outright_forwards_arr[i] = spot_arr[i][:, np.newaxis] + forwards_points_arr
+            depo_arr[i] = market_df[[original_currency[i] + d + '.close' for d in depo_tenor]].values / 100.0
+
+            base_conv[i] = self.get_day_count_conv(cross[0:3])
+            terms_conv[i] = self.get_day_count_conv(cross[3:6])
+
+        implied_depo_arr = np.zeros(outright_forwards_arr.shape)
+
+        # Each kernel handles all the currency pairs where we're inferring the base (or terms) currency at once
+        for infer_depo_numba, ind in [(_infer_base_currency_depo_numba, implied_base),
+                                      (_infer_terms_currency_depo_numba, ~implied_base)]:
+            if ind.any():
+                implied_depo_arr[ind] = infer_depo_numba(spot_arr[ind], outright_forwards_arr[ind], depo_arr[ind],
+                                                         quoted_delivery_days_arr[ind], base_conv[ind],
+                                                         terms_conv[ind], no_of_tenors)
+
+        # Tidy format, with one row for each currency pair, date and tenor
+        shape = implied_depo_arr.shape
+
+        def repeat(arr, axis):
+            return np.broadcast_to(np.expand_dims(np.asarray(arr), [a for a in range(3) if a != axis]),
+                                   shape).ravel()
+
+        return pd.DataFrame({"date": repeat(market_df.index.values, 1),
+                             "cross": repeat(crosses, 0),
+                             "tenor": repeat(fx_forwards_tenor, 2),
+                             "implied_currency": repeat(implied_currency, 0),
+                             "original_currency": repeat(original_currency, 0),
+                             "delivery_days": quoted_delivery_days_arr.ravel(),
+                             "original_depo": depo_arr.ravel() * 100.0,
+                             "implied_depo": implied_depo_arr.ravel() * 100.0})
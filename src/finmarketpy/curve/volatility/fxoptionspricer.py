@@ -14,6 +14,8 @@ __author__ = 'saeedamen'  # Saeed Amen
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import math
+
 import numpy as np
 import pandas as pd
 
@@ -39,19 +41,51 @@ except:
 market_constants = MarketConstants()
 
 
+@guvectorize(['void(f8[:], f8[:], f8[:], f8[:], f8[:], f8[:], f8[:], f8[:], f8[:])'],
+             '(n),(n),(n),(n),(n),(n),(n)->(n),(n)', cache=True, target="cpu",
+             nopython=True)
+def _garman_kohlhagen_numba(spot, strike, texp, rd, rf, vol, phi, value,
+                            spot_delta):
+    for i in range(len(spot)):
+
+        # Same floors as FinancePy, so options expiring today still have a value
+        t = max(texp[i], 1e-12)
+        v = max(vol[i], 1e-12)
+
+        vsqrt_t = v * math.sqrt(t)
+        for_df = math.exp(-rf[i] * t)
+        ss = spot[i] * for_df
+        kk = max(strike[i], 1e-12) * math.exp(-rd[i] * t)
+
+        d1 = math.log(ss / kk) / vsqrt_t + vsqrt_t / 2.0
+        d2 = d1 - vsqrt_t
+
+        # Normal CDF N(phi * d)
+        n_d1 = 0.5 * math.erfc(-phi[i] * d1 / math.sqrt(2.0))
+        n_d2 = 0.5 * math.erfc(-phi[i] * d2 / math.sqrt(2.0))
+
+        # Value is in terms currency pips (ie. domestic)
+        value[i] = phi[i] * (ss * n_d1 - kk * n_d2)
+        spot_delta[i] = phi[i] * for_df * n_d1
+
+
 class FXOptionsPricer(AbstractPricer):
-    """Prices various vanilla FX options, using FinancePy underneath.
+    """Prices various vanilla FX options, using FinancePy underneath, or
+    alternatively with finmarketpy's own vectorised Garman-Kohlhagen engine,
+    which prices every option in one go.
     """
 
     def __init__(self, fx_vol_surface=None,
                  premium_output=market_constants.fx_options_premium_output,
-                 delta_output=market_constants.fx_options_delta_output):
+                 delta_output=market_constants.fx_options_delta_output,
+                 pricing_engine=market_constants.fx_options_pricing_engine):
 
         self._calendar = Calendar()
         self._fx_vol_surface = fx_vol_surface
         self._fx_forwards_pricer = FXForwardsPricer()
         self._premium_output = premium_output
         self._delta_output = delta_output
+        self._pricing_engine = pricing_engine
 
     def price_instrument(self,
                          cross,
@@ -66,7 +100,8 @@ class FXOptionsPricer(AbstractPricer):
                          delta_output=None,
                          depo_tenor=None,
                          use_atm_quoted=False,
-                         return_as_df=True):
+                         return_as_df=True,
+                         pricing_engine=None):
         """Prices FX options for horizon dates/expiry dates given by the user from FX spot rates, FX volatility surface
         and deposit rates.
 
@@ -124,6 +159,11 @@ class FXOptionsPricer(AbstractPricer):
             True - returns output as DataFrame
             False - returns output as np.ndarray
 
+        pricing_engine : str
+            'financepy' - prices each option with FinancePy
+            'finmarketpy' - prices all the options in one go (vol surface is
+            only built for dates where the strike/vol needs to be found)
+
         Returns
         -------
         DataFrame
@@ -133,6 +173,7 @@ class FXOptionsPricer(AbstractPricer):
         if fx_vol_surface is None: fx_vol_surface = self._fx_vol_surface
         if premium_output is None: premium_output = self._premium_output
         if delta_output is None: delta_output = self._delta_output
+        if pricing_engine is None: pricing_engine = self._pricing_engine
 
         logger = LoggerManager().getLogger(__name__)
 
@@ -247,7 +288,9 @@ class FXOptionsPricer(AbstractPricer):
                             vol[i] = fx_vol_surface.get_10d_put_vol(
                                 tenor) / 100.0
 
-                if not built_vol_surface:
+                # The finmarketpy engine only needs the vol surface to interpolate vol
+                if not built_vol_surface and (pricing_engine == "financepy"
+                                              or np.isnan(vol[i])):
                     try:
                         fx_vol_surface.build_vol_surface(horizon_date[i])
                     except:
@@ -268,6 +311,10 @@ class FXOptionsPricer(AbstractPricer):
                             i] = fx_vol_surface.calculate_vol_for_strike_expiry(
                             strike[i], expiry_date=None, tenor=tenor)
 
+                # Priced below, all in one go
+                if pricing_engine == "finmarketpy":
+                    continue
+
                 model = BlackScholes(float(vol[i]))
 
                 logger.info(
@@ -334,6 +381,32 @@ class FXOptionsPricer(AbstractPricer):
                                         fx_vol_surface.get_for_discount_curve(),
                                         model)[delta_output.replace('-', '_')]
 
+            if pricing_engine == "finmarketpy":
+                logger.info("Pricing " + contract_type_ + " options, from "
+                            + str(horizon_date[0]) + " to " + str(horizon_date[-1]))
+
+                spot[:], dom_depo, for_depo = \
+                    fx_vol_surface.get_spot_depo_rates(horizon_date)
+
+                strike_ = strike.astype(np.float64)
+
+                option_values_, delta_ = self.price_vanilla(
+                    horizon_date, expiry_date, spot, strike_, vol, dom_depo,
+                    for_depo, contract_type=contract_type_, notional=notional,
+                    cross=cross, premium_output=premium_output,
+                    delta_output=delta_output)
+
+                option_values[:] = option_values + option_values_
+                delta[:] = delta + delta_
+
+                if contract_type == "european-call":
+                    intrinsic_values[:] = np.maximum(spot - strike_, 0)
+                elif contract_type == "european-put":
+                    intrinsic_values[:] = np.maximum(strike_ - spot, 0)
+
+                if "pct-for" in premium_output:
+                    intrinsic_values[:] = intrinsic_values / spot
+
         if contract_type == "european-call":
             contract_type_fin = OptionTypes.EUROPEAN_CALL
 
@@ -369,6 +442,146 @@ class FXOptionsPricer(AbstractPricer):
 
         return option_values, spot, strike, vol, delta, expiry_date, intrinsic_values
 
+    def price_vanilla(self, horizon_date, expiry_date, spot, strike, vol,
+                      dom_depo, for_depo, contract_type="european-call",
+                      notional=1000000, cross=None, premium_output=None,
+                      delta_output=None):
+        """Prices European FX options with Garman-Kohlhagen, vectorised
+        across arrays of horizon dates, expiry dates, strikes, vols and
+        depo rates (so a history of options can be priced in one call). It
+        follows the same conventions as FinancePy's FXVanillaOption, with
+        delivery on the expiry date, and notional in the base currency.
+
+        Parameters
+        ----------
+        horizon_date : DateTimeIndex
+            Horizon dates for options
+
+        expiry_date : DateTimeIndex
+            Expiry dates for options
+
+        spot : np.ndarray or float
+            FX spot rate on the horizon dates
+
+        strike : np.ndarray or float
+            Strike of options
+
+        vol : np.ndarray or float
+            Implied vol of options (eg. 0.1 for 10%)
+
+        dom_depo : np.ndarray or float
+            Continuously compounded rate of the terms currency (eg. 0.02 for 2%)
+
+        for_depo : np.ndarray or float
+            Continuously compounded rate of the base currency
+
+        contract_type : str
+            "european-call", "european-put", "european-straddle" or
+            "european-strangle" (with the same strike for call and put)
+
+        notional : float
+            Notional in base currency of the option
+
+        cross : str (optional)
+            Currency pair (only used in error messages)
+
+        premium_output : str
+            eg. "pct-for", "pct-dom", "pips-for", "pips-dom", "cash-for",
+            "cash-dom" or "v"
+
+        delta_output : str
+            eg. "pips-spot-delta", "pips-fwd-delta", "pct-spot-delta-prem-adj"
+            or "pct-fwd-delta-prem-adj"
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+        """
+        if premium_output is None: premium_output = self._premium_output
+        if delta_output is None: delta_output = self._delta_output
+
+        if isinstance(horizon_date, pd.Timestamp):
+            horizon_date = pd.DatetimeIndex([horizon_date])
+        else:
+            horizon_date = pd.DatetimeIndex(horizon_date)
+
+        if isinstance(expiry_date, pd.Timestamp):
+            expiry_date = pd.DatetimeIndex([expiry_date])
+        else:
+            expiry_date = pd.DatetimeIndex(expiry_date)
+
+        # Single horizon date for many expiries (or vice versa)
+        if len(horizon_date) == 1:
+            horizon_date = horizon_date.repeat(len(expiry_date))
+        elif len(expiry_date) == 1:
+            expiry_date = expiry_date.repeat(len(horizon_date))
+
+        # Year fractions measured in (fractional) days/365, as FinancePy
+        texp = np.asarray((expiry_date - horizon_date) / np.timedelta64(1, "D"),
+                          dtype=np.float64) / 365.0
+
+        spot, strike, texp, vol, dom_depo, for_depo = [
+            np.ascontiguousarray(x, dtype=np.float64) for x in np.broadcast_arrays(
+                spot, strike, texp, vol, dom_depo, for_depo)]
+
+        if contract_type == "european-call":
+            phi = [1.0]
+        elif contract_type == "european-put":
+            phi = [-1.0]
+        elif contract_type in ["european-straddle", "european-strangle"]:
+            phi = [1.0, -1.0]
+        else:
+            raise ValueError("Unknown contract type " + str(contract_type))
+
+        value = np.zeros(len(spot))
+        spot_delta = np.zeros(len(spot))
+
+        for p in phi:
+            value_, spot_delta_ = _garman_kohlhagen_numba(
+                spot, strike, texp, dom_depo, for_depo, vol,
+                np.full(len(spot), p))
+
+            value = value + value_
+            spot_delta = spot_delta + spot_delta_
+
+        # Options which have already expired can't be priced
+        value[texp < 0] = np.nan
+        spot_delta[texp < 0] = np.nan
+
+        premium_output = premium_output.replace("-", "_")
+        delta_output = delta_output.replace("-", "_")
+
+        # Premium currency is the base currency, ie. notional is in base
+        if premium_output in ["v", "pips_dom"]:
+            option_values = value
+        elif premium_output == "pips_for":
+            option_values = value / (spot * strike)
+        elif premium_output == "pct_dom":
+            option_values = value / strike
+        elif premium_output == "pct_for":
+            option_values = value / spot
+        elif premium_output == "cash_dom":
+            option_values = value * notional
+        elif premium_output == "cash_for":
+            option_values = value * notional / spot
+        else:
+            raise ValueError("Unknown premium output " + premium_output
+                             + (" for " + cross if cross is not None else ""))
+
+        if delta_output == "pips_spot_delta":
+            delta = spot_delta
+        elif delta_output == "pips_fwd_delta":
+            delta = spot_delta * np.exp(for_depo * texp)
+        elif delta_output == "pct_spot_delta_prem_adj":
+            delta = spot_delta - value / spot
+        elif delta_output == "pct_fwd_delta_prem_adj":
+            delta = np.exp(for_depo * texp) * (spot_delta - value / spot)
+        else:
+            raise ValueError("Unknown delta output " + delta_output
+                             + (" for " + cross if cross is not None else ""))
+
+        return option_values, delta
+
     def get_day_count_conv(self, currency):
         if currency in market_constants.currencies_with_365_basis:
             return 365.0
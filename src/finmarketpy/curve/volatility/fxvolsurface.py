@@ -16,9 +16,19 @@ __author__ = "saeedamen"
 #
 
 
+import contextlib
+import hashlib
+import inspect
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
 import pandas as pd
 import numpy as np
 
+from numba import njit
+
 # FinancePy is an optional dependency
 try:
     from financepy.market.curves.discount_curve_flat import DiscountCurveFlat
@@ -35,19 +45,262 @@ try:
         VolFuncTypes
 
     from financepy.utils.global_types import FinSolverTypes
+
+    import financepy.market.volatility.fx_vol_surface_plus as fin_fx_vol_surface_plus
+
+    _fin_obj = fin_fx_vol_surface_plus._obj
+
+    @njit(fastmath=True)
+    def _counted_obj(params, counter, *args):
+        # Counts how many times the solver evaluates FinancePy's objective function
+        counter[0] += 1
+
+        return _fin_obj(params, *args)
 except:
     pass
 
+from findatapy.util import LoggerManager, SwimPool
 from findatapy.util.dataconstants import DataConstants
 
 from finmarketpy.curve.volatility.abstractvolsurface import AbstractVolSurface
+from finmarketpy.curve.volatility.fxvolsurfacehistory import FXVolSurfaceHistory
 from finmarketpy.util.marketconstants import MarketConstants
 from finmarketpy.util.marketutil import MarketUtil
+from finmarketpy.util.shareddataframe import SharedDataFrame
 
 data_constants = DataConstants()
 market_constants = MarketConstants()
 
 
+class FXVolSurfaceCache(object):
+    """Process wide LRU cache of calibrated FinancePy FX vol surfaces, keyed by a hash of the value date, the market
+    quotes for that date and the calibration settings (vol function, ATM/delta methods, solver etc.). Hence, pricing
+    several options on the same date (or rerunning the same backtest) only needs to calibrate each surface once.
+
+    Calibrated surfaces can also be persisted to disk (eg. so they survive between backtest runs), by setting
+    MarketConstants.fx_options_vol_surface_cache_folder
+    """
+
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, max_size=None, folder=None):
+        if max_size is None: max_size = market_constants.fx_options_vol_surface_cache_size
+        if folder is None: folder = market_constants.fx_options_vol_surface_cache_folder
+
+        self._max_size = max_size
+        self._folder = folder
+
+    def get(self, key):
+        """Gets a calibrated vol surface from memory (or disk), if it exists
+
+        Parameters
+        ----------
+        key : str
+            Hash of the value date, market quotes and calibration settings
+
+        Returns
+        -------
+        FinFXVolSurface
+        """
+        if self._max_size <= 0:
+            return None
+
+        with self._lock:
+            fin_fx_vol_surface = self._cache.get(key)
+
+            if fin_fx_vol_surface is not None:
+                self._cache.move_to_end(key)
+
+                return fin_fx_vol_surface
+
+        fin_fx_vol_surface = self._load(key)
+
+        if fin_fx_vol_surface is not None:
+            self._put_in_memory(key, fin_fx_vol_surface)
+
+        return fin_fx_vol_surface
+
+    def put(self, key, fin_fx_vol_surface):
+        """Adds a calibrated vol surface to the cache
+
+        Parameters
+        ----------
+        key : str
+            Hash of the value date, market quotes and calibration settings
+
+        fin_fx_vol_surface : FinFXVolSurface
+            Calibrated vol surface
+        """
+        if self._max_size <= 0:
+            return
+
+        self._put_in_memory(key, fin_fx_vol_surface)
+        self._save(key, fin_fx_vol_surface)
+
+    def clear(self):
+        """Clears the cache in memory (but not any files on disk)
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def _put_in_memory(self, key, fin_fx_vol_surface):
+        with self._lock:
+            self._cache[key] = fin_fx_vol_surface
+            self._cache.move_to_end(key)
+
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+
+    def _get_path(self, key):
+        return os.path.join(self._folder, 'fx_vol_surface_' + key + '.pkl')
+
+    def _load(self, key):
+        if self._folder is None:
+            return None
+
+        path = self._get_path(key)
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    return pickle.load(f)
+            except Exception:
+                return None
+
+        return None
+
+    def _save(self, key, fin_fx_vol_surface):
+        if self._folder is None:
+            return
+
+        os.makedirs(self._folder, exist_ok=True)
+
+        # Write to a temporary file first, so other processes never read a partially written file
+        path = self._get_path(key)
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+
+        with open(temp_path, 'wb') as f:
+            pickle.dump(fin_fx_vol_surface, f)
+
+        os.replace(temp_path, path)
+
+
+class _CalibrationMonitor(object):
+    """Hooks into FinancePy's FX vol surface calibration, which doesn't let us give initial parameters to the
+    solver or report how it converged. While active, it can replace the initial parameters for each tenor (eg. with
+    the previous day's fitted parameters) and records the iterations, objective function calls and residual of
+    the solver for each tenor.
+
+    """
+
+    # FinancePy's module is patched while calibrating, so only one calibration can be monitored at a time (and
+    # unmonitored calibrations also need to take the lock, so they never run through the patched functions)
+    _lock = threading.RLock()
+
+    def __init__(self, x_inits=None):
+        self._x_inits = x_inits
+
+        self.iterations = []
+        self.function_calls = []
+        self.residual = []
+
+        self._originals = {}
+
+    def __enter__(self):
+        # FinancePy's _solve_to_horizon is private, so check it still takes the initial parameters (by name, rather
+        # than relying on their position)
+        self._solve_to_horizon_signature = inspect.signature(fin_fx_vol_surface_plus._solve_to_horizon)
+
+        if self._x_inits is not None and 'x_inits' not in self._solve_to_horizon_signature.parameters:
+            raise Exception("Cannot warm start the vol surface calibration, FinancePy's _solve_to_horizon has no "
+                            "x_inits parameter")
+
+        self._lock.acquire()
+
+        for name in ['_solve_to_horizon', 'nelder_mead', 'minimize']:
+            self._originals[name] = getattr(fin_fx_vol_surface_plus, name)
+
+        fin_fx_vol_surface_plus._solve_to_horizon = self._solve_to_horizon
+        fin_fx_vol_surface_plus.nelder_mead = self._nelder_mead
+        fin_fx_vol_surface_plus.minimize = self._minimize
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for name, func in self._originals.items():
+            setattr(fin_fx_vol_surface_plus, name, func)
+
+        self._lock.release()
+
+    def get_diagnostics(self, tenors):
+        return pd.DataFrame({'iterations': self.iterations, 'function_calls': self.function_calls,
+                             'residual': self.residual}, index=tenors)
+
+    def _solve_to_horizon(self, *args, **kwargs):
+        # Called once for each tenor, in order
+        tenor_index = len(self.residual)
+
+        self.iterations.append(0)
+        self.function_calls.append(0)
+        self.residual.append(np.nan)
+
+        if self._x_inits is not None:
+            bound_args = self._solve_to_horizon_signature.bind(*args, **kwargs)
+            bound_args.arguments['x_inits'] = self._x_inits[tenor_index].copy()
+
+            args, kwargs = bound_args.args, bound_args.kwargs
+
+        return self._originals['_solve_to_horizon'](*args, **kwargs)
+
+    def _nelder_mead(self, fun, x0, *args, **kwargs):
+        # Numba solver doesn't report its iterations, but we can count the objective function calls
+        counter = np.zeros(1, dtype=np.int64)
+        fun_args = tuple(kwargs.pop('args', ()))
+
+        xopt = self._originals['nelder_mead'](_counted_obj, x0, *args, args=(counter,) + fun_args, **kwargs)
+
+        self.iterations[-1] = np.nan
+        self.function_calls[-1] += int(counter[0])
+        self.residual[-1] = float(fun(xopt, *fun_args))
+
+        return xopt
+
+    def _minimize(self, fun, x0, args=(), **kwargs):
+        opt = self._originals['minimize'](fun, x0, args, **kwargs)
+
+        self.iterations[-1] += opt.nit
+        self.function_calls[-1] += opt.nfev
+        self.residual[-1] = float(opt.fun)
+
+        return opt
+
+
+def _build_vol_surface_history(market_df, asset, kwargs, value_date, warm_start, calibration_diagnostics):
+    # Runs in a separate process, with only the market data for these dates
+    return FXVolSurface(market_df=market_df, asset=asset, **kwargs)._build_vol_surface_history(
+        value_date, warm_start=warm_start, calibration_diagnostics=calibration_diagnostics)
+
+
+class _SharedFXVolSurface(object):
+    """Lightweight handle to an FXVolSurface to send to other processes. Its market data is published once to shared
+    memory, and the vol surface is created again from it (with the same settings) in each process, rather than
+    pickling the vol surface and its market data for every task.
+
+    """
+
+    def __init__(self, fx_vol_surface):
+        self._shared_market_df = SharedDataFrame(fx_vol_surface.get_all_market_data())
+        self._asset = fx_vol_surface._asset
+        self._kwargs = fx_vol_surface._kwargs
+
+    def get_fx_vol_surface(self):
+        return FXVolSurface(market_df=self._shared_market_df.get_df(), asset=self._asset, **self._kwargs)
+
+    def close(self):
+        self._shared_market_df.close()
+
+
 class FXVolSurface(AbstractVolSurface):
     """Holds data for an FX vol surface and also interpolates vol surface,
     converts strikes to implied vols etc.
@@ -62,7 +315,9 @@ class FXVolSurface(AbstractVolSurface):
                  depo_tenor=market_constants.fx_options_depo_tenor,
                  solver=market_constants.fx_options_solver,
                  alpha=market_constants.fx_options_alpha,
-                 tol=market_constants.fx_options_tol):
+                 tol=market_constants.fx_options_tol,
+                 cache_size=market_constants.fx_options_vol_surface_cache_size,
+                 cache_folder=market_constants.fx_options_vol_surface_cache_folder):
         """Initialises object, with market data and various market conventions
 
         Parameters
@@ -102,7 +357,19 @@ class FXVolSurface(AbstractVolSurface):
 
         alpha : float
             Between 0 and 1 (default 0.5)
+
+        cache_size : int
+            Maximum number of calibrated vol surfaces to keep in the process wide cache (0 disables the cache)
+
+        cache_folder : str
+            Folder to persist calibrated vol surfaces to disk (if None, they are only kept in memory)
         """
+        # To create the same vol surface in other processes
+        self._kwargs = {"field": field, "tenors": tenors, "vol_function_type": vol_function_type,
+                        "atm_method": atm_method, "delta_method": delta_method, "depo_tenor": depo_tenor,
+                        "solver": solver, "alpha": alpha, "tol": tol, "cache_size": cache_size,
+                        "cache_folder": cache_folder}
+
         self._market_df = market_df
         self._tenors = tenors
         self._asset = asset
@@ -118,6 +385,10 @@ class FXVolSurface(AbstractVolSurface):
         self._fin_fx_vol_surface = None
         self._df_vol_dict = None
 
+        # Fitted parameters of the last calibrated vol surface, and how its calibration converged
+        self._warm_start_parameters = None
+        self._calibration_diagnostics = None
+
         for_name_base = asset[0:3]
         dom_name_terms = asset[3:6]
 
@@ -130,16 +401,24 @@ class FXVolSurface(AbstractVolSurface):
                               dom_name_terms + depo_tenor + field].values / 100.0  # 0.02940  # USD
 
         self._spot_history = market_df[asset + field].values
-        self._atm_vols = market_df[
-            [asset + "V" + t + field for t in tenors]].values
-        self._market_strangle25DeltaVols = market_df[
-            [asset + "25B" + t + field for t in tenors]].values
-        self._risk_reversal25DeltaVols = market_df[
-            [asset + "25R" + t + field for t in tenors]].values
-        self._market_strangle10DeltaVols = market_df[
-            [asset + "10B" + t + field for t in tenors]].values
-        self._risk_reversal10DeltaVols = market_df[
-            [asset + "10R" + t + field for t in tenors]].values
+
+        # All the vol quotes for each date are contiguous in memory (date x quote x tenor), so building the vol surface
+        # for a date only needs to fetch one row
+        self._vol_quotes = np.ascontiguousarray(np.stack(
+            [market_df[[asset + q + t + field for t in tenors]].values for q in ["V", "25B", "25R", "10B", "10R"]],
+            axis=1), dtype=np.float64)
+
+        self._atm_vols = self._vol_quotes[:, 0]
+        self._market_strangle25DeltaVols = self._vol_quotes[:, 1]
+        self._risk_reversal25DeltaVols = self._vol_quotes[:, 2]
+        self._market_strangle10DeltaVols = self._vol_quotes[:, 3]
+        self._risk_reversal10DeltaVols = self._vol_quotes[:, 4]
+
+        # Lookup from date to row of the market data (for the first row, if a date is repeated)
+        self._date_row = {}
+
+        for i, date in enumerate(market_df.index):
+            self._date_row.setdefault(date, i)
 
         if vol_function_type == "CLARK":
             self._vol_function_type = VolFuncTypes.CLARK
@@ -185,7 +464,9 @@ class FXVolSurface(AbstractVolSurface):
         self._alpha = alpha
         self._tol = tol
 
-    def build_vol_surface(self, value_date):
+        self._vol_surface_cache = FXVolSurfaceCache(max_size=cache_size, folder=cache_folder)
+
+    def build_vol_surface(self, value_date, warm_start=False, calibration_diagnostics=False):
         """Builds the implied volatility surface for a particular value date and calculates the benchmark strikes etc.
 
         Before we do any sort of interpolation later, we need to build the implied_vol vol surface.
@@ -195,6 +476,14 @@ class FXVolSurface(AbstractVolSurface):
         value_date : str
             Value date (need to have market data for this date)
 
+        warm_start : bool
+            Start the solver from the parameters of the last vol surface built (eg. the previous day's), rather
+            than from scratch, which typically converges more quickly when walking through history in order
+
+        calibration_diagnostics : bool
+            Record the iterations, objective function calls and residual of the solver for each tenor (see
+            get_calibration_diagnostics), which is always done when warm starting
+
         asset : str
             Asset name
 
@@ -213,18 +502,56 @@ class FXVolSurface(AbstractVolSurface):
 
         value_fin_date = self._findate(self._value_date)
 
-        date_index = self._market_df.index == value_date
+        date_row = self._get_date_row(value_date)
 
         # TODO: add whole rates curve
         dom_discount_curve = DiscountCurveFlat(value_fin_date,
-                                               self._domCCRate[date_index])
+                                               self._domCCRate[date_row])
         for_discount_curve = DiscountCurveFlat(value_fin_date,
-                                               self._forCCRate[date_index])
+                                               self._forCCRate[date_row])
 
         self._dom_discount_curve = dom_discount_curve
         self._for_discount_curve = for_discount_curve
 
-        self._spot = float(self._spot_history[date_index][0])
+        self._spot = float(self._spot_history[date_row])
+
+        x_inits = None
+
+        if warm_start and self._warm_start_parameters is not None \
+                and np.isfinite(self._warm_start_parameters).all():
+            x_inits = self._warm_start_parameters
+
+        # Skip the calibration if we've already fitted a surface with the same quotes and settings (and started the
+        # solver from the same place, given warm starting can converge to slightly different parameters)
+        key = self._get_vol_surface_cache_key(date_row, x_inits=x_inits)
+
+        self._fin_fx_vol_surface = self._vol_surface_cache.get(key)
+        self._calibration_diagnostics = None
+
+        if self._fin_fx_vol_surface is not None:
+            self._warm_start_parameters = np.array(self._fin_fx_vol_surface.parameters)
+
+            return
+
+        calibration_monitor = contextlib.nullcontext()
+
+        if warm_start or calibration_diagnostics:
+            calibration_monitor = _CalibrationMonitor(x_inits=x_inits)
+
+        # Always hold the lock, so a calibration on another thread can't use the initial parameters or add to the
+        # diagnostics of this one
+        with _CalibrationMonitor._lock, calibration_monitor:
+            self._build_fin_fx_vol_surface(value_fin_date, date_row)
+
+        if isinstance(calibration_monitor, _CalibrationMonitor):
+            self._calibration_diagnostics = calibration_monitor.get_diagnostics(self._tenors)
+
+        self._warm_start_parameters = np.array(self._fin_fx_vol_surface.parameters)
+
+        self._vol_surface_cache.put(key, self._fin_fx_vol_surface)
+
+    def _build_fin_fx_vol_surface(self, value_fin_date, date_row):
+        vol_quotes = self._vol_quotes[date_row]
 
         # New implementation in FinancePy also uses 10d for interpolation
         self._fin_fx_vol_surface = FinFXVolSurface(
@@ -232,19 +559,14 @@ class FXVolSurface(AbstractVolSurface):
             self._spot,
             self._asset,
             self._asset[0:3],
-            dom_discount_curve,
-            for_discount_curve,
+            self._dom_discount_curve,
+            self._for_discount_curve,
             self._tenors.copy(),
-            self._atm_vols[date_index][
-                0],
-            self._market_strangle25DeltaVols[
-                date_index][0],
-            self._risk_reversal25DeltaVols[
-                date_index][0],
-            self._market_strangle10DeltaVols[
-                date_index][0],
-            self._risk_reversal10DeltaVols[
-                date_index][0],
+            vol_quotes[0],
+            vol_quotes[1],
+            vol_quotes[2],
+            vol_quotes[3],
+            vol_quotes[4],
             self._alpha,
             atm_method=self._atm_method,
             delta_method=self._delta_method,
@@ -252,6 +574,134 @@ class FXVolSurface(AbstractVolSurface):
             fin_solver_type=self._solver,
             tol=self._tol)  # TODO add tol
 
+    def build_vol_surface_history(self, value_date=None, run_in_parallel=True, thread_no=None, warm_start=False,
+                                  calibration_diagnostics=False):
+        """Calibrates the vol surface for many dates, splitting the dates between several processes, and returns the
+        fitted parameters, key strikes and their vols for every date in a compact store, which can be used later
+        without having to calibrate again. Dates where the vol surface can't be calibrated are left as NaN.
+
+        Parameters
+        ----------
+        value_date : DateTimeIndex
+            Value dates (default - every date of the market data)
+
+        run_in_parallel : bool
+            Split the dates between several processes
+
+        thread_no : int
+            Number of processes (default - MarketConstants.fx_options_vol_surface_thread_no)
+
+        warm_start : bool
+            Calibrate the dates in order, starting the solver for each date from the previous date's parameters (when
+            run in parallel, each process walks through its own block of dates in order)
+
+        calibration_diagnostics : bool
+            Record the iterations, objective function calls and residual of the solver for each date and tenor
+            (always done when warm starting)
+
+        Returns
+        -------
+        FXVolSurfaceHistory
+        """
+        if value_date is None: value_date = self._market_df.index
+        if thread_no is None: thread_no = market_constants.fx_options_vol_surface_thread_no[
+            market_constants.generic_plat]
+
+        value_date = pd.DatetimeIndex(value_date)
+
+        thread_no = max(min(thread_no, len(value_date)), 1)
+
+        if not run_in_parallel or thread_no == 1:
+            return self._build_vol_surface_history(value_date, warm_start=warm_start,
+                                                   calibration_diagnostics=calibration_diagnostics)
+
+        logger = LoggerManager().getLogger(__name__)
+        logger.info("Calibrating " + self._asset + " vol surface for " + str(len(value_date)) + " dates in "
+                    + str(thread_no) + " processes")
+
+        swim_pool = SwimPool(multiprocessing_library=market_constants.multiprocessing_library)
+
+        pool = swim_pool.create_pool(thread_technique=market_constants.fx_options_vol_surface_thread_technique,
+                                     thread_no=thread_no)
+
+        try:
+            # Contiguous blocks of dates, so the results are in the same order as the dates, and each process only
+            # gets the market data it needs
+            results = []
+
+            for value_date_chunk in np.array_split(np.arange(len(value_date)), thread_no):
+                value_date_chunk = value_date[value_date_chunk]
+
+                results.append(pool.apply_async(_build_vol_surface_history, args=(
+                    self._market_df[self._market_df.index.isin(value_date_chunk)], self._asset, self._kwargs,
+                    value_date_chunk, warm_start, calibration_diagnostics)))
+
+            fx_vol_surface_history = FXVolSurfaceHistory.concat([r.get() for r in results])
+        finally:
+            swim_pool.close_pool(pool, force_process_respawn=True)
+
+        return fx_vol_surface_history
+
+    def _build_vol_surface_history(self, value_date, warm_start=False, calibration_diagnostics=False):
+        logger = LoggerManager().getLogger(__name__)
+
+        key_strikes_names = FXVolSurfaceHistory.key_strikes_names
+
+        no_of_tenors = len(self._tenors)
+
+        strikes = np.full((len(value_date), len(key_strikes_names), no_of_tenors), np.nan)
+        vols = np.full((len(value_date), len(key_strikes_names), no_of_tenors), np.nan)
+        fwd = np.full((len(value_date), no_of_tenors), np.nan)
+        t_exp = np.full((len(value_date), no_of_tenors), np.nan)
+        calibrated = np.zeros(len(value_date), dtype=bool)
+
+        # Left as NaN if not recorded (or the vol surface came from the cache)
+        iterations = np.full((len(value_date), no_of_tenors), np.nan)
+        function_calls = np.full((len(value_date), no_of_tenors), np.nan)
+        residual = np.full((len(value_date), no_of_tenors), np.nan)
+
+        parameters = None
+
+        # The first date always starts from scratch
+        self._warm_start_parameters = None
+
+        for i in range(len(value_date)):
+            try:
+                self.build_vol_surface(value_date[i], warm_start=warm_start,
+                                       calibration_diagnostics=calibration_diagnostics)
+                df_vol_dict = self.extract_vol_surface(num_strike_intervals=None)
+            except Exception as e:
+                logger.warning("Failed to calibrate " + self._asset + " vol surface for " + str(value_date[i])
+                               + ": " + str(e))
+
+                continue
+
+            strikes[i] = df_vol_dict["deltas_vs_strikes"].loc[key_strikes_names].values
+            vols[i] = df_vol_dict["vol_surface_delta_space"].loc[key_strikes_names].values
+            fwd[i] = self._fin_fx_vol_surface.fwd
+            t_exp[i] = self._fin_fx_vol_surface.t_exp
+
+            # Number of parameters depends on the vol function
+            fitted_parameters = np.asarray(self._fin_fx_vol_surface.parameters, dtype=np.float64)
+
+            if parameters is None:
+                parameters = np.full((len(value_date),) + fitted_parameters.shape, np.nan)
+
+            parameters[i] = fitted_parameters
+            calibrated[i] = True
+
+            if self._calibration_diagnostics is not None:
+                iterations[i] = self._calibration_diagnostics['iterations'].values
+                function_calls[i] = self._calibration_diagnostics['function_calls'].values
+                residual[i] = self._calibration_diagnostics['residual'].values
+
+        if parameters is None:
+            parameters = np.full((len(value_date), no_of_tenors, 0), np.nan)
+
+        return FXVolSurfaceHistory(value_date, self._tenors, strikes, vols, parameters, fwd, t_exp, calibrated,
+                                   vol_function_type=self._vol_function_type.value, iterations=iterations,
+                                   function_calls=function_calls, residual=residual)
+
     def calculate_vol_for_strike_expiry(self, K, expiry_date=None, tenor="1M"):
         """Calculates the implied_vol volatility for a given strike and tenor (or expiry date, if specified). The
         expiry date/broken dates are interpolated linearly in variance space.
@@ -539,7 +989,7 @@ class FXVolSurface(AbstractVolSurface):
         -------
         float
         """
-        return self._atm_vols[self._market_df.index == self._value_date][0][
+        return self._atm_vols[self._get_date_row(self._value_date)][
             self._get_tenor_index(tenor)]
 
     def get_atm_vol(self, tenor=None):
@@ -573,6 +1023,45 @@ class FXVolSurface(AbstractVolSurface):
         return self._df_vol_dict["vol_surface_delta_space"][tenor][
             "K_10D_P_MS"]
 
+    def get_calibration_diagnostics(self):
+        """Gets how the solver converged for each tenor, when the vol surface was last built (if it was built with
+        warm_start or calibration_diagnostics). Iterations are NaN for the Numba Nelder-Mead solver, which doesn't
+        report them (the number of objective function calls is still recorded).
+
+        Returns
+        -------
+        DataFrame
+            Iterations, objective function calls and residual (value of the objective function) for each tenor
+        """
+        return self._calibration_diagnostics
+
+    def get_spot_depo_rates(self, value_date):
+        """Gets the spot and the depo rates (as used for the discount curves
+        when building the vol surface) for many value dates, without having
+        to build the vol surface for each of them
+
+        Parameters
+        ----------
+        value_date : DateTimeIndex
+            Value dates (NaN returned where there is no market data)
+
+        Returns
+        -------
+        np.ndarray, np.ndarray, np.ndarray
+            Spot, terms currency depo rate and base currency depo rate
+        """
+        indexer = self._market_df.index.get_indexer(
+            pd.DatetimeIndex(value_date))
+
+        def _take(arr):
+            arr = np.asarray(arr, dtype=np.float64)[indexer]
+            arr[indexer < 0] = np.nan
+
+            return arr
+
+        return _take(self._spot_history), _take(self._domCCRate), \
+               _take(self._forCCRate)
+
     def get_dom_discount_curve(self):
         return self._dom_discount_curve
 
@@ -583,6 +1072,29 @@ class FXVolSurface(AbstractVolSurface):
         if self._fin_fx_vol_surface is not None:
             self._fin_fx_vol_surface.plotVolCurves()
 
+    def _get_date_row(self, value_date):
+        try:
+            return self._date_row[pd.Timestamp(value_date)]
+        except KeyError:
+            raise Exception("No market data for " + self._asset + " vol surface on " + str(value_date))
+
+    def _get_vol_surface_cache_key(self, date_row, x_inits=None):
+        settings = [self._asset, self._tenors, self._vol_function_type, self._atm_method, self._delta_method,
+                    self._solver, self._alpha, self._tol, self._value_date]
+
+        md5 = hashlib.md5(str(settings).encode('utf-8'))
+
+        md5.update(np.array([self._spot_history[date_row], self._domCCRate[date_row], self._forCCRate[date_row]],
+                            dtype=np.float64).tobytes())
+        md5.update(self._vol_quotes[date_row].tobytes())
+
+        # Initial parameters of the solver when warm starting (otherwise FinancePy's default ones)
+        if x_inits is not None:
+            md5.update(b'x_inits')
+            md5.update(np.ascontiguousarray(x_inits, dtype=np.float64).tobytes())
+
+        return md5.hexdigest()
+
     def _findate(self, timestamp):
 
         return Date(timestamp.day, timestamp.month, timestamp.year,
@@ -0,0 +1,333 @@
+__author__ = "saeedamen"
+
+#
+# Copyright 2020 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pandas as pd
+import numpy as np
+
+# FinancePy is an optional dependency
+try:
+    from financepy.market.volatility.fx_vol_surface_plus import vol_function
+except:
+    pass
+
+
+class FXVolSurfaceHistory(object):
+    """Compact store of FX vol surfaces calibrated over many dates (eg. by
+    FXVolSurface.build_vol_surface_history). For each date it holds the
+    fitted parameters of the vol function for each tenor, and the key strikes
+    (ATM, 25d and 10d calls/puts) and their vols, so these can be used later
+    without having to calibrate the vol surfaces again.
+
+    """
+
+    key_strikes_names = ["K_10D_P", "K_10D_P_MS", "K_25D_P", "K_25D_P_MS",
+                         "ATM", "K_25D_C", "K_25D_C_MS", "K_10D_C",
+                         "K_10D_C_MS"]
+
+    def __init__(self, value_date, tenors, strikes, vols, parameters, fwd,
+                 t_exp, calibrated, vol_function_type=None, iterations=None,
+                 function_calls=None, residual=None):
+        """Initialises the store with arrays for each date
+
+        Parameters
+        ----------
+        value_date : DateTimeIndex
+            Value dates of the vol surfaces
+
+        tenors : str(list)
+            Tenors of the vol surfaces
+
+        strikes : np.ndarray
+            Key strikes, with shape (dates, key strikes, tenors)
+
+        vols : np.ndarray
+            Implied vols of the key strikes (in %), with shape (dates, key strikes, tenors)
+
+        parameters : np.ndarray
+            Fitted parameters of the vol function, with shape (dates, tenors, parameters)
+
+        fwd : np.ndarray
+            Outright forwards, with shape (dates, tenors)
+
+        t_exp : np.ndarray
+            Time to expiry in years, with shape (dates, tenors)
+
+        calibrated : np.ndarray
+            Whether the vol surface could be calibrated for each date
+
+        vol_function_type : int
+            FinancePy vol function used for the calibration (eg. CLARK5)
+
+        iterations : np.ndarray (optional)
+            Iterations of the solver, with shape (dates, tenors)
+
+        function_calls : np.ndarray (optional)
+            Objective function calls by the solver, with shape (dates, tenors)
+
+        residual : np.ndarray (optional)
+            Value of the objective function after calibration, with shape (dates, tenors)
+        """
+        self.value_date = pd.DatetimeIndex(value_date)
+        self.tenors = list(tenors)
+        self.strikes = strikes
+        self.vols = vols
+        self.parameters = parameters
+        self.fwd = fwd
+        self.t_exp = t_exp
+        self.calibrated = calibrated
+        self.vol_function_type = vol_function_type
+
+        # Calibration diagnostics are NaN, if they weren't recorded
+        def _diagnostics(arr):
+            if arr is None:
+                return np.full((len(self.value_date), len(self.tenors)), np.nan)
+
+            return arr
+
+        self.iterations = _diagnostics(iterations)
+        self.function_calls = _diagnostics(function_calls)
+        self.residual = _diagnostics(residual)
+
+    def __len__(self):
+        return len(self.value_date)
+
+    @staticmethod
+    def concat(fx_vol_surface_history_list):
+        """Joins stores for different dates together (in the order given)
+
+        Parameters
+        ----------
+        fx_vol_surface_history_list : FXVolSurfaceHistory(list)
+            Stores to join
+
+        Returns
+        -------
+        FXVolSurfaceHistory
+        """
+        first = fx_vol_surface_history_list[0]
+
+        def _concat(attr):
+            return np.concatenate(
+                [getattr(x, attr) for x in fx_vol_surface_history_list])
+
+        value_date = first.value_date.append(
+            [x.value_date for x in fx_vol_surface_history_list[1:]])
+
+        # Stores where no dates could be calibrated have no parameters
+        no_of_parameters = max(
+            [x.parameters.shape[2] for x in fx_vol_surface_history_list])
+
+        parameters = np.concatenate(
+            [np.pad(x.parameters, ((0, 0), (0, 0),
+                                   (0, no_of_parameters - x.parameters.shape[2])),
+                    constant_values=np.nan)
+             for x in fx_vol_surface_history_list])
+
+        return FXVolSurfaceHistory(value_date, first.tenors,
+                                   _concat("strikes"), _concat("vols"),
+                                   parameters, _concat("fwd"),
+                                   _concat("t_exp"), _concat("calibrated"),
+                                   vol_function_type=first.vol_function_type,
+                                   iterations=_concat("iterations"),
+                                   function_calls=_concat("function_calls"),
+                                   residual=_concat("residual"))
+
+    def get_strike(self, tenor, key_strike="ATM"):
+        """Gets a time series of a key strike (eg. ATM, K_25D_C etc.) for
+        a tenor
+
+        Parameters
+        ----------
+        tenor : str
+            Tenor eg. "1M"
+
+        key_strike : str
+            Key strike eg. "ATM", "K_25D_C", "K_25D_P", "K_10D_C", "K_10D_P"
+
+        Returns
+        -------
+        pd.Series
+        """
+        return pd.Series(self.strikes[:, self._get_key_strike_index(key_strike),
+                         self._get_tenor_index(tenor)],
+                         index=self.value_date, name=key_strike + "." + tenor)
+
+    def get_vol(self, tenor, key_strike="ATM"):
+        """Gets a time series of the implied vol (in %) of a key strike (eg.
+        ATM, K_25D_C etc.) for a tenor
+
+        Parameters
+        ----------
+        tenor : str
+            Tenor eg. "1M"
+
+        key_strike : str
+            Key strike eg. "ATM", "K_25D_C", "K_25D_P", "K_10D_C", "K_10D_P"
+
+        Returns
+        -------
+        pd.Series
+        """
+        return pd.Series(self.vols[:, self._get_key_strike_index(key_strike),
+                         self._get_tenor_index(tenor)],
+                         index=self.value_date, name=key_strike + "." + tenor)
+
+    def get_calibration_diagnostics(self):
+        """Gets how the solver converged on each date, summed over the
+        tenors (with the largest residual of any tenor). These are NaN for
+        dates where the diagnostics weren't recorded.
+
+        Returns
+        -------
+        DataFrame
+        """
+        def _sum(arr):
+            return np.where(np.isnan(arr).all(axis=1), np.nan,
+                            np.nansum(arr, axis=1))
+
+        def _max(arr):
+            return np.where(np.isnan(arr).all(axis=1), np.nan,
+                            np.max(np.nan_to_num(arr, nan=-np.inf), axis=1))
+
+        return pd.DataFrame({"iterations": _sum(self.iterations),
+                             "function_calls": _sum(self.function_calls),
+                             "residual": _max(self.residual)},
+                            index=self.value_date)
+
+    def get_deltas_vs_strikes(self, value_date):
+        """Gets the key strikes for every tenor on a date (in the same format
+        as FXVolSurface.extract_vol_surface()["deltas_vs_strikes"])
+
+        Parameters
+        ----------
+        value_date : str
+            Value date
+
+        Returns
+        -------
+        DataFrame
+        """
+        return pd.DataFrame(self.strikes[self._get_date_index(value_date)],
+                            index=self.key_strikes_names, columns=self.tenors)
+
+    def get_vol_surface_delta_space(self, value_date):
+        """Gets the implied vols (in %) of the key strikes for every tenor on
+        a date (in the same format as
+        FXVolSurface.extract_vol_surface()["vol_surface_delta_space"])
+
+        Parameters
+        ----------
+        value_date : str
+            Value date
+
+        Returns
+        -------
+        DataFrame
+        """
+        return pd.DataFrame(self.vols[self._get_date_index(value_date)],
+                            index=self.key_strikes_names, columns=self.tenors)
+
+    def get_vol_from_quoted_tenor(self, value_date, K, tenor, gaps=None):
+        """Interpolates the implied vol (as a fraction) for a strike for a
+        quoted tenor on a date, using the fitted parameters (so without
+        calibrating the vol surface again)
+
+        Parameters
+        ----------
+        value_date : str
+            Value date
+
+        K : float
+            Strike
+
+        tenor : str
+            Tenor eg. "1M"
+
+        Returns
+        -------
+        float
+        """
+        if gaps is None:
+            gaps = np.array([0.1])
+
+        date_index = self._get_date_index(value_date)
+        tenor_index = self._get_tenor_index(tenor)
+
+        return vol_function(self.vol_function_type,
+                            self.parameters[date_index, tenor_index],
+                            np.array([K]), gaps,
+                            self.fwd[date_index, tenor_index], K,
+                            self.t_exp[date_index, tenor_index])
+
+    def save(self, path):
+        """Saves the store to a compressed NumPy file
+
+        Parameters
+        ----------
+        path : str
+            Path of the file (eg. "eurusd_vol_surface.npz")
+        """
+        np.savez_compressed(
+            path, value_date=self.value_date.asi8,
+            value_date_tz=np.array(str(self.value_date.tz)),
+            tenors=np.array(self.tenors), strikes=self.strikes,
+            vols=self.vols, parameters=self.parameters, fwd=self.fwd,
+            t_exp=self.t_exp, calibrated=self.calibrated,
+            iterations=self.iterations, function_calls=self.function_calls,
+            residual=self.residual,
+            vol_function_type=np.array(-1 if self.vol_function_type is None
+                                       else self.vol_function_type))
+
+    @staticmethod
+    def load(path):
+        """Loads a store saved by FXVolSurfaceHistory.save
+
+        Parameters
+        ----------
+        path : str
+            Path of the file
+
+        Returns
+        -------
+        FXVolSurfaceHistory
+        """
+        with np.load(path) as data:
+            value_date = pd.DatetimeIndex(data["value_date"])
+            tz = str(data["value_date_tz"])
+
+            if tz != "None":
+                value_date = value_date.tz_localize("UTC").tz_convert(tz)
+
+            vol_function_type = int(data["vol_function_type"])
+
+            return FXVolSurfaceHistory(
+                value_date, data["tenors"].tolist(), data["strikes"],
+                data["vols"], data["parameters"], data["fwd"], data["t_exp"],
+                data["calibrated"],
+                vol_function_type=None if vol_function_type == -1
+                else vol_function_type, iterations=data["iterations"],
+                function_calls=data["function_calls"],
+                residual=data["residual"])
+
+    def _get_date_index(self, value_date):
+        return self.value_date.get_loc(pd.Timestamp(value_date))
+
+    def _get_tenor_index(self, tenor):
+        return self.tenors.index(tenor)
+
+    def _get_key_strike_index(self, key_strike):
+        return self.key_strikes_names.index(key_strike)
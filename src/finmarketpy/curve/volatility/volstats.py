@@ -22,6 +22,8 @@ from pandas.tseries.offsets import CustomBusinessDay
 from findatapy.timeseries import Calculations, Filter, Timezone
 from findatapy.timeseries import Calendar
 
+from finmarketpy.util.businesscalendar import BusinessDayCalendar
+
 
 class VolStats(object):
     """Arranging underlying volatility market in easier to read format.
@@ -189,9 +191,8 @@ class VolStats(object):
         # Add by number of days (note: for overnight tenors/1 week in FX we can add business days like this)
         # For because they are always +1 business days, +5 business days (exc. national holidays and only including
         # weekend). For longer dates like 1 month this is an approximation
-        implied_vol.index = [
-            pd.Timestamp(x) + pd.tseries.offsets.BDay(tenor_days) for x in
-            implied_vol.index]
+        implied_vol.index = BusinessDayCalendar.get().business_day_offset(
+            implied_vol.index, tenor_days)
 
         vrp = implied_vol.join(realized_vol, how='outer')
         vrp[asset + "VRP" + tenor_label + ".close"] = vrp[
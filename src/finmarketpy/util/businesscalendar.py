@@ -0,0 +1,190 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2021 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from findatapy.timeseries import Calendar
+from findatapy.util.dataconstants import DataConstants
+
+data_constants = DataConstants()
+
+
+def get_holidays_version():
+    """Gets the version of the findatapy holidays table (its modification time and size), so anything calculated from
+    the holidays can be recalculated if it is edited
+
+    Returns
+    -------
+    str
+    """
+    try:
+        stat = os.stat(data_constants.holidays_parquet_table)
+
+        return str(stat.st_mtime_ns) + '_' + str(stat.st_size)
+    except (OSError, AttributeError):
+        return None
+
+
+def _split_dates(dates):
+    # Split into days and time of day (in local time), because offsets only move the day
+    dates = pd.DatetimeIndex(dates)
+    tz = dates.tz
+
+    if tz is not None:
+        dates = dates.tz_localize(None)
+
+    days = dates.values.astype('datetime64[D]')
+
+    return days, dates.values - days, tz
+
+
+def _combine_dates(days, time_of_day, tz):
+    dates = pd.DatetimeIndex(days.astype('datetime64[ns]') + time_of_day)
+
+    if tz is not None:
+        dates = dates.tz_localize(tz)
+
+    return dates
+
+
+class BusinessDayCalendar(object):
+    """Business days (Mon-Fri, excluding holidays) of a holiday calendar, held as a NumPy business day calendar, so
+    many dates can be offset at once with integer array operations, giving the same dates as
+    CustomBusinessDay/CustomBusinessMonthEnd with the same holidays.
+
+    Use BusinessDayCalendar.get to share one instance for each holiday calendar across the process (eg. between all
+    the curve builders), rather than fetching the holidays for every cross each time.
+    """
+
+    _cache = {}
+    _lock = threading.Lock()
+
+    def __init__(self, holidays=None):
+        """Initialises the business days from a list of holidays
+
+        Parameters
+        ----------
+        holidays : DateTimeIndex
+            Holidays (default - none, so just weekends are excluded)
+        """
+        if holidays is None:
+            holidays = []
+
+        holidays = pd.DatetimeIndex(holidays)
+
+        if holidays.tz is not None:
+            holidays = holidays.tz_localize(None)
+
+        self.busdaycal = np.busdaycalendar(holidays=holidays.values.astype('datetime64[D]'))
+
+    @staticmethod
+    def get(cal=None, calendar=None):
+        """Gets the business days for a holiday calendar, which are only created the first time they are needed (or
+        if the holidays table has since changed)
+
+        Parameters
+        ----------
+        cal : str
+            Holiday calendar (eg. 'EURUSD') (default - none, so just weekends are excluded)
+
+        calendar : Calendar
+            Used to get the holidays
+
+        Returns
+        -------
+        BusinessDayCalendar
+        """
+        key = (cal, get_holidays_version())
+
+        with BusinessDayCalendar._lock:
+            business_day_calendar = BusinessDayCalendar._cache.get(key)
+
+        if business_day_calendar is None:
+            if cal is None:
+                business_day_calendar = BusinessDayCalendar()
+            else:
+                if calendar is None: calendar = Calendar()
+
+                business_day_calendar = BusinessDayCalendar(calendar.get_holidays(cal=cal))
+
+            with BusinessDayCalendar._lock:
+                BusinessDayCalendar._cache[key] = business_day_calendar
+
+        return business_day_calendar
+
+    @staticmethod
+    def clear():
+        """Clears all the cached business days
+        """
+        with BusinessDayCalendar._lock:
+            BusinessDayCalendar._cache.clear()
+
+    def business_day_offset(self, dates, n):
+        """Vectorised equivalent of dates + CustomBusinessDay(n=n, holidays=holidays)
+
+        Parameters
+        ----------
+        dates : DateTimeIndex
+            Dates to offset
+
+        n : int
+            Number of business days
+
+        Returns
+        -------
+        DateTimeIndex
+        """
+        days, time_of_day, tz = _split_dates(dates)
+
+        days = np.busday_offset(days, n, roll='forward' if n <= 0 else 'backward', busdaycal=self.busdaycal)
+
+        return _combine_dates(days, time_of_day, tz)
+
+    def business_month_end_offset(self, dates, n):
+        """Vectorised equivalent of dates + CustomBusinessMonthEnd(n, holidays=holidays)
+
+        Parameters
+        ----------
+        dates : DateTimeIndex
+            Dates to offset
+
+        n : int
+            Number of business month ends
+
+        Returns
+        -------
+        DateTimeIndex
+        """
+        days, time_of_day, tz = _split_dates(dates)
+
+        month = days.astype('datetime64[M]')
+
+        # Last business day of the current month
+        month_end = np.busday_offset((month + 1).astype('datetime64[D]') - 1, 0, roll='backward',
+                                     busdaycal=self.busdaycal)
+
+        # If we haven't reached it yet, it counts as the first month end
+        if n > 0:
+            n = np.where(days < month_end, n - 1, n)
+        else:
+            n = np.where(days > month_end, n + 1, n)
+
+        days = np.busday_offset((month + n + 1).astype('datetime64[D]') - 1, 0, roll='backward',
+                                busdaycal=self.busdaycal)
+
+        return _combine_dates(days, time_of_day, tz)
@@ -40,6 +40,17 @@ class MarketConstants(object):
                           'windows' : 1,
                           'mac' : 8}
 
+    # minimum number of points (rows x columns) in a backtest, before calculating the return statistics and
+    # cumulative indices in parallel (otherwise the overhead of starting processes outweighs the benefits)
+    backtest_parallel_min_size = 10000000
+
+    # when running TradingModel.construct_strategy in parallel (with multiprocessing), publish the market data once to
+    # memory mapped files, which the workers attach to, rather than pickling it for every basket
+    backtest_shared_memory = False
+
+    # folder for these memory mapped files (if None, will use /dev/shm if it exists, otherwise the temp folder)
+    backtest_shared_memory_folder = None
+
     hdf5_file_econ_file = "x"
 
     db_database_econ_file = ''
@@ -58,6 +69,18 @@ class MarketConstants(object):
     # Whether to output additional fields related to calculation of total return indices
     output_calculation_fields = False
 
+    # When constructing total return indices for many FX crosses in parallel (eg. FXForwardsCurve), how many processes
+    # to split the crosses between, and whether to use "multiprocessing" or "thread"
+    fx_curve_thread_no = {'linux': 8,
+                          'windows': 1,
+                          'mac': 8}
+
+    fx_curve_thread_technique = "multiprocessing"
+
+    # When streaming FX spot total return indices, how many rows to hold back waiting for the first deposit data of
+    # every currency, before giving up (so a missing deposit doesn't end up with the whole history in memory)
+    fx_spot_stream_max_pending_rows = 1000000
+
 ### FX Forwards ########################################################################################################
     fx_forwards_points_divisor_1 = ['IDR']
     fx_forwards_points_divisor_100 = ['JPY']
@@ -66,6 +89,12 @@ class MarketConstants(object):
     # Forwards typically used for interpolation (note: eg. TN and SN are swaps)
     fx_forwards_tenor_for_interpolation = ["1W", "2W", "3W", "1M", "2M", "3M", "4M", "6M", "9M", "1Y", "2Y", "3Y", "5Y"]
 
+    # How many delivery dates before we interpolate forwards on all the cores (below this, threads are slower)
+    fx_forwards_interpolate_parallel_threshold = 100000
+
+    # Split those interpolations into this many chunks for each core (so busier cores don't hold up the rest)
+    fx_forwards_interpolate_chunks_per_thread = 4
+
     # What contract will we generally be trading?
     fx_forwards_trading_tenor = '1M'
 
@@ -81,6 +110,13 @@ class MarketConstants(object):
     # Typically when do we roll the contract?
     fx_forwards_roll_months = 1
 
+    # Maximum number of cross/tenor combinations in the process wide cache of the delivery dates of quoted forwards
+    # (0 disables the cache)
+    fx_forwards_quoted_delivery_cache_size = 256
+
+    # Folder to also persist the cache of quoted delivery dates to disk (if None, it is only kept in memory)
+    fx_forwards_quoted_delivery_cache_folder = None
+
 ### FX Options ########################################################################################################
     fx_options_points_divisor_100 = ['JPY']
     fx_options_points_divisor_1000 = []
@@ -134,6 +170,21 @@ class MarketConstants(object):
 
     fx_options_tol = 1e-8
 
+    # Maximum number of calibrated FX vol surfaces (one for each date and set of market quotes) in the process wide
+    # cache (0 disables the cache)
+    fx_options_vol_surface_cache_size = 1024
+
+    # Folder to also persist calibrated FX vol surfaces to disk (if None, they are only kept in memory)
+    fx_options_vol_surface_cache_folder = None
+
+    # When calibrating FX vol surfaces over many dates (FXVolSurface.build_vol_surface_history), how many processes
+    # to split the dates between, and whether to use "multiprocessing" or "thread"
+    fx_options_vol_surface_thread_no = {'linux': 8,
+                                        'windows': 1,
+                                        'mac': 8}
+
+    fx_options_vol_surface_thread_technique = "multiprocessing"
+
     override_fields = {}
 
     # Overwrite field variables with those listed in MarketCred or we can pass through an override_fields dictionary
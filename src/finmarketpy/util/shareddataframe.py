@@ -0,0 +1,165 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2021 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+import os
+import tempfile
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from finmarketpy.util.marketconstants import MarketConstants
+
+market_constants = MarketConstants()
+
+
+class SharedDataFrame(object):
+    """Publishes a DataFrame once to memory mapped NumPy files (by default in /dev/shm on Linux, so they are held in
+    RAM), so it can be shared between processes. Only this lightweight handle is pickled when it is sent to a worker,
+    which then attaches to the underlying buffers zero-copy by name, rather than unpickling a full copy of the
+    DataFrame.
+
+    DataFrames which cannot be stored as a single NumPy block (eg. columns of different dtypes) or which do not have
+    a DatetimeIndex are kept inside the handle and are pickled as normal.
+    """
+
+    def __init__(self, df: pd.DataFrame = None, folder: str = None):
+        self._df = None
+        self._fallback_df = None
+        self._values_path = None
+        self._index_path = None
+        self._columns = None
+        self._index_name = None
+        self._tz = None
+        self._index_dtype = None
+        self._freq = None
+
+        if df is None:
+            return
+
+        if self._is_shareable(df):
+            if folder is None:
+                folder = market_constants.backtest_shared_memory_folder
+
+            if folder is None:
+                folder = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+            name = 'finmarketpy_' + uuid.uuid4().hex
+
+            self._values_path = os.path.join(folder, name + '_values.npy')
+            self._index_path = os.path.join(folder, name + '_index.npy')
+            self._columns = df.columns
+            self._index_name = df.index.name
+            self._tz = df.index.tz
+            self._index_dtype = df.index.values.dtype
+            self._freq = df.index.freq
+
+            # Write the values and the underlying UTC timestamps in one go
+            values = np.lib.format.open_memmap(self._values_path, mode='w+', dtype=df.dtypes.iloc[0],
+                                               shape=df.shape)
+            values[:] = df.values
+            values.flush()
+
+            index = np.lib.format.open_memmap(self._index_path, mode='w+', dtype=np.int64, shape=(len(df.index),))
+            index[:] = df.index.asi8
+            index.flush()
+
+            del values, index
+        else:
+            self._fallback_df = df
+
+    def _is_shareable(self, df):
+        return isinstance(df, pd.DataFrame) and isinstance(df.index, pd.DatetimeIndex) \
+               and len(df.columns) > 0 and len(df.dtypes.unique()) == 1 and df.dtypes.iloc[0].kind in 'fiub'
+
+    @property
+    def is_shared(self) -> bool:
+        """Is the DataFrame held in memory mapped files (rather than inside the handle)
+
+        Returns
+        -------
+        bool
+        """
+        return self._values_path is not None
+
+    def get_df(self) -> pd.DataFrame:
+        """Attaches to the shared buffers (if it hasn't already in this process) and returns them as a read only
+        DataFrame. Any modification should be done on a copy.
+
+        Returns
+        -------
+        DataFrame
+        """
+        if not (self.is_shared):
+            return self._fallback_df
+
+        if self._df is None:
+            values = np.load(self._values_path, mmap_mode='r')
+            index = np.load(self._index_path, mmap_mode='r')
+
+            index = pd.DatetimeIndex(np.asarray(index).view(self._index_dtype), name=self._index_name)
+
+            if self._tz is not None:
+                index = index.tz_localize('UTC').tz_convert(self._tz)
+
+            if self._freq is not None:
+                index = pd.DatetimeIndex(index, freq=self._freq)
+
+            self._df = pd.DataFrame(values, index=index, columns=self._columns, copy=False)
+
+        return self._df
+
+    def get_columns(self, col_ind: list) -> pd.DataFrame:
+        """Gets a subset of columns, by position, only copying those columns out of the shared buffers
+
+        Parameters
+        ----------
+        col_ind : list(int)
+            Positions of the columns to select
+
+        Returns
+        -------
+        DataFrame
+        """
+        df = self.get_df()
+
+        if df is None:
+            return None
+
+        return df.iloc[:, col_ind]
+
+    def close(self):
+        """Deletes the memory mapped files. Should only be called by the process which published the DataFrame, after
+        all the workers have finished with it.
+        """
+        self._df = None
+
+        for path in [self._values_path, self._index_path]:
+            if path is not None:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        self._values_path = None
+        self._index_path = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+
+        # Never pickle the attached buffers, the worker will attach to them itself
+        if self.is_shared:
+            state['_df'] = None
+
+        return state
@@ -0,0 +1,258 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""Benchmarks for the backtest engine, using synthetic FX spot prices and signals (so no market data is needed).
+
+The benchmarks need pytest-benchmark (listed in .rhiza/requirements/tests.txt, which make install installs) and only
+run with --benchmark-only, eg. with make benchmark (defined in .rhiza/make.d/test.mk) or
+
+    pytest tests/benchmarks --benchmark-only
+
+Wall time is measured by pytest-benchmark, so can be compared against earlier runs on the same machine with
+
+    pytest tests/benchmarks --benchmark-only --benchmark-autosave
+    pytest tests/benchmarks --benchmark-only --benchmark-compare --benchmark-compare-fail=median:20%
+
+Each benchmark is also run once more to record the peak RSS and the peak memory allocated (with tracemalloc), which
+are stored in the extra_info of the results and checked against baseline_memory.json (these are deterministic, unlike
+timings, so the baseline is kept in the repo). To update the baseline set FINMARKETPY_BENCHMARK_SAVE_BASELINE=1.
+
+The size of the grid of assets x rows is limited by FINMARKETPY_BENCHMARK_MAX_CELLS (default 1,000,000), which can
+be increased to run the largest backtests (eg. 10 assets x 5M rows needs 5e7).
+"""
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+BENCHMARK_ASSETS = [10, 100, 1000]
+BENCHMARK_ROWS = [1000, 100000, 5000000]
+
+BENCHMARK_MAX_CELLS = int(float(os.environ.get('FINMARKETPY_BENCHMARK_MAX_CELLS', 1e6)))
+BENCHMARK_ROUNDS = int(os.environ.get('FINMARKETPY_BENCHMARK_ROUNDS', 3))
+
+# How much more memory a benchmark can use than its baseline, before it fails (with some slack in MB, so the smallest
+# benchmarks aren't flagged for tiny changes)
+BENCHMARK_MEMORY_TOLERANCE = float(os.environ.get('FINMARKETPY_BENCHMARK_MEMORY_TOLERANCE', 1.2))
+BENCHMARK_MEMORY_SLACK_MB = 1.0
+BENCHMARK_SAVE_BASELINE = os.environ.get('FINMARKETPY_BENCHMARK_SAVE_BASELINE', '0') == '1'
+
+BENCHMARK_BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline_memory.json')
+
+
+def pytest_collection_modifyitems(config, items):
+    # Benchmarks are slow, so don't run them as part of the normal tests
+    if config.getoption('benchmark_only', default=False):
+        return
+
+    skip = pytest.mark.skip(reason='benchmarks only run with --benchmark-only (eg. make benchmark)')
+
+    for item in items:
+        if 'benchmarks' in item.nodeid.split('::')[0]:
+            item.add_marker(skip)
+
+
+def benchmark_sizes(assets=BENCHMARK_ASSETS, rows=BENCHMARK_ROWS):
+    """Gets the (assets, rows) combinations to benchmark, marking any which are too large to be skipped
+
+    Parameters
+    ----------
+    assets : int (list)
+        Number of assets
+    rows : int (list)
+        Number of rows
+
+    Returns
+    -------
+    list
+    """
+    sizes = []
+
+    for a in assets:
+        for r in rows:
+            marks = []
+
+            if a * r > BENCHMARK_MAX_CELLS:
+                marks = [pytest.mark.skip(reason='larger than FINMARKETPY_BENCHMARK_MAX_CELLS')]
+
+            sizes.append(pytest.param(a, r, id=str(a) + 'x' + str(r), marks=marks))
+
+    return sizes
+
+
+def create_fx_spot(assets, rows, seed=0):
+    """Creates synthetic FX spot prices (geometric Brownian motion with ~10% annualised vol), daily for shorter
+    histories and minutely for longer ones, with a few missing points (eg. holidays)
+
+    Parameters
+    ----------
+    assets : int
+        Number of FX crosses
+    rows : int
+        Number of points in time
+    seed : int
+        Random seed
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    rng = np.random.default_rng(seed)
+
+    if rows <= 10000:
+        index = pd.bdate_range(start='1 Jan 2000', periods=rows)
+        vol = 0.1 / np.sqrt(252)
+    else:
+        index = pd.date_range(start='1 Jan 2000', periods=rows, freq='min')
+        vol = 0.1 / np.sqrt(252 * 1440)
+
+    columns = ['FX%03d.close' % i for i in range(assets)]
+
+    spot = np.exp(np.cumsum(rng.normal(0, vol, (rows, assets)), axis=0))
+    spot[rng.integers(0, rows, rows // 100 + 1), rng.integers(0, assets, rows // 100 + 1)] = np.nan
+
+    return pd.DataFrame(spot, index=index, columns=columns)
+
+
+def create_fx_signal(spot_df, fast=20, slow=60):
+    """Creates a simple trend following signal (moving average crossover) for synthetic FX spot
+
+    Parameters
+    ----------
+    spot_df : pd.DataFrame
+        FX spot prices
+    fast : int
+        Periods in fast moving average
+    slow : int
+        Periods in slow moving average
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    spot_df = spot_df.ffill()
+
+    return np.sign(spot_df.rolling(fast).mean() - spot_df.rolling(slow).mean())
+
+
+class MemoryProfile(object):
+    """Records the peak memory allocated by Python/NumPy (with tracemalloc) and the peak increase in RSS (by polling
+    /proc/self/statm in a background thread, where it exists) while running a function.
+
+    """
+
+    def __init__(self, poll_interval=0.002):
+        self._poll_interval = poll_interval
+
+        self.peak_alloc_mb = None
+        self.net_alloc_mb = None
+        self.peak_rss_mb = None
+        self.wall_time = None
+
+    def _rss(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def run(self, func):
+        rss_start = self._rss()
+        rss_peak = [rss_start]
+        done = threading.Event()
+
+        def poll():
+            while not done.is_set():
+                rss_peak[0] = max(rss_peak[0], self._rss())
+                done.wait(self._poll_interval)
+
+        poll_thread = None
+
+        if rss_start is not None:
+            poll_thread = threading.Thread(target=poll, daemon=True)
+            poll_thread.start()
+
+        tracemalloc.start()
+
+        try:
+            start = time.perf_counter()
+            func()
+            self.wall_time = time.perf_counter() - start
+
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            done.set()
+
+        if poll_thread is not None:
+            poll_thread.join()
+            self.peak_rss_mb = (rss_peak[0] - rss_start) / 1e6
+
+        self.peak_alloc_mb = peak / 1e6
+        self.net_alloc_mb = current / 1e6
+
+        return self
+
+
+@pytest.fixture(scope='session')
+def memory_baseline():
+    baseline = {}
+
+    if os.path.exists(BENCHMARK_BASELINE_PATH):
+        with open(BENCHMARK_BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+    yield baseline
+
+    if BENCHMARK_SAVE_BASELINE:
+        with open(BENCHMARK_BASELINE_PATH, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+
+
+@pytest.fixture
+def run_benchmark(benchmark, memory_baseline, request):
+    """Times a function with pytest-benchmark and then profiles its memory, checking the peak allocations against
+    the stored baseline
+    """
+
+    def run(func):
+        result = benchmark.pedantic(func, rounds=BENCHMARK_ROUNDS, iterations=1, warmup_rounds=1)
+
+        profile = MemoryProfile().run(func)
+
+        benchmark.extra_info['peak_alloc_mb'] = profile.peak_alloc_mb
+        benchmark.extra_info['net_alloc_mb'] = profile.net_alloc_mb
+        benchmark.extra_info['peak_rss_mb'] = profile.peak_rss_mb
+
+        name = request.node.name
+
+        if BENCHMARK_SAVE_BASELINE:
+            memory_baseline[name] = {'peak_alloc_mb': round(profile.peak_alloc_mb, 3)}
+        elif name in memory_baseline:
+            max_alloc_mb = memory_baseline[name]['peak_alloc_mb'] * BENCHMARK_MEMORY_TOLERANCE \
+                + BENCHMARK_MEMORY_SLACK_MB
+
+            assert profile.peak_alloc_mb <= max_alloc_mb, \
+                name + ' peak allocations of %.1fMB are more than the baseline of %.1fMB' \
+                % (profile.peak_alloc_mb, memory_baseline[name]['peak_alloc_mb'])
+
+        return result
+
+    return run
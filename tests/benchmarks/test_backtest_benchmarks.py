@@ -0,0 +1,150 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+import pytest
+
+pytest.importorskip('pytest_benchmark',
+                    reason='benchmarks need pytest-benchmark (see .rhiza/requirements/tests.txt)')
+
+import numpy as np
+
+from finmarketpy.backtest import Backtest, BacktestRequest, TradeAnalysis, TradingModel
+from finmarketpy.backtest.backtestengine import RiskEngine
+from finmarketpy.economics import TechParams
+
+from .conftest import benchmark_sizes, create_fx_signal, create_fx_spot
+
+# Feature flags for the backtest, each of which switches on a different part of the engine
+FEATURES = {
+    'base': {},
+    'vol': {'signal_vol_adjust': True, 'portfolio_vol_adjust': True},
+    'stops': {'stop_loss': -0.02, 'take_profit': 0.04, 'trailing_stop': -0.03},
+    'clip': {'max_net_exposure': 1.0, 'max_abs_exposure': 2.0, 'position_clip_rebalance_freq': 'BM'},
+    'notional': {'portfolio_notional_size': 1000000},
+}
+
+FEATURES['all'] = {k: v for f in FEATURES.values() for k, v in f.items()}
+
+
+def create_backtest_request(spot_df, **kwargs):
+    br = BacktestRequest()
+    br.start_date = spot_df.index[0]
+    br.finish_date = spot_df.index[-1]
+    br.spot_tc_bp = 0.5
+    br.ann_factor = 252
+    br.signal_vol_target = 0.1
+    br.signal_vol_max_leverage = 5
+    br.signal_vol_rebalance_freq = 'BM'
+    br.portfolio_vol_target = 0.1
+    br.portfolio_vol_max_leverage = 5
+    br.portfolio_vol_rebalance_freq = 'BM'
+
+    for k, v in kwargs.items():
+        setattr(br, k, v)
+
+    return br
+
+
+class SyntheticFXTrendModel(TradingModel):
+    """Trend following model on synthetic FX spot (with no market data to download)"""
+
+    FINAL_STRATEGY = 'Synthetic FX trend'
+
+    def __init__(self, assets, rows):
+        self._spot_df = create_fx_spot(assets, rows)
+
+        super(SyntheticFXTrendModel, self).__init__()
+
+    def load_parameters(self, br=None):
+        if br is not None:
+            return br
+
+        br = create_backtest_request(self._spot_df, signal_vol_adjust=True, portfolio_vol_adjust=True)
+        br.tech_params = TechParams()
+
+        return br
+
+    def load_assets(self, br=None):
+        tickers = [x.split('.')[0] for x in self._spot_df.columns]
+
+        return self._spot_df, self._spot_df, None, {self.FINAL_STRATEGY: tickers}
+
+    def construct_signal(self, spot_df=None, spot_df2=None, tech_params=None, br=None, run_in_parallel=False):
+        return create_fx_signal(spot_df)
+
+    def construct_strategy_benchmark(self):
+        return None
+
+
+@pytest.mark.parametrize('feature', list(FEATURES.keys()))
+@pytest.mark.parametrize('assets, rows', benchmark_sizes())
+def test_benchmark_calculate_trading_pnl(run_benchmark, assets, rows, feature):
+    spot_df = create_fx_spot(assets, rows)
+    signal_df = create_fx_signal(spot_df)
+
+    br = create_backtest_request(spot_df, **FEATURES[feature])
+
+    def run():
+        backtest = Backtest()
+        backtest.calculate_trading_PnL(br, spot_df, signal_df, None, False)
+
+        # Most outputs are only calculated when they are first asked for
+        backtest.portfolio_cum()
+
+        if br.portfolio_notional_size is not None:
+            backtest.portfolio_signal_notional()
+            backtest.portfolio_signal_contracts()
+
+        return backtest
+
+    backtest = run_benchmark(run)
+
+    assert np.isfinite(backtest.portfolio_cum().values).any()
+
+
+@pytest.mark.parametrize('assets, rows', benchmark_sizes())
+def test_benchmark_calculate_leverage_factor(run_benchmark, assets, rows):
+    returns_df = create_fx_spot(assets, rows).pct_change(fill_method=None)
+
+    leverage_df = run_benchmark(
+        lambda: RiskEngine().calculate_leverage_factor(returns_df, 0.1, 5, vol_rebalance_freq='BM'))
+
+    assert leverage_df.shape == returns_df.shape
+
+
+@pytest.mark.parametrize('assets, rows', benchmark_sizes(rows=[1000, 100000]))
+def test_benchmark_construct_strategy(run_benchmark, assets, rows):
+    model = SyntheticFXTrendModel(assets, rows)
+
+    run_benchmark(lambda: model.construct_strategy())
+
+    assert model.strategy_pnl() is not None
+
+
+@pytest.mark.parametrize('batch', [False, True], ids=['separate', 'batch'])
+@pytest.mark.parametrize('assets, rows', benchmark_sizes(rows=[1000, 100000]))
+def test_benchmark_tc_shock(run_benchmark, assets, rows, batch):
+    model = SyntheticFXTrendModel(assets, rows)
+
+    tc = [0, 0.25, 0.5, 0.75, 1, 1.25, 1.5, 2]
+
+    # Equivalent to TradeAnalysis.run_tc_shock, without plotting the results
+    def run():
+        return TradeAnalysis().run_arbitrary_sensitivity(
+            model, parameter_list=[{'spot_tc_bp': x} for x in tc], pretty_portfolio_names=[str(x) + 'bp' for x in tc],
+            parameter_type='TC analysis', plot=False, batch=batch)
+
+    port_list, summary_ir, summary_rets = run_benchmark(run)
+
+    assert len(summary_ir.index) == len(tc)
@@ -0,0 +1,36 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+import numpy as np
+import pandas as pd
+
+
+def create_fx_vol_market_df(cross, horizon_date, tenors, seed=1):
+    """Creates synthetic market data for an FX vol surface (spot, depos and ATM, 25d/10d risk reversals and
+    butterflies)"""
+    rng = np.random.default_rng(seed)
+
+    market_df = pd.DataFrame(index=horizon_date)
+    market_df[cross + '.close'] = 1.15 * np.exp(np.cumsum(rng.normal(0, 0.004, len(horizon_date))))
+    market_df[cross[0:3] + '1M.close'] = -0.4 + rng.normal(0, 0.01, len(horizon_date))
+    market_df[cross[3:6] + '1M.close'] = 2.4 + rng.normal(0, 0.01, len(horizon_date))
+
+    for i, t in enumerate(tenors):
+        market_df[cross + 'V' + t + '.close'] = 7 + 0.3 * i + rng.normal(0, 0.1, len(horizon_date))
+        market_df[cross + '25B' + t + '.close'] = 0.2 + 0.02 * i
+        market_df[cross + '25R' + t + '.close'] = -0.4 - 0.05 * i
+        market_df[cross + '10B' + t + '.close'] = 0.6 + 0.05 * i
+        market_df[cross + '10R' + t + '.close'] = -0.8 - 0.1 * i
+
+    return market_df
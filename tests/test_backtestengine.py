@@ -0,0 +1,448 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+import copy
+
+import pytest
+import pandas as pd
+import numpy as np
+from pandas.testing import assert_frame_equal
+
+from finmarketpy.backtest import Backtest, BacktestRequest, BacktestSweep
+
+dates = pd.date_range(start='1/1/2010', periods=1000, freq='B')
+cols = ['Asset%d.close' % x for x in range(1, 6)]
+
+
+def create_asset_signal():
+    np.random.seed(42)
+
+    asset_df = pd.DataFrame(index=dates, columns=cols,
+                            data=100 * np.exp(np.cumsum(np.random.normal(0, 0.006, (len(dates), len(cols))), axis=0)))
+    asset_df.iloc[np.random.randint(0, len(dates), 20), np.random.randint(0, len(cols), 20)] = np.nan
+
+    signal_df = np.sign(asset_df.rolling(20).mean() - asset_df.rolling(60).mean())
+
+    return asset_df, signal_df
+
+
+def create_backtest_request():
+    br = BacktestRequest()
+    br.start_date = dates[0]
+    br.finish_date = dates[-1]
+    br.spot_tc_bp = 0.5
+    br.signal_vol_adjust = True
+    br.signal_vol_rebalance_freq = 'BM'
+    br.signal_vol_max_leverage = 5
+    br.portfolio_vol_adjust = True
+    br.portfolio_vol_rebalance_freq = 'BM'
+    br.portfolio_vol_max_leverage = 5
+
+    return br
+
+
+def test_backtest_sweep():
+    asset_df, signal_df = create_asset_signal()
+    br = create_backtest_request()
+
+    parameter_list = [{'spot_tc_bp': 0.0}, {'spot_tc_bp': 2.0, 'signal_vol_target': 0.05},
+                      {'portfolio_vol_target': 0.2, 'signal_delay': 1}, {'signal_vol_adjust': False},
+                      {'max_net_exposure': 0.2}, {'max_abs_exposure': 0.3},
+                      {'max_net_exposure': 0.2, 'max_abs_exposure': 0.3},
+                      {'take_profit': 0.03, 'stop_loss': -0.02}]
+    parameter_names = [str(x) for x in range(len(parameter_list))]
+
+    backtest_sweep = BacktestSweep()
+
+    assert backtest_sweep.is_sweepable(br, parameter_list)
+    assert not backtest_sweep.is_sweepable(br, [{'signal_vol_periods': 40}])
+
+    portfolio_df = backtest_sweep.calculate_portfolio_returns(br, asset_df, signal_df, parameter_list,
+                                                              parameter_names=parameter_names)
+
+    # Sweep should match running every backtest separately
+    for i in range(len(parameter_list)):
+        br_param = copy.copy(br)
+
+        for k in parameter_list[i].keys():
+            setattr(br_param, k, parameter_list[i][k])
+
+        backtest = Backtest()
+        backtest.calculate_trading_PnL(br_param, asset_df, signal_df, None)
+
+        expected_df = backtest.portfolio_pnl()
+        expected_df.columns = [parameter_names[i]]
+
+        assert_frame_equal(portfolio_df[[parameter_names[i]]], expected_df)
+
+
+@pytest.mark.parametrize('portfolio_combination', ['sum', 'weighted', 'weighted-sum'])
+def test_backtest_sweep_portfolio_combination(portfolio_combination):
+    asset_df, signal_df = create_asset_signal()
+    br = create_backtest_request()
+    br.portfolio_combination = portfolio_combination
+
+    if 'weighted' in portfolio_combination:
+        br.portfolio_combination_weights = {c + ' / ' + c: w for c, w in zip(asset_df.columns, [1, 2, 0.5, 1, 3])}
+
+    parameter_list = [{'spot_tc_bp': 2.0}, {'spot_rc_bp': 1.0, 'portfolio_vol_target': 0.2},
+                      {'max_net_exposure': 0.2}, {'max_abs_exposure': 0.3}]
+
+    backtest_sweep = BacktestSweep()
+
+    assert backtest_sweep.is_sweepable(br, parameter_list)
+
+    portfolio_df = backtest_sweep.calculate_portfolio_returns(br, asset_df, signal_df, parameter_list,
+                                                              parameter_names=['0', '1', '2', '3'])
+
+    # Sweep combines the signals in the same way as running every backtest separately
+    for i in range(len(parameter_list)):
+        br_param = copy.copy(br)
+
+        for k in parameter_list[i].keys():
+            setattr(br_param, k, parameter_list[i][k])
+
+        backtest = Backtest()
+        backtest.calculate_trading_PnL(br_param, asset_df, signal_df, None)
+
+        expected_df = backtest.portfolio_pnl()
+        expected_df.columns = [str(i)]
+
+        assert_frame_equal(portfolio_df[[str(i)]], expected_df)
+
+
+def test_backtest_parallel(monkeypatch):
+    from finmarketpy.util.marketconstants import MarketConstants
+
+    asset_df, signal_df = create_asset_signal()
+    br = create_backtest_request()
+
+    backtest_serial = Backtest()
+    backtest_serial.calculate_trading_PnL(br, asset_df, signal_df, None, run_in_parallel=False)
+
+    # Force the parallel calculation even for a small backtest
+    monkeypatch.setattr(MarketConstants, 'backtest_parallel_min_size', 0)
+
+    backtest_parallel = Backtest()
+    backtest_parallel.calculate_trading_PnL(br, asset_df, signal_df, None, run_in_parallel=True)
+
+    # Parallel output should be identical to serial
+    assert_frame_equal(backtest_serial.pnl_cum(), backtest_parallel.pnl_cum(), check_exact=True)
+    assert_frame_equal(backtest_serial.components_pnl_cum(), backtest_parallel.components_pnl_cum(), check_exact=True)
+    assert_frame_equal(backtest_serial.portfolio_cum(), backtest_parallel.portfolio_cum(), check_exact=True)
+
+    assert backtest_serial.portfolio_pnl_desc() == backtest_parallel.portfolio_pnl_desc()
+    assert backtest_serial.components_pnl_ret_stats().summary() == \
+           backtest_parallel.components_pnl_ret_stats().summary()
+
+
+def test_trading_model_shared_memory(monkeypatch):
+    from finmarketpy.backtest import TradingModel
+    from finmarketpy.util.marketconstants import MarketConstants
+    from finmarketpy.util.shareddataframe import SharedDataFrame
+
+    asset_df, signal_df = create_asset_signal()
+
+    # Handle should round trip the DataFrame through the memory mapped files
+    shared = SharedDataFrame(asset_df)
+
+    assert shared.is_shared
+    assert_frame_equal(shared.get_df(), asset_df)
+    assert_frame_equal(shared.get_columns([1, 3]), asset_df.iloc[:, [1, 3]])
+
+    shared.close()
+
+    class TradingModelTest(TradingModel):
+        FINAL_STRATEGY = 'Basket'
+
+        def load_parameters(self, br=None):
+            return create_backtest_request()
+
+        def load_assets(self, br=None):
+            return {'asset_df': asset_df}
+
+        def construct_signal(self, spot_df=None, spot_df2=None, tech_params=None, br=None, run_in_parallel=False):
+            return np.sign(spot_df.rolling(20).mean() - spot_df.rolling(60).mean())
+
+        def construct_strategy_benchmark(self):
+            return None
+
+    monkeypatch.setattr(MarketConstants, 'backtest_thread_no', {'linux': 2, 'windows': 2, 'mac': 2})
+
+    model_pickle = TradingModelTest()
+    model_pickle.construct_strategy(run_in_parallel=True)
+
+    monkeypatch.setattr(MarketConstants, 'backtest_shared_memory', True)
+
+    model_shared = TradingModelTest()
+    model_shared.construct_strategy(run_in_parallel=True)
+
+    # Sharing the market data should not change any of the results
+    assert_frame_equal(model_pickle._strategy_group_pnl, model_shared._strategy_group_pnl, check_exact=True)
+    assert_frame_equal(model_pickle._strategy_pnl, model_shared._strategy_pnl, check_exact=True)
+
+
+def test_backtest_update():
+    asset_df, signal_df = create_asset_signal()
+
+    br_stop = create_backtest_request()
+    br_stop.signal_vol_adjust = False
+    br_stop.portfolio_vol_adjust = False
+    br_stop.stop_loss = -0.01
+    br_stop.take_profit = 0.015
+
+    br_clip = create_backtest_request()
+    br_clip.signal_delay = 2
+    br_clip.max_net_exposure = 0.3
+    br_clip.cum_index = 'add'
+
+    # Vol targeting uses rolling windows, so can only match full recalculation up to rounding
+    for br, check_exact in [(br_stop, True), (create_backtest_request(), False), (br_clip, False)]:
+        backtest_full = Backtest()
+        backtest_full.calculate_trading_PnL(br, asset_df, signal_df, None)
+
+        # Only kept if asked for
+        assert backtest_full._update_state is None
+
+        with pytest.raises(Exception):
+            backtest_full.update_trading_PnL(br, asset_df.iloc[900:], signal_df.iloc[900:])
+
+        backtest_update = Backtest()
+        backtest_update.calculate_trading_PnL(br, asset_df.iloc[:900], signal_df.iloc[:900], None,
+                                              keep_update_state=True)
+
+        for i in range(900, len(dates), 7):
+            backtest_update.update_trading_PnL(br, asset_df.iloc[i:i + 7], signal_df.iloc[i:i + 7])
+
+        for f in ['pnl_cum', 'components_pnl_cum', 'portfolio_cum', 'portfolio_leverage', 'portfolio_signal',
+                  'portfolio_trade', 'portfolio_net_exposure']:
+            assert_frame_equal(getattr(backtest_full, f)(), getattr(backtest_update, f)(), check_exact=check_exact,
+                               check_freq=False)
+
+        assert backtest_full.portfolio_pnl_desc() == backtest_update.portfolio_pnl_desc()
+
+
+def test_leverage_factor_resample_freq():
+    from finmarketpy.backtest.backtestengine import RiskEngine
+
+    intraday_dates = pd.date_range(start='1/1/2020', periods=24 * 200, freq='h')
+
+    np.random.seed(42)
+
+    returns_df = pd.DataFrame(index=intraday_dates, columns=['Asset1.close', 'Asset2.close'],
+                              data=np.random.normal(0, 0.001, (len(intraday_dates), 2)))
+
+    risk_engine = RiskEngine()
+
+    leverage_df = risk_engine.calculate_leverage_factor(returns_df, 0.1, 5, vol_periods=20, vol_obs_in_year=252,
+                                                        vol_rebalance_freq='W', resample_freq='D')
+
+    assert leverage_df is not None
+    assert leverage_df.index.equals(returns_df.index)
+    assert leverage_df.notna().values.any()
+
+    # Should be the same as calculating the leverage on the daily returns (labelled at the end of each day, so there's
+    # no lookahead) and filling it down onto the hourly points
+    daily_returns_df = (1.0 + returns_df).resample('D', closed='left', label='right').prod() - 1.0
+    daily_leverage_df = risk_engine.calculate_leverage_factor(daily_returns_df, 0.1, 5, vol_periods=20,
+                                                              vol_obs_in_year=252, vol_rebalance_freq='W')
+
+    assert_frame_equal(leverage_df, daily_leverage_df.reindex(returns_df.index, method='ffill'), check_freq=False)
+
+
+def test_backtest_lazy_outputs():
+    asset_df, signal_df = create_asset_signal()
+    br = create_backtest_request()
+    br.portfolio_notional_size = 1000000
+
+    backtest = Backtest()
+    backtest.calculate_trading_PnL(br, asset_df, signal_df, None)
+
+    # Cumulative indices, trades and notionals are only calculated when they are first asked for
+    assert backtest._pnl_cum is None and backtest._portfolio_trade is None
+    assert backtest._portfolio_signal_notional is None
+
+    pnl_cum = backtest.pnl_cum()
+
+    assert pnl_cum is backtest.pnl_cum()
+    assert_frame_equal(backtest.portfolio_trade(), backtest.portfolio_signal() - backtest.portfolio_signal().shift(1))
+    assert_frame_equal(backtest.portfolio_signal_notional(), backtest.portfolio_signal() * 1000000)
+
+
+def test_backtest_trade_attribution():
+    from findatapy.timeseries import Calculations
+
+    asset_df, signal_df = create_asset_signal()
+    br = create_backtest_request()
+
+    backtest = Backtest()
+    backtest.calculate_trading_PnL(br, asset_df, signal_df, None)
+
+    # Should match the older implementation, which misses the first trade in each asset
+    pnl_trades_df = backtest.pnl_trades()
+    old_pnl_trades_df = Calculations().calculate_individual_trade_gains(backtest.signal(), backtest.pnl())
+
+    is_trade = old_pnl_trades_df.notna().values
+
+    assert (pnl_trades_df.notna().values | ~is_trade).all()
+    np.testing.assert_allclose(pnl_trades_df.values[is_trade], old_pnl_trades_df.values[is_trade])
+
+    # Check each trade against compounding its returns directly
+    trades_df = backtest.pnl_trades_detail()
+    pnl_df = backtest.pnl().fillna(0)
+
+    assert len(trades_df) == pnl_trades_df.notna().values.sum() + trades_df['Open'].sum()
+
+    for _, trade in trades_df.iterrows():
+        entry = pnl_df.index.get_loc(trade['Entry Date'])
+        exit = pnl_df.index.get_loc(trade['Exit Date'])
+
+        assert (backtest.signal()[trade['Asset'].split(' / ')[0]].iloc[entry:exit] == trade['Position']).all()
+
+        trade_pnl = np.cumprod(1 + pnl_df[trade['Asset']].values[entry + 1:exit + 1]) - 1
+
+        assert trade['Holding Periods'] == exit - entry
+        np.testing.assert_allclose([trade['P&L'], trade['MAE'], trade['MFE']],
+                                   [trade_pnl[-1], min(trade_pnl.min(), 0), max(trade_pnl.max(), 0)])
+
+
+def test_trade_attribution_large_losses():
+    from finmarketpy.backtest.tradeattribution import TradeAttribution
+
+    rng = np.random.default_rng(0)
+
+    index = pd.date_range(start='1/1/2020', periods=50, freq='B')
+
+    # Five trades, with (leveraged) returns of -100% or worse during some of them
+    signal = np.repeat([1, -1, 1, -1, 1], 10).astype(float)
+    returns = rng.normal(0, 0.01, len(index))
+    returns[5] = -1.2
+    returns[23] = -1.0
+    returns[32] = -1.5
+    returns[36] = -1.1
+
+    signal_df = pd.DataFrame({'Asset': signal}, index=index)
+    returns_df = pd.DataFrame({'Asset': returns}, index=index)
+
+    trades_df = TradeAttribution().calculate_trades(signal_df, returns_df, cum_index='mult')
+
+    assert len(trades_df) == 5
+
+    # Each trade only compounds its own returns
+    for _, trade in trades_df.iterrows():
+        entry = index.get_loc(trade['Entry Date'])
+        exit = index.get_loc(trade['Exit Date'])
+
+        trade_pnl = np.cumprod(1 + returns[entry + 1:exit + 1]) - 1
+
+        np.testing.assert_allclose([trade['P&L'], trade['MAE'], trade['MFE']],
+                                   [trade_pnl[-1], min(trade_pnl.min(), 0), max(trade_pnl.max(), 0)], atol=1e-12)
+
+
+def test_backtest_stops():
+    asset_df, signal_df = create_asset_signal()
+
+    br = create_backtest_request()
+    br.stop_loss = -0.01
+    br.take_profit = 0.015
+
+    backtest = Backtest()
+    backtest.calculate_trading_PnL(br, asset_df, signal_df, None)
+
+    # Stop levels for each asset
+    br_asset = copy.copy(br)
+    br_asset.stop_loss = [-0.01] * len(cols)
+    br_asset.take_profit = {c: 0.015 for c in cols}
+
+    backtest_asset = Backtest()
+    backtest_asset.calculate_trading_PnL(br_asset, asset_df, signal_df, None)
+
+    assert_frame_equal(backtest.signal(), backtest_asset.signal(), check_exact=True)
+
+    # Trailing stop, checked against a simple loop
+    br_trailing = create_backtest_request()
+    br_trailing.trailing_stop = -0.01
+
+    asset_aligned_df, signal_aligned_df, returns_df = backtest._align_signal_with_asset(br_trailing, asset_df, signal_df)
+    signal_trailing_df = backtest._apply_stop_loss_take_profit(br_trailing, returns_df, signal_aligned_df,
+                                                               np.zeros(asset_aligned_df.shape, dtype=bool))
+
+    signal, returns = signal_aligned_df.values, returns_df.values
+    signal_expected = np.full(signal.shape, np.nan)
+
+    for c in range(len(cols)):
+        trade_ret, trade_peak, position = 0, 0, np.nan
+
+        for i in range(1, len(signal)):
+            is_stopped = False
+
+            if i >= 2 and not np.isnan(signal[i - 1, c]) and not np.isnan(signal[i - 2, c]):
+                if signal[i - 1, c] != signal[i - 2, c]:
+                    trade_ret, trade_peak = 0, 0
+
+                trade_ret = trade_ret + signal[i - 1, c] * returns[i, c]
+                trade_peak = max(trade_peak, trade_ret)
+                is_stopped = trade_ret - trade_peak < -0.01
+
+            if is_stopped:
+                position = 0
+            elif signal[i, c] != signal[i - 1, c] and not np.isnan(signal[i, c]):
+                position = signal[i, c]
+
+            signal_expected[i, c] = position
+
+    assert (signal_trailing_df.values == 0).sum() > 0
+    np.testing.assert_array_equal(signal_trailing_df.values[1:], signal_expected[1:])
+
+
+def test_portfolio_weight_construction():
+    from findatapy.timeseries import Calculations
+    from finmarketpy.backtest.backtestengine import PortfolioWeightConstruction
+
+    asset_df, signal_df = create_asset_signal()
+    returns_df = asset_df.ffill().pct_change()
+    signal_df = signal_df.ffill()
+
+    br = create_backtest_request()
+    br.signal_vol_adjust = False
+    br.spot_tc_bp = {'Asset1': 2.0, 'default': 0.5}
+    br.spot_rc_bp = 0.1
+    br.portfolio_combination = 'weighted'
+    br.portfolio_combination_weights = {c + ' / ' + c: 1.0 + i for i, c in enumerate(cols)}
+
+    pnl_cols = [c + ' / ' + c for c in cols]
+
+    portfolio_signal_before_weighting_df, portfolio_signal_df, portfolio_leverage_df, portfolio_df, _, signal_pnl_df = \
+        PortfolioWeightConstruction(br=br).optimize_portfolio_weights(returns_df, signal_df, pnl_cols)
+
+    # Should be the same as calculating with DataFrames and repeated matrices
+    signal_pnl_expected_df = Calculations().calculate_signal_returns_with_tc_matrix(
+        signal_df, returns_df, tc=br.spot_tc_bp, rc=br.spot_rc_bp)
+    signal_pnl_expected_df.columns = pnl_cols
+
+    assert_frame_equal(signal_pnl_df, signal_pnl_expected_df, check_exact=True)
+
+    weights_matrix = np.repeat(np.arange(1.0, len(cols) + 1)[np.newaxis, :], len(dates), 0)
+    weights_matrix[signal_pnl_expected_df.isna().values] = 0
+    total_weights = np.transpose(np.repeat(weights_matrix.sum(axis=1)[np.newaxis, :], len(cols), 0))
+    weights_matrix = weights_matrix / np.where(total_weights == 0, 1.0, total_weights)
+
+    leverage_matrix = np.transpose(np.repeat(portfolio_leverage_df.values.T, len(cols), 0))
+
+    portfolio_expected = np.nansum(signal_pnl_expected_df.values * weights_matrix, axis=1)
+    portfolio_expected[signal_pnl_expected_df.isna().all(axis=1).values] = np.nan
+
+    np.testing.assert_allclose(portfolio_df['Portfolio'].values, portfolio_expected)
+    np.testing.assert_array_equal(portfolio_signal_before_weighting_df.values, leverage_matrix * signal_df.values)
+    np.testing.assert_allclose(portfolio_signal_df.values, leverage_matrix * signal_df.values * weights_matrix)
@@ -0,0 +1,295 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+import pytest
+import pandas as pd
+import numpy as np
+from pandas.tseries.offsets import CustomBusinessDay, CustomBusinessMonthEnd
+
+from findatapy.timeseries import Calendar
+
+from finmarketpy.curve.fxforwardscurve import FXForwardsCurve
+from finmarketpy.curve.rates.fxforwardspricer import FXForwardsPricer, QuotedDeliveryCache, _forwards_interpolate_numba
+from finmarketpy.util.businesscalendar import BusinessDayCalendar
+
+
+def test_business_day_offsets():
+    holidays = Calendar().get_holidays(cal='EURUSD')
+    business_day_calendar = BusinessDayCalendar.get('EURUSD')
+
+    # Shared for the same holiday calendar
+    assert BusinessDayCalendar.get('EURUSD') is business_day_calendar
+
+    # Include weekends and holidays, which are rolled differently
+    dates = pd.date_range(start='1 Dec 2018', end='31 Jan 2020', freq='D')
+
+    for n in [1, 2, 4]:
+        assert (business_day_calendar.business_month_end_offset(dates, n) ==
+                dates + CustomBusinessMonthEnd(n, holidays=holidays)).all()
+
+    for n in [-5, -1, 0, 1, 2]:
+        assert (business_day_calendar.business_day_offset(dates, n) ==
+                dates + CustomBusinessDay(n=n, holidays=holidays)).all()
+
+
+def test_construct_roll_schedule():
+    cross = 'EURUSD'
+    horizon_date = pd.bdate_range(start='1 Jan 2019', end='31 Dec 2019')
+
+    fx_forwards_curve = FXForwardsCurve()
+
+    roll_schedule_df = fx_forwards_curve.construct_roll_schedule(cross, horizon_date, fx_forwards_trading_tenor='1M',
+                                                                 roll_days_before=5, roll_event='month-end',
+                                                                 roll_months=1)
+
+    new_trade = roll_schedule_df[cross + '-roll.close'].values
+    roll_date = pd.DatetimeIndex(roll_schedule_df[cross + '.roll-date'])
+    delivery_date = pd.DatetimeIndex(roll_schedule_df[cross + '.delivery-date'])
+
+    # Trade at the start and then roll every month, 5 business days before month end
+    assert new_trade[0] and new_trade.sum() == 13
+    assert (horizon_date[new_trade][1:] == roll_date[np.roll(new_trade, -1)][:-1]).all()
+
+    # Same contract is held until the next roll
+    trade_no = np.cumsum(new_trade)
+
+    for t in range(1, trade_no[-1] + 1):
+        assert len(delivery_date[trade_no == t].unique()) == 1
+
+    delivery_ser = Calendar().get_delivery_date_from_horizon_date(horizon_date[new_trade], '1M', cal=cross)
+
+    assert (delivery_date[new_trade] == delivery_ser).all()
+
+    # Cached for the same horizon dates
+    assert roll_schedule_df.equals(fx_forwards_curve.construct_roll_schedule(cross, horizon_date,
+                                                                             fx_forwards_trading_tenor='1M',
+                                                                             roll_days_before=5,
+                                                                             roll_event='month-end', roll_months=1))
+
+
+def test_construct_total_return_index_mtm():
+    cross = 'EURUSD'
+    tenors = ['1W', '2W', '3W', '1M', '2M', '3M']
+
+    np.random.seed(42)
+
+    horizon_date = pd.bdate_range(start='1 Jan 2019', end='30 Jun 2019')
+
+    market_df = pd.DataFrame(index=horizon_date)
+    market_df[cross + '.close'] = 1.15 * np.exp(np.cumsum(np.random.normal(0, 0.005, len(horizon_date))))
+
+    for i, tenor in enumerate(tenors):
+        market_df[cross + tenor + '.close'] = 5 * (i + 1) + np.random.normal(0, 0.5, len(horizon_date))
+
+    total_return_index_df = FXForwardsCurve().construct_total_return_index(
+        cross, market_df, fx_forwards_tenor_for_interpolation=tenors, output_calculation_fields=True)
+
+    new_trade = total_return_index_df[cross + '-roll.close'].values
+    delivery_date = pd.DatetimeIndex(total_return_index_df[cross + '.delivery-date'])
+
+    fx_forwards_pricer = FXForwardsPricer()
+
+    # On a roll, we mark to market the contract we rolled out of (priced one at a time)
+    for i in np.flatnonzero(new_trade[1:]) + 1:
+        mtm = fx_forwards_pricer.price_instrument(cross, horizon_date[i], delivery_date[i - 1], market_df=market_df,
+                                                  fx_forwards_tenor_for_interpolation=tenors)
+
+        assert total_return_index_df[cross + '-mtm.close'].iloc[i] == \
+               mtm[cross + '-interpolated-outright-forward.close'].iloc[0]
+
+    assert (total_return_index_df[cross + '-mtm.close'].values[~new_trade] ==
+            total_return_index_df[cross + '-interpolated-outright-forward.close'].values[~new_trade]).all()
+
+
+def test_quoted_delivery_cache(tmp_path):
+    cross = 'USDJPY'
+    horizon_date = pd.bdate_range(start='1 Jan 2019', end='31 Dec 2019')
+
+    calendar = Calendar()
+
+    # Also persisted to disk
+    quoted_delivery_cache = QuotedDeliveryCache(max_size=1, folder=str(tmp_path))
+    quoted_delivery_cache.clear()
+
+    for tenor in ['1W', '1M']:
+        expected = calendar.get_delivery_date_from_horizon_date(horizon_date, tenor, cal=cross)
+
+        # Sub-ranges are served from the cache, and overlapping ranges only calculate the new dates
+        assert (quoted_delivery_cache.get_delivery_date(cross, horizon_date[100:200], tenor) == expected[100:200]).all()
+        assert (quoted_delivery_cache.get_delivery_date(cross, horizon_date[150:], tenor) == expected[150:]).all()
+        assert (quoted_delivery_cache.get_delivery_date(cross, horizon_date[120:130], tenor) == expected[120:130]).all()
+
+    quoted_delivery_cache.clear()
+
+    # Loaded from disk
+    assert (QuotedDeliveryCache(folder=str(tmp_path)).get_delivery_date(cross, horizon_date[100:], '1W') ==
+            calendar.get_delivery_date_from_horizon_date(horizon_date[100:], '1W', cal=cross)).all()
+
+    assert len(list(tmp_path.iterdir())) == 2
+
+    quoted_delivery_cache.clear()
+
+
+def test_construct_total_return_index_parallel():
+    crosses = ['EURUSD', 'USDJPY', 'USDUSD', 'AUDUSD']
+    tenors = ['1W', '1M', '3M']
+
+    rng = np.random.default_rng(0)
+
+    horizon_date = pd.bdate_range(start='1 Jan 2019', end='31 Dec 2019')
+
+    market_df = pd.DataFrame(index=horizon_date)
+
+    for cross in crosses[:2] + crosses[3:]:
+        market_df[cross + '.close'] = np.exp(np.cumsum(rng.normal(0, 0.005, len(horizon_date))))
+
+        for i, tenor in enumerate(tenors):
+            market_df[cross + tenor + '.close'] = 5 * (i + 1) + rng.normal(0, 0.5, len(horizon_date))
+
+    fx_forwards_curve = FXForwardsCurve()
+
+    total_return_index_df = fx_forwards_curve.construct_total_return_index(
+        crosses, market_df, fx_forwards_tenor_for_interpolation=tenors, output_calculation_fields=True)
+
+    # Same output (and in the same order) whether or not the crosses are constructed in parallel
+    parallel_total_return_index_df = fx_forwards_curve.construct_total_return_index(
+        crosses, market_df, fx_forwards_tenor_for_interpolation=tenors, output_calculation_fields=True,
+        run_in_parallel=True, thread_no=2)
+
+    pd.testing.assert_frame_equal(total_return_index_df, parallel_total_return_index_df)
+
+    cross_timing_df = fx_forwards_curve.get_cross_timing()
+
+    assert list(cross_timing_df.index) == crosses
+    assert (cross_timing_df['time'] >= 0).all()
+
+
+def test_construct_via_currency():
+    tickers = ['AUDJPY', 'EURUSD', 'USDJPY', 'USDUSD', 'EURJPY']
+    tenors = ['1W', '1M', '3M']
+
+    rng = np.random.default_rng(1)
+
+    horizon_date = pd.bdate_range(start='1 Jan 2019', end='30 Jun 2019')
+
+    market_df = pd.DataFrame(index=horizon_date)
+
+    for cross in ['AUDUSD', 'EURUSD', 'USDJPY']:
+        market_df[cross + '.close'] = np.exp(np.cumsum(rng.normal(0, 0.005, len(horizon_date))))
+
+        for i, tenor in enumerate(tenors):
+            market_df[cross + tenor + '.close'] = 5 * (i + 1) + rng.normal(0, 0.5, len(horizon_date))
+
+    fx_forwards_curve = FXForwardsCurve(fx_forwards_tenor_for_interpolation=tenors)
+
+    # Each leg is only needed once
+    legs = fx_forwards_curve._get_via_currency_legs(tickers, 'USD')
+
+    assert legs == ['AUDUSD', 'JPYUSD', 'EURUSD', 'USDUSD']
+
+    leg_df = fx_forwards_curve.construct_total_return_index(legs, market_df)
+
+    total_return_index_df = fx_forwards_curve._construct_via_currency_total_return_index(tickers, 'USD', leg_df,
+                                                                                        '-forward-tot.close')
+
+    assert list(total_return_index_df.columns) == [x + '-forward-tot.close' for x in tickers]
+
+    # Same as constructing the base and terms separately for each ticker
+    def get_rets(cross):
+        return fx_forwards_curve.construct_total_return_index(cross, market_df).iloc[:, 0].pct_change().fillna(0)
+
+    aud_rets, jpy_rets, eur_rets = get_rets('AUDUSD'), get_rets('JPYUSD'), get_rets('EURUSD')
+
+    for tick, rets in [('AUDJPY', aud_rets - jpy_rets), ('EURUSD', eur_rets), ('USDJPY', -jpy_rets),
+                       ('USDUSD', 0 * eur_rets), ('EURJPY', eur_rets - jpy_rets)]:
+        assert total_return_index_df[tick + '-forward-tot.close'].values == \
+               pytest.approx(100 * np.cumprod(1 + rets.values))
+
+
+def test_calculate_implied_depo_panel():
+    crosses = ['EURUSD', 'USDJPY', 'AUDUSD']
+    implied_currency = ['EUR', 'JPY', 'AUD']
+    tenors = ['1W', '1M', '3M']
+
+    rng = np.random.default_rng(2)
+
+    horizon_date = pd.bdate_range(start='1 Jan 2019', end='30 Jun 2019')
+
+    market_df = pd.DataFrame(index=horizon_date)
+
+    for cross in crosses:
+        market_df[cross + '.close'] = np.exp(np.cumsum(rng.normal(0, 0.005, len(horizon_date))))
+
+        for i, tenor in enumerate(tenors):
+            market_df[cross + tenor + '.close'] = 5 * (i + 1) + rng.normal(0, 0.5, len(horizon_date))
+
+    for currency in ['USD']:
+        for tenor in tenors:
+            market_df[currency + tenor + '.close'] = 2 + rng.normal(0, 0.1, len(horizon_date))
+
+    fx_forwards_pricer = FXForwardsPricer()
+
+    implied_depo_df = fx_forwards_pricer.calculate_implied_depo_panel(crosses, implied_currency=implied_currency,
+                                                                      market_df=market_df, fx_forwards_tenor=tenors)
+
+    assert len(implied_depo_df.index) == len(crosses) * len(horizon_date) * len(tenors)
+
+    # Same as implying the deposits for each currency pair separately
+    for cross, currency in zip(crosses, implied_currency):
+        expected_df = fx_forwards_pricer.calculate_implied_depo(cross, currency, market_df=market_df,
+                                                               fx_forwards_tenor=tenors)
+
+        for tenor in tenors:
+            df = implied_depo_df[(implied_depo_df['cross'] == cross) & (implied_depo_df['tenor'] == tenor)]
+
+            assert (df['implied_currency'] == currency).all() and (df['original_currency'] == 'USD').all()
+            assert (pd.DatetimeIndex(df['date']) == horizon_date).all()
+            assert df['implied_depo'].values == pytest.approx(
+                expected_df[currency + tenor + '-implied-depo.close'].values)
+            assert df['original_depo'].values == pytest.approx(market_df['USD' + tenor + '.close'].values)
+
+    with pytest.raises(ValueError):
+        fx_forwards_pricer.calculate_implied_depo_panel('EURUSD', implied_currency='JPY', market_df=market_df,
+                                                       fx_forwards_tenor=tenors)
+
+
+def test_forwards_interpolate_numba():
+    rng = np.random.default_rng(3)
+
+    no_of_tenors = 13
+    n = 1001
+
+    quoted_delivery_days_arr = np.cumsum(rng.integers(5, 200, (n, no_of_tenors)), axis=1).astype(float)
+    forwards_points_arr = np.cumsum(rng.normal(0, 10, (n, no_of_tenors)), axis=1)
+    spot_arr = rng.uniform(1, 2, n)
+
+    # Include spot, before the first tenor, exactly on a tenor and beyond the longest tenor
+    spot_delivery_days_arr = rng.integers(-2, quoted_delivery_days_arr[:, -1] + 30).astype(float)
+    spot_delivery_days_arr[::10] = 0
+    spot_delivery_days_arr[5::10] = quoted_delivery_days_arr[5::10, 4]
+
+    # Piecewise linear in the forward points (from zero at spot)
+    expected = spot_arr + np.array([np.interp(d, np.append(0, q), np.append(0, p), right=np.nan)
+                                    if d > 0 else p[0] / q[0] * d
+                                    for d, q, p in zip(spot_delivery_days_arr, quoted_delivery_days_arr,
+                                                       forwards_points_arr)])
+
+    # Same whether or not it's split into chunks for each core
+    for parallel_threshold in [n + 1, 0]:
+        interpolated_arr = _forwards_interpolate_numba(spot_arr, spot_delivery_days_arr, quoted_delivery_days_arr,
+                                                       forwards_points_arr, no_of_tenors,
+                                                       parallel_threshold=parallel_threshold)
+
+        assert interpolated_arr == pytest.approx(expected, nan_ok=True)
+        assert (np.isnan(interpolated_arr) == (spot_delivery_days_arr > quoted_delivery_days_arr[:, -1])).all()
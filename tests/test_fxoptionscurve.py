@@ -0,0 +1,146 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+import pickle
+
+import pytest
+import pandas as pd
+import numpy as np
+from pandas.tseries.offsets import CustomBusinessDay
+
+from findatapy.timeseries import Calendar
+
+from finmarketpy.curve.fxoptionscurve import FXOptionsCurve
+from finmarketpy.curve.volatility.fxvolsurface import FXVolSurface
+from finmarketpy.util.marketconstants import MarketConstants
+
+from .conftest import create_fx_vol_market_df
+
+cross = 'EURUSD'
+
+
+def get_roll_schedule(roll_schedule_df):
+    return [roll_schedule_df[cross + c].values for c in ['-new-trade.close', '-exit-trade.close',
+                                                         '-has-position.close', '.expiry-date', '.roll-date']]
+
+
+def test_construct_roll_schedule():
+    horizon_date = pd.bdate_range(start='1 Jan 2019', end='31 Dec 2019')
+
+    new_trade, exit_trade, has_position, expiry_date, roll_date = get_roll_schedule(
+        FXOptionsCurve().construct_roll_schedule(cross, horizon_date, fx_options_trading_tenor='1M',
+                                                 roll_days_before=5, roll_event='expiry-date'))
+
+    # Trade at the start and then roll 5 business days before expiry, exiting the previous contract
+    assert new_trade[0] and new_trade.sum() == 16
+    assert has_position.all()
+    assert (exit_trade == np.append(False, new_trade[1:])).all()
+
+    trade_no = np.cumsum(new_trade)
+
+    for t in range(1, trade_no[-1] + 1):
+        assert len(set(expiry_date[trade_no == t])) == 1
+        assert len(set(roll_date[trade_no == t])) == 1
+
+    holidays = Calendar().get_holidays(cal=cross)
+
+    assert (pd.DatetimeIndex(roll_date) == pd.DatetimeIndex(expiry_date) - CustomBusinessDay(n=5, holidays=holidays)).all()
+    assert (horizon_date[new_trade][1:] == pd.DatetimeIndex(roll_date[np.roll(new_trade, -1)][:-1])).all()
+
+    expiry_ser = Calendar().get_expiry_date_from_horizon_date(horizon_date[new_trade], '1M', cal=cross)
+
+    # Expiries are moved onto the next horizon date, if they are holidays (apart from the first, and any after the
+    # end of the history)
+    trade_expiry_date = pd.DatetimeIndex(expiry_date[new_trade])
+    in_history = expiry_ser <= horizon_date[-1]
+
+    assert trade_expiry_date[0] == expiry_ser[0]
+    assert (trade_expiry_date[1:][in_history[1:]] ==
+            horizon_date[horizon_date.searchsorted(expiry_ser[1:][in_history[1:]])]).all()
+    assert (trade_expiry_date[~in_history] == expiry_ser[~in_history]).all()
+
+
+def test_construct_roll_schedule_expired_before_roll():
+    horizon_date = pd.bdate_range(start='1 Jan 2019', end='30 Jun 2019')
+
+    new_trade, exit_trade, has_position, expiry_date, roll_date = get_roll_schedule(
+        FXOptionsCurve().construct_roll_schedule(cross, horizon_date, fx_options_trading_tenor='1W',
+                                                 roll_days_before=0, roll_event='month-end', roll_months=1))
+
+    # A 1W option expires well before the month end roll, so we exit it the day after expiry and then have no
+    # position until the roll
+    assert new_trade.sum() == 7
+
+    for i in np.flatnonzero(exit_trade & ~new_trade):
+        assert horizon_date[i - 1] == expiry_date[i - 1] and expiry_date[i] == 0 and roll_date[i] == 0
+
+    assert (has_position == (expiry_date != 0) | exit_trade).all()
+    assert not has_position[~new_trade & (np.roll(exit_trade, 1) | ~np.roll(has_position, 1))].any()
+
+
+def test_construct_roll_schedule_enter_trading_dates():
+    horizon_date = pd.bdate_range(start='1 Jan 2019', end='31 Dec 2019')
+    enter_trading_dates = horizon_date[[10, 100, 110]]
+
+    new_trade, exit_trade, has_position, expiry_date, roll_date = get_roll_schedule(
+        FXOptionsCurve().construct_roll_schedule(cross, horizon_date, enter_trading_dates=enter_trading_dates,
+                                                 fx_options_trading_tenor='1M'))
+
+    assert (horizon_date[new_trade] == enter_trading_dates).all()
+    assert (roll_date == 0).all()
+
+    # Hold until expiry, unless we enter a new trade before then
+    expiry_ser = Calendar().get_expiry_date_from_horizon_date(enter_trading_dates, '1M', cal=cross)
+
+    assert (has_position == ((horizon_date >= enter_trading_dates[0]) & (horizon_date <= expiry_ser[0])) |
+            ((horizon_date >= enter_trading_dates[1]) & (horizon_date <= expiry_ser[2]))).all()
+    assert (horizon_date[exit_trade] == expiry_ser[[0, 2]]).all()
+    assert (expiry_date[has_position] != 0).all() and (expiry_date[~has_position] == 0).all()
+
+
+def test_construct_total_return_index_parallel():
+    pytest.importorskip('financepy')
+
+    tenors = MarketConstants().fx_options_tenor_for_interpolation
+
+    horizon_date = pd.bdate_range(start='2 Jan 2019', end='31 Jan 2019')
+    market_df = create_fx_vol_market_df(cross, horizon_date, tenors)
+
+    fx_vol_surface = FXVolSurface(market_df=market_df, asset=cross, tenors=tenors, cache_size=0)
+    fx_options_curve = FXOptionsCurve(fx_options_trading_tenor='1W', roll_months=1, fx_vol_surface=fx_vol_surface)
+
+    total_return_index_df = fx_options_curve.construct_total_return_index([cross, 'USDUSD'], market_df)
+
+    # Same output whether or not the crosses are constructed in parallel (where the vol surface is created again
+    # in each process from shared memory)
+    parallel_total_return_index_df = fx_options_curve.construct_total_return_index(
+        [cross, 'USDUSD'], market_df, run_in_parallel=True, thread_no=2)
+
+    pd.testing.assert_frame_equal(total_return_index_df, parallel_total_return_index_df)
+
+    # Neither the curve nor the parameters sent to each process hold the vol surface's market data
+    shared_list = []
+
+    worker_curve = fx_options_curve._get_worker_curve()
+    worker_kwargs = fx_options_curve._get_kwargs_for_worker({'fx_vol_surface': fx_vol_surface}, shared_list)
+
+    try:
+        assert worker_curve._fx_vol_surface is None and fx_options_curve._fx_vol_surface is fx_vol_surface
+        assert len(pickle.dumps(worker_kwargs)) < len(pickle.dumps({'fx_vol_surface': fx_vol_surface})) / 10
+
+        assert fx_options_curve._get_kwargs_from_worker(worker_kwargs)['fx_vol_surface'] \
+            .get_all_market_data().equals(market_df)
+    finally:
+        for shared in shared_list:
+            shared.close()
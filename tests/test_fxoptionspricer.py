@@ -0,0 +1,148 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+import pytest
+import pandas as pd
+import numpy as np
+
+from finmarketpy.curve.volatility.fxoptionspricer import FXOptionsPricer
+from finmarketpy.util.marketconstants import MarketConstants
+
+from .conftest import create_fx_vol_market_df
+
+market_constants = MarketConstants()
+
+premium_outputs = ['pct-for', 'pct-dom', 'pips-for', 'pips-dom', 'cash-for', 'cash-dom']
+delta_outputs = ['pips-spot-delta', 'pips-fwd-delta', 'pct-spot-delta-prem-adj', 'pct-fwd-delta-prem-adj']
+
+
+@pytest.mark.parametrize('contract_type', ['european-call', 'european-put'])
+def test_price_vanilla_against_financepy(contract_type):
+    pytest.importorskip('financepy')
+
+    from financepy.utils.date import Date
+    from financepy.market.curves.discount_curve_flat import DiscountCurveFlat
+    from financepy.models.black_scholes import BlackScholes
+    from financepy.products.fx.fx_vanilla_option import FXVanillaOption
+    from financepy.utils.global_types import OptionTypes
+
+    option_type = OptionTypes.EUROPEAN_CALL if contract_type == 'european-call' else OptionTypes.EUROPEAN_PUT
+
+    horizon_date = pd.Timestamp('2 Jan 2020')
+    expiry_date = pd.DatetimeIndex(['3 Jan 2020', '3 Feb 2020', '2 Jul 2020', '4 Jan 2021'])
+    strike = np.array([1.10, 1.12, 1.15, 1.20])
+    vol = np.array([0.05, 0.07, 0.08, 0.1])
+    spot, dom_depo, for_depo = 1.12, 0.02, -0.005
+
+    fx_options_pricer = FXOptionsPricer()
+
+    value_date = Date(horizon_date.day, horizon_date.month, horizon_date.year)
+    dom_discount_curve = DiscountCurveFlat(value_date, dom_depo)
+    for_discount_curve = DiscountCurveFlat(value_date, for_depo)
+
+    for premium_output in premium_outputs:
+        for delta_output in delta_outputs:
+            option_values, delta = fx_options_pricer.price_vanilla(
+                horizon_date, expiry_date, spot, strike, vol, dom_depo, for_depo, contract_type=contract_type,
+                notional=1000000, premium_output=premium_output, delta_output=delta_output)
+
+            for i in range(len(expiry_date)):
+                option = FXVanillaOption(Date(expiry_date[i].day, expiry_date[i].month, expiry_date[i].year),
+                                         strike[i], 'EURUSD', option_type, 1000000, 'EUR')
+                model = BlackScholes(vol[i])
+
+                value_fin = option.value(value_date, spot, dom_discount_curve, for_discount_curve, model)[
+                    premium_output.replace('-', '_')]
+                delta_fin = option.delta(value_date, spot, dom_discount_curve, for_discount_curve, model)[
+                    delta_output.replace('-', '_')]
+
+                # FinancePy uses an approximation for the normal CDF, which is accurate to around 1e-7
+                assert option_values[i] == pytest.approx(value_fin, rel=1e-5, abs=1e-6)
+                assert delta[i] == pytest.approx(delta_fin, abs=1e-6)
+
+
+def test_price_vanilla_put_call_parity():
+    horizon_date = pd.bdate_range(start='1 Jan 2010', end='31 Dec 2019')
+    expiry_date = horizon_date + pd.Timedelta(days=30)
+
+    rng = np.random.default_rng(0)
+
+    spot = 1.1 * np.exp(np.cumsum(rng.normal(0, 0.005, len(horizon_date))))
+    strike = spot * rng.uniform(0.95, 1.05, len(horizon_date))
+    vol = rng.uniform(0.05, 0.15, len(horizon_date))
+    dom_depo, for_depo = 0.02, 0.01
+
+    fx_options_pricer = FXOptionsPricer()
+
+    kwargs = dict(premium_output='pips-dom', delta_output='pips-spot-delta')
+
+    call, call_delta = fx_options_pricer.price_vanilla(horizon_date, expiry_date, spot, strike, vol, dom_depo,
+                                                       for_depo, contract_type='european-call', **kwargs)
+    put, put_delta = fx_options_pricer.price_vanilla(horizon_date, expiry_date, spot, strike, vol, dom_depo,
+                                                     for_depo, contract_type='european-put', **kwargs)
+    straddle, straddle_delta = fx_options_pricer.price_vanilla(horizon_date, expiry_date, spot, strike, vol,
+                                                               dom_depo, for_depo, contract_type='european-straddle',
+                                                               **kwargs)
+
+    t = 30 / 365.0
+
+    assert call - put == pytest.approx(spot * np.exp(-for_depo * t) - strike * np.exp(-dom_depo * t))
+    assert call_delta - put_delta == pytest.approx(np.full(len(horizon_date), np.exp(-for_depo * t)))
+    assert straddle == pytest.approx(call + put)
+    assert straddle_delta == pytest.approx(call_delta + put_delta)
+
+    # Options which have already expired can't be priced
+    option_values, delta = fx_options_pricer.price_vanilla(expiry_date, horizon_date, spot, strike, vol, dom_depo,
+                                                           for_depo, **kwargs)
+
+    assert np.isnan(option_values).all() and np.isnan(delta).all()
+
+    with pytest.raises(ValueError):
+        fx_options_pricer.price_vanilla(horizon_date, expiry_date, spot, strike, vol, dom_depo, for_depo,
+                                        premium_output='pct')
+
+
+@pytest.mark.parametrize('contract_type', ['european-call', 'european-straddle'])
+def test_price_instrument_pricing_engines(contract_type):
+    pytest.importorskip('financepy')
+
+    from finmarketpy.curve.volatility.fxvolsurface import FXVolSurface
+
+    cross = 'EURUSD'
+    tenors = market_constants.fx_options_tenor_for_interpolation
+    horizon_date = pd.bdate_range(start='2 Jan 2019', end='8 Jan 2019')
+
+    market_df = create_fx_vol_market_df(cross, horizon_date, tenors)
+
+    try:
+        fx_vol_surface = FXVolSurface(market_df=market_df, asset=cross, tenors=tenors)
+    except NameError:
+        pytest.skip('FinancePy version is not supported by FXVolSurface')
+
+    for strike, vol in [(1.15, 0.08), ('atm', None), (1.15, None)]:
+        option_prices = {}
+
+        for pricing_engine in ['financepy', 'finmarketpy']:
+            option_prices[pricing_engine] = FXOptionsPricer(fx_vol_surface=fx_vol_surface,
+                                                            pricing_engine=pricing_engine).price_instrument(
+                cross, horizon_date, strike, vol=vol, tenor='1M', contract_type=contract_type)
+
+        financepy_df = option_prices['financepy']
+        finmarketpy_df = option_prices['finmarketpy']
+
+        assert (financepy_df[cross + '.expiry-date'] == finmarketpy_df[cross + '.expiry-date']).all()
+
+        for field in ['-option-price', '', '-strike', '-vol', '-delta', '-intrinsic-value']:
+            assert finmarketpy_df[cross + field + '.close'].values.astype(float) == \
+                   pytest.approx(financepy_df[cross + field + '.close'].values.astype(float), abs=1e-6)
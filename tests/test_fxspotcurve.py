@@ -0,0 +1,115 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+import pytest
+import pandas as pd
+import numpy as np
+
+from finmarketpy.curve.fxspotcurve import FXSpotCurve
+
+crosses = ['EURUSD', 'USDJPY', 'USDUSD']
+
+
+def create_intraday_market_df():
+    rng = np.random.default_rng(0)
+
+    horizon_date = pd.date_range(start='1 Jan 2020', periods=10000, freq='min')
+
+    market_df = pd.DataFrame(index=horizon_date)
+
+    for cross in ['EURUSD', 'USDJPY']:
+        market_df[cross + '.close'] = np.exp(np.cumsum(rng.normal(0, 1e-4, len(horizon_date))))
+
+    # Deposits are patchy (and missing at the start for EUR)
+    for currency in ['EUR', 'USD', 'JPY']:
+        depo = rng.normal(1, 0.2, len(horizon_date))
+        depo[rng.random(len(horizon_date)) < 0.5] = np.nan
+
+        market_df[currency + 'ON.close'] = depo
+
+    market_df.iloc[:2000, market_df.columns.get_loc('EURON.close')] = np.nan
+
+    return market_df
+
+
+def test_construct_total_return_index_stream():
+    market_df = create_intraday_market_df()
+
+    fx_spot_curve = FXSpotCurve(depo_tenor='ON')
+
+    total_return_index_df = fx_spot_curve.construct_total_return_index(crosses, market_df)[
+        [x + '-tot.close' for x in crosses]]
+
+    market_df_chunks = (market_df.iloc[i:i + 777] for i in range(0, len(market_df.index), 777))
+
+    # Same as constructing it all in one go (chunks are only held back until there are EUR deposits)
+    total_return_index_chunks = list(fx_spot_curve.construct_total_return_index_stream(crosses, market_df_chunks))
+
+    assert len(total_return_index_chunks) == len(market_df.index) // 777 + 1 - 2000 // 777
+    pd.testing.assert_frame_equal(pd.concat(total_return_index_chunks), total_return_index_df,
+                                  check_dtype=False, check_freq=False)
+
+    # Carry on later from where we stopped
+    stream_state = {}
+
+    first_df = pd.concat(fx_spot_curve.construct_total_return_index_stream(crosses, [market_df.iloc[:5000]],
+                                                                           stream_state=stream_state))
+    second_df = pd.concat(fx_spot_curve.construct_total_return_index_stream(crosses, [market_df.iloc[5000:]],
+                                                                            stream_state=stream_state))
+
+    pd.testing.assert_frame_equal(pd.concat([first_df, second_df]), total_return_index_df,
+                                  check_dtype=False, check_freq=False)
+
+    # Empty chunks are skipped
+    total_return_index_chunks = list(fx_spot_curve.construct_total_return_index_stream(
+        crosses, [market_df.iloc[:6000], market_df.iloc[6000:6000], market_df.iloc[6000:]]))
+
+    assert len(total_return_index_chunks) == 2
+    pd.testing.assert_frame_equal(pd.concat(total_return_index_chunks), total_return_index_df,
+                                  check_dtype=False, check_freq=False)
+
+
+def test_construct_total_return_index_stream_max_pending_rows():
+    market_df = create_intraday_market_df()
+
+    fx_spot_curve = FXSpotCurve(depo_tenor='ON')
+
+    market_df_chunks = [market_df.iloc[i:i + 777] for i in range(0, len(market_df.index), 777)]
+
+    # EUR deposits only start after 2000 rows
+    assert len(list(fx_spot_curve.construct_total_return_index_stream(crosses, market_df_chunks,
+                                                                      max_pending_rows=2000))) > 0
+
+    with pytest.raises(Exception, match='No deposit data'):
+        list(fx_spot_curve.construct_total_return_index_stream(crosses, market_df_chunks, max_pending_rows=1000))
+
+
+def test_construct_total_return_index_stream_parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+
+    market_df = create_intraday_market_df()
+
+    path = str(tmp_path / 'market_df.parquet')
+    market_df.to_parquet(path, row_group_size=1000)
+
+    fx_spot_curve = FXSpotCurve(depo_tenor='ON')
+
+    total_return_index_df = fx_spot_curve.construct_total_return_index(crosses, market_df)[
+        [x + '-tot.close' for x in crosses]]
+
+    total_return_index_chunks = list(fx_spot_curve.construct_total_return_index_stream(crosses, path))
+
+    assert len(total_return_index_chunks) == 8
+    pd.testing.assert_frame_equal(pd.concat(total_return_index_chunks), total_return_index_df,
+                                  check_dtype=False, check_freq=False)
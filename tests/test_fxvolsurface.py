@@ -0,0 +1,277 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+import threading
+
+import pytest
+import pandas as pd
+import numpy as np
+
+from finmarketpy.util.marketconstants import MarketConstants
+
+from .conftest import create_fx_vol_market_df
+
+market_constants = MarketConstants()
+
+cross = 'EURUSD'
+tenors = market_constants.fx_options_tenor_for_interpolation
+
+
+def create_fx_vol_surface(market_df, **kwargs):
+    pytest.importorskip('financepy')
+
+    from finmarketpy.curve.volatility.fxvolsurface import FXVolSurface
+
+    try:
+        return FXVolSurface(market_df=market_df, asset=cross, tenors=tenors, **kwargs)
+    except NameError:
+        pytest.skip('FinancePy version is not supported by FXVolSurface')
+
+
+def test_vol_surface_cache(tmp_path):
+    horizon_date = pd.bdate_range(start='2 Jan 2019', end='4 Jan 2019')
+    market_df = create_fx_vol_market_df(cross, horizon_date, tenors)
+
+    fx_vol_surface = create_fx_vol_surface(market_df, cache_folder=str(tmp_path))
+    fx_vol_surface._vol_surface_cache.clear()
+
+    fx_vol_surface.build_vol_surface(horizon_date[0])
+    fin_fx_vol_surface = fx_vol_surface._fin_fx_vol_surface
+
+    # Same date, so the calibrated surface is reused (also by other instances with the same market data)
+    fx_vol_surface.build_vol_surface(horizon_date[1])
+    fx_vol_surface.build_vol_surface(horizon_date[0])
+
+    assert fx_vol_surface._fin_fx_vol_surface is fin_fx_vol_surface
+
+    create_fx_vol_surface(market_df.copy()).build_vol_surface(horizon_date[0])
+
+    assert fx_vol_surface._fin_fx_vol_surface is fin_fx_vol_surface
+
+    # Different quotes or calibration settings need a new calibration
+    shifted_market_df = market_df.copy()
+    shifted_market_df[cross + 'V1M.close'] = shifted_market_df[cross + 'V1M.close'] + 0.5
+
+    for other_fx_vol_surface in [create_fx_vol_surface(shifted_market_df),
+                                 create_fx_vol_surface(market_df, alpha=0.4)]:
+        other_fx_vol_surface.build_vol_surface(horizon_date[0])
+
+        assert other_fx_vol_surface._fin_fx_vol_surface is not fin_fx_vol_surface
+
+    # Loaded from disk, after clearing the cache in memory
+    fx_vol_surface._vol_surface_cache.clear()
+
+    fx_vol_surface = create_fx_vol_surface(market_df, cache_folder=str(tmp_path))
+    fx_vol_surface.build_vol_surface(horizon_date[0])
+
+    assert fx_vol_surface._fin_fx_vol_surface is not fin_fx_vol_surface
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # Calibrating again without the cache gives the same surface
+    uncached_fx_vol_surface = create_fx_vol_surface(market_df, cache_size=0)
+    uncached_fx_vol_surface.build_vol_surface(horizon_date[0])
+
+    assert uncached_fx_vol_surface._fin_fx_vol_surface is not fin_fx_vol_surface
+
+    for t in range(len(tenors)):
+        assert fx_vol_surface.get_vol_from_quoted_tenor(1.15, t) == \
+               pytest.approx(uncached_fx_vol_surface.get_vol_from_quoted_tenor(1.15, t))
+
+    fx_vol_surface._vol_surface_cache.clear()
+
+
+def test_build_vol_surface_history(tmp_path):
+    from finmarketpy.curve.volatility.fxvolsurfacehistory import FXVolSurfaceHistory
+
+    horizon_date = pd.bdate_range(start='2 Jan 2019', end='9 Jan 2019')
+    market_df = create_fx_vol_market_df(cross, horizon_date, tenors)
+
+    # Can't calibrate a surface without an ATM vol
+    market_df.loc[horizon_date[3], cross + 'V1M.close'] = np.nan
+
+    fx_vol_surface = create_fx_vol_surface(market_df, cache_size=0)
+
+    fx_vol_surface_history = fx_vol_surface.build_vol_surface_history(run_in_parallel=True, thread_no=2)
+
+    assert (fx_vol_surface_history.value_date == horizon_date).all()
+    assert fx_vol_surface_history.calibrated.tolist() == [True, True, True, False, True, True]
+
+    # Same as calibrating each date separately (in this process)
+    for i in [0, 5]:
+        fx_vol_surface.build_vol_surface(horizon_date[i])
+        df_vol_dict = fx_vol_surface.extract_vol_surface(num_strike_intervals=None)
+
+        assert fx_vol_surface_history.get_deltas_vs_strikes(horizon_date[i]).equals(
+            df_vol_dict['deltas_vs_strikes'].loc[FXVolSurfaceHistory.key_strikes_names].astype(float))
+        assert fx_vol_surface_history.get_vol_surface_delta_space(horizon_date[i]).equals(
+            df_vol_dict['vol_surface_delta_space'].loc[FXVolSurfaceHistory.key_strikes_names].astype(float))
+
+        assert fx_vol_surface_history.get_strike('1M', 'K_25D_C').iloc[i] == fx_vol_surface.get_25d_call_strike('1M')
+        assert fx_vol_surface_history.get_vol('1M').iloc[i] == fx_vol_surface.get_atm_vol('1M')
+
+        assert fx_vol_surface_history.get_vol_from_quoted_tenor(horizon_date[i], 1.16, '3M') == \
+               fx_vol_surface.get_vol_from_quoted_tenor(1.16, '3M')
+
+    assert np.isnan(fx_vol_surface_history.get_vol('1M').iloc[3])
+
+    # Round trip to disk
+    path = str(tmp_path / 'eurusd_vol_surface.npz')
+    fx_vol_surface_history.save(path)
+
+    loaded_fx_vol_surface_history = FXVolSurfaceHistory.load(path)
+
+    assert (loaded_fx_vol_surface_history.value_date == horizon_date).all()
+    assert loaded_fx_vol_surface_history.tenors == tenors
+
+    for attr in ['strikes', 'vols', 'parameters', 'fwd', 't_exp', 'calibrated']:
+        np.testing.assert_array_equal(getattr(loaded_fx_vol_surface_history, attr),
+                                      getattr(fx_vol_surface_history, attr))
+
+
+@pytest.mark.parametrize('solver', ['nelmer-mead-numba', 'nelmer-mead'])
+def test_warm_start_calibration(solver):
+    horizon_date = pd.bdate_range(start='2 Jan 2019', end='10 Jan 2019')
+    market_df = create_fx_vol_market_df(cross, horizon_date, tenors)
+
+    fx_vol_surface = create_fx_vol_surface(market_df, cache_size=0, solver=solver)
+
+    cold_fx_vol_surface_history = fx_vol_surface.build_vol_surface_history(run_in_parallel=False,
+                                                                           calibration_diagnostics=True)
+    warm_fx_vol_surface_history = fx_vol_surface.build_vol_surface_history(run_in_parallel=False, warm_start=True)
+
+    cold_diagnostics_df = cold_fx_vol_surface_history.get_calibration_diagnostics()
+    warm_diagnostics_df = warm_fx_vol_surface_history.get_calibration_diagnostics()
+
+    # First date always starts from scratch, later ones start from the previous date's parameters
+    assert warm_diagnostics_df['function_calls'].iloc[0] == cold_diagnostics_df['function_calls'].iloc[0]
+    assert warm_diagnostics_df['function_calls'].iloc[1:].sum() < cold_diagnostics_df['function_calls'].iloc[1:].sum()
+
+    if solver == 'nelmer-mead':
+        assert warm_diagnostics_df['iterations'].iloc[1:].sum() < cold_diagnostics_df['iterations'].iloc[1:].sum()
+    else:
+        # Numba solver doesn't report its iterations
+        assert warm_diagnostics_df['iterations'].isna().all()
+
+    # Both fit the market quotes equally well
+    assert (warm_diagnostics_df['residual'] < 1e-5).all() and (cold_diagnostics_df['residual'] < 1e-5).all()
+
+    # Solutions can differ slightly, as the quotes don't pin down the vol function exactly (in vol points)
+    for t in tenors:
+        np.testing.assert_allclose(warm_fx_vol_surface_history.get_vol(t), cold_fx_vol_surface_history.get_vol(t),
+                                   atol=0.05)
+
+    # Per tenor diagnostics for the last vol surface built
+    diagnostics_df = fx_vol_surface.get_calibration_diagnostics()
+
+    assert diagnostics_df.index.tolist() == tenors
+    assert (diagnostics_df['function_calls'] > 0).all()
+
+    # Not recorded by default
+    fx_vol_surface.build_vol_surface(horizon_date[0])
+
+    assert fx_vol_surface.get_calibration_diagnostics() is None
+
+
+def test_warm_start_vol_surface_cache(tmp_path):
+    horizon_date = pd.bdate_range(start='2 Jan 2019', end='3 Jan 2019')
+    market_df = create_fx_vol_market_df(cross, horizon_date, tenors)
+
+    fx_vol_surface = create_fx_vol_surface(market_df, cache_folder=str(tmp_path))
+    fx_vol_surface._vol_surface_cache.clear()
+
+    # First date starts from scratch, the second from the first date's parameters
+    fx_vol_surface.build_vol_surface(horizon_date[0], warm_start=True)
+    fx_vol_surface.build_vol_surface(horizon_date[1], warm_start=True)
+    warm_fin_fx_vol_surface = fx_vol_surface._fin_fx_vol_surface
+
+    # Warm started surfaces are only reused when starting from the same parameters, not for a cold start
+    cold_fx_vol_surface = create_fx_vol_surface(market_df, cache_folder=str(tmp_path))
+    cold_fx_vol_surface.build_vol_surface(horizon_date[1])
+
+    assert cold_fx_vol_surface._fin_fx_vol_surface is not warm_fin_fx_vol_surface
+    assert len(list(tmp_path.iterdir())) == 3
+
+    # Also when loaded from disk, it's the same as calibrating from scratch
+    fx_vol_surface._vol_surface_cache.clear()
+
+    cold_fx_vol_surface = create_fx_vol_surface(market_df, cache_folder=str(tmp_path))
+    cold_fx_vol_surface.build_vol_surface(horizon_date[1])
+
+    uncached_fx_vol_surface = create_fx_vol_surface(market_df, cache_size=0)
+    uncached_fx_vol_surface.build_vol_surface(horizon_date[1])
+
+    np.testing.assert_array_equal(np.asarray(cold_fx_vol_surface._fin_fx_vol_surface.parameters),
+                                  np.asarray(uncached_fx_vol_surface._fin_fx_vol_surface.parameters))
+
+    fx_vol_surface._vol_surface_cache.clear()
+
+
+def test_calibration_monitor_needs_x_inits(monkeypatch):
+    fin_fx_vol_surface_plus = pytest.importorskip('financepy.market.volatility.fx_vol_surface_plus')
+
+    from finmarketpy.curve.volatility.fxvolsurface import _CalibrationMonitor
+
+    # Can't warm start if FinancePy no longer takes the initial parameters
+    monkeypatch.setattr(fin_fx_vol_surface_plus, '_solve_to_horizon', lambda s, t, alpha: None)
+
+    with pytest.raises(Exception, match='x_inits'):
+        with _CalibrationMonitor(x_inits=np.zeros((len(tenors), 5))):
+            pass
+
+    # But can still record the diagnostics
+    with _CalibrationMonitor():
+        pass
+
+
+def test_cold_calibration_waits_for_monitor():
+    horizon_date = pd.bdate_range(start='2 Jan 2019', end='3 Jan 2019')
+    market_df = create_fx_vol_market_df(cross, horizon_date, tenors)
+
+    fx_vol_surface = create_fx_vol_surface(market_df, cache_size=0)
+
+    from finmarketpy.curve.volatility.fxvolsurface import _CalibrationMonitor
+
+    thread = threading.Thread(target=fx_vol_surface.build_vol_surface, args=(horizon_date[0],))
+
+    # A cold calibration on another thread doesn't run through FinancePy's functions while they are patched
+    with _CalibrationMonitor(x_inits=np.zeros((len(tenors), 5))) as calibration_monitor:
+        thread.start()
+        thread.join(timeout=1)
+
+        assert thread.is_alive()
+        assert calibration_monitor.residual == []
+
+    thread.join()
+
+    assert fx_vol_surface._fin_fx_vol_surface is not None
+
+
+def test_vol_surface_date_lookup():
+    horizon_date = pd.bdate_range(start='2 Jan 2019', end='8 Jan 2019')
+    market_df = create_fx_vol_market_df(cross, horizon_date, tenors)
+
+    fx_vol_surface = create_fx_vol_surface(market_df)
+
+    # Quotes for each date are fetched by row, with dates as strings or timestamps
+    for i, date in enumerate(horizon_date):
+        for value_date in [date, date.strftime('%Y-%m-%d')]:
+            assert fx_vol_surface._get_date_row(value_date) == i
+
+        assert (fx_vol_surface._vol_quotes[i, 0] == market_df[[cross + 'V' + t + '.close' for t in tenors]]
+                .values[i]).all()
+        assert (fx_vol_surface._vol_quotes[i, 4] == market_df[[cross + '10R' + t + '.close' for t in tenors]]
+                .values[i]).all()
+
+    with pytest.raises(Exception):
+        fx_vol_surface.build_vol_surface('1 Jan 2019')
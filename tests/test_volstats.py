@@ -0,0 +1,45 @@
+__author__ = 'saeedamen'  # Saeed Amen
+
+#
+# Copyright 2016-2020 Cuemacro - https://www.cuemacro.com / @cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+import pytest
+import pandas as pd
+import numpy as np
+
+from finmarketpy.curve.volatility.volstats import VolStats
+
+
+@pytest.mark.parametrize('tenor', ['ON', '1W', '1M'])
+def test_calculate_vol_risk_premium(tenor):
+    rng = np.random.default_rng(0)
+
+    horizon_date = pd.bdate_range(start='1 Jan 2019', end='31 Dec 2019')
+
+    implied_vol = pd.DataFrame({'EURUSDV' + tenor + '.close': rng.uniform(5, 10, len(horizon_date))},
+                               index=horizon_date)
+    realized_vol = pd.DataFrame({'EURUSDH' + tenor + '.close': rng.uniform(5, 10, len(horizon_date))},
+                                index=horizon_date)
+
+    vrp = VolStats().calculate_vol_risk_premium('EURUSD', tenor_label=tenor, implied_vol=implied_vol,
+                                                realized_vol=realized_vol)
+
+    # Implied vol is moved forward by the business days in the tenor, so it covers the same period as realized vol
+    tenor_days = {'ON': 1, '1W': 5, '1M': 20}[tenor]
+
+    implied_aligned = pd.Series(implied_vol.iloc[:, 0].values,
+                                index=[x + pd.tseries.offsets.BDay(tenor_days) for x in horizon_date])
+
+    expected = (implied_aligned - realized_vol.iloc[:, 0]).dropna()
+
+    assert (vrp['EURUSDVRP' + tenor + '.close'].dropna().index == expected.index).all()
+    assert vrp['EURUSDVRP' + tenor + '.close'].dropna().values == pytest.approx(expected.values)